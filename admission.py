@@ -0,0 +1,277 @@
+import asyncio
+import os
+import threading
+import time
+
+from collections import OrderedDict, deque
+from dotenv import load_dotenv
+
+# Admission control for upstream generations.
+# At most ADMISSION_MAX_INFLIGHT generations per worker call the API at once. The others
+# wait in one FIFO queue per user, and free slots go to the users in turn (round-robin),
+# so a user with many queued generations doesn't delay everybody else. Each user also has
+# a token bucket: ADMISSION_BURST generations at once, refilled at ADMISSION_RATE per minute.
+# Slots and tokens count upstream requests: a sectioned generation (see prompts.py) takes one
+# of each per section, up to the whole of ADMISSION_MAX_INFLIGHT or ADMISSION_BURST.
+# Queues are bounded (in total, per user, and in waiting time), which bounds latency under
+# overload: requests past the limits are turned away instead of waiting.
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Admission variables
+ADMISSION_MAX_INFLIGHT = int(os.environ.get("ADMISSION_MAX_INFLIGHT", 8))
+ADMISSION_MAX_QUEUED = int(os.environ.get("ADMISSION_MAX_QUEUED", 64))
+ADMISSION_MAX_QUEUED_PER_USER = int(os.environ.get("ADMISSION_MAX_QUEUED_PER_USER", 2))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 60))
+# - ADMISSION_RATE 0: the quota never refills, ADMISSION_BURST generations per worker lifetime
+ADMISSION_RATE = float(os.environ.get("ADMISSION_RATE", 6))
+ADMISSION_BURST = float(os.environ.get("ADMISSION_BURST", 3))
+
+# - Seconds between queue position updates sent to the client
+ADMISSION_POSITION_INTERVAL = float(os.environ.get("ADMISSION_POSITION_INTERVAL", 1))
+
+
+# The user used up their quota: retry_after is the number of seconds until enough tokens are back,
+# None if the quota never refills (ADMISSION_RATE 0)
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__("too many generations" if retry_after is None else f"too many generations, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+# The generation was turned away: queue full, or waited too long
+class AdmissionRejected(Exception):
+    pass
+
+
+# A generation's place in the admission queue
+# - units: upstream requests of the generation, the tokens charged for it
+# - slots: the slots it holds once admitted, as many as its units, within the controller's limit
+class Ticket:
+    def __init__(self, controller, user_id, units=1):
+        self.controller = controller
+        self.user_id = user_id
+        self.units = units
+        self.slots = max(1, min(units, controller.max_inflight))
+        self.state = "new"
+
+        # True once nobody waits for the generation: a queued ticket then leaves the queue.
+        # Set by the flight the ticket belongs to (see singleflight.py)
+        self.abandoned = lambda: False
+
+    # 1-based place in the queue, 0 once admitted, None if not queued
+    def position(self):
+        return self.controller.position(self)
+
+    # Yield the place in the queue whenever it changes, until the ticket leaves the queue
+    def positions(self, interval=ADMISSION_POSITION_INTERVAL):
+        cond = self.controller._cond
+        last = None
+        while self.state in ("new", "queued"):
+            position = self.position()
+            if position is not None and position != last:
+                last = position
+                yield position
+            with cond:
+                cond.wait_for(lambda: self.state not in ("new", "queued") or self.controller._position(self) != last, interval)
+
+    # Async counterpart of positions(), polling every interval
+    async def apositions(self, interval=ADMISSION_POSITION_INTERVAL):
+        last = None
+        while self.state in ("new", "queued"):
+            position = self.position()
+            if position is not None and position != last:
+                last = position
+                yield position
+            await asyncio.sleep(min(interval, 0.2) if position is None else interval)
+
+
+class AdmissionController:
+    def __init__(self, max_inflight=ADMISSION_MAX_INFLIGHT, max_queued=ADMISSION_MAX_QUEUED,
+                 max_queued_per_user=ADMISSION_MAX_QUEUED_PER_USER, queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+                 rate=ADMISSION_RATE, burst=ADMISSION_BURST):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.queue_timeout = queue_timeout
+        self.rate = max(rate, 0) / 60
+        self.burst = burst
+        self.inflight = 0
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._buckets = {}
+        self._cond = threading.Condition()
+
+    # Take units tokens from the user's bucket; raises RateLimited when there aren't enough
+    def charge(self, user_id, units=1):
+        units = min(units, max(self.burst, 1))
+        now = time.monotonic()
+        with self._cond:
+            tokens, last = self._buckets.get(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < units:
+                raise RateLimited((units - tokens) / self.rate if self.rate > 0 else None)
+            self._buckets[user_id] = (tokens - units, now)
+
+            # Full buckets carry no information: drop them, so the table stays small
+            if len(self._buckets) > 1024:
+                full = [user for user, (t, l) in self._buckets.items() if t + (now - l) * self.rate >= self.burst]
+                for user in full:
+                    del self._buckets[user]
+
+    # Give back the tokens taken by charge(), when the request turned out to cost nothing
+    def refund(self, user_id, units=1):
+        units = min(units, max(self.burst, 1))
+        with self._cond:
+            if user_id in self._buckets:
+                tokens, last = self._buckets[user_id]
+                self._buckets[user_id] = (min(self.burst, tokens + units), last)
+
+    def ticket(self, user_id, units=1):
+        return Ticket(self, user_id, units)
+
+    # Wait for a slot; raises AdmissionRejected if the queue is full or the wait too long
+    def acquire(self, ticket):
+        with self._cond:
+            if ticket.state == "cancelled":
+                raise AdmissionRejected("generation cancelled")
+
+            # Free slot and nobody waiting: go ahead
+            if self.inflight + ticket.slots <= self.max_inflight and not self._queued:
+                self.inflight += ticket.slots
+                ticket.state = "admitted"
+                self._cond.notify_all()
+                return
+
+            user_queue = self._queues.get(ticket.user_id, ())
+            if self._queued >= self.max_queued or len(user_queue) >= self.max_queued_per_user:
+                ticket.state = "rejected"
+                raise AdmissionRejected("server busy, try again later")
+
+            self._queues.setdefault(ticket.user_id, deque()).append(ticket)
+            self._queued += 1
+            ticket.state = "queued"
+            self._cond.notify_all()
+
+            # Wait for a slot, checking every interval that somebody still wants the generation
+            deadline = time.monotonic() + self.queue_timeout
+            while ticket.state == "queued":
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or ticket.abandoned():
+                    self._remove(ticket)
+                    ticket.state = "rejected" if remaining <= 0 else "cancelled"
+                    self._cond.notify_all()
+                    break
+                self._cond.wait(min(remaining, ADMISSION_POSITION_INTERVAL))
+
+            if ticket.state == "rejected":
+                raise AdmissionRejected("server busy, try again later")
+            if ticket.state != "admitted":
+                raise AdmissionRejected("generation cancelled")
+
+    # Free the slots of an admitted ticket, and hand them to the next user in turn
+    def release(self, ticket):
+        with self._cond:
+            self.inflight -= ticket.slots
+            self._dispatch()
+
+    # Give up a ticket: leave the queue, or free the slot if it was already admitted
+    def cancel(self, ticket):
+        with self._cond:
+            if ticket.state == "admitted":
+                self.inflight -= ticket.slots
+                self._dispatch()
+            elif ticket.state == "queued":
+                self._remove(ticket)
+            ticket.state = "cancelled"
+            self._cond.notify_all()
+
+    # 1-based place of a ticket in the round-robin order, 0 once admitted, None if not queued
+    def position(self, ticket):
+        with self._cond:
+            return self._position(ticket)
+
+    # Generations running and waiting
+    def depth(self):
+        with self._cond:
+            return {"inflight": self.inflight, "queued": self._queued}
+
+    # Round-robin order: the first ticket of every user in queue order, then the second ones...
+    def _position(self, ticket):
+        if ticket.state == "admitted":
+            return 0
+        if ticket.state != "queued":
+            return None
+
+        # Ahead: every ticket of the earlier rounds, and this round's tickets of the users before
+        rank = self._queues[ticket.user_id].index(ticket)
+        ahead = 0
+        before = True
+        for user_id, user_queue in self._queues.items():
+            if user_id == ticket.user_id:
+                before = False
+            ahead += min(len(user_queue), rank)
+            if before and len(user_queue) > rank:
+                ahead += 1
+        return ahead + 1
+
+    # Admit tickets in turn while the next one fits: a large one isn't overtaken by smaller ones
+    def _dispatch(self):
+        while self._queues:
+            user_id, user_queue = next(iter(self._queues.items()))
+            if self.inflight + user_queue[0].slots > self.max_inflight:
+                break
+            del self._queues[user_id]
+            ticket = user_queue.popleft()
+            self._queued -= 1
+
+            # The user's next generation waits for its next turn, behind the other users
+            if user_queue:
+                self._queues[user_id] = user_queue
+
+            self.inflight += ticket.slots
+            ticket.state = "admitted"
+        self._cond.notify_all()
+
+    def _remove(self, ticket):
+        user_queue = self._queues.get(ticket.user_id)
+        if user_queue is not None and ticket in user_queue:
+            user_queue.remove(ticket)
+            self._queued -= 1
+            if not user_queue:
+                del self._queues[ticket.user_id]
+
+    # Run the generator from produce() once the ticket is admitted, and free the slot after it.
+    # A generation turned away costs nothing upstream: the user gets their token back
+    def admitted(self, ticket, produce):
+        try:
+            self.acquire(ticket)
+        except AdmissionRejected:
+            self.refund(ticket.user_id, ticket.units)
+            raise
+
+        try:
+            yield from produce()
+        finally:
+            self.release(ticket)
+
+    # Async counterpart of admitted(): the wait runs in a thread, off the event loop
+    async def aadmitted(self, ticket, produce):
+        try:
+            await asyncio.to_thread(self.acquire, ticket)
+        except AdmissionRejected:
+            self.refund(ticket.user_id, ticket.units)
+            raise
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+
+        try:
+            async for chunk in produce():
+                yield chunk
+        finally:
+            self.release(ticket)
+
+
+admission = AdmissionController()
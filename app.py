@@ -1,38 +1,47 @@
 import openai
 import os
 import sqlalchemy
-import requests
 import json
+import math
+import queue
+import time
+import uuid
 
-from flask import Flask, redirect, render_template, request, url_for, Response
+from flask import Flask, g, jsonify, redirect, render_template, request, url_for, Response
 from flask_login import LoginManager, current_user, login_required, login_user, logout_user, UserMixin
-from werkzeug.security import check_password_hash, generate_password_hash
 from oauthlib.oauth2 import WebApplicationClient
-from sqlalchemy import create_engine
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from itsdangerous import URLSafeSerializer
-
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from admission import AdmissionRejected, RateLimited, admission
+from cache import TTLCache, itinerary_key
+from codec import decode_plan, encode_plan
+from database import db, execute_write, writer
+from hashing import hasher
+from itineraries import agenerate_itinerary, generate_itinerary
+from mailer import MAIL_SENDER, mailer
+from metrics import (
+    GENERATIONS_INFLIGHT, QUEUE_DEPTH, REQUEST_SECONDS, SPOOL_DEPTH, Sampler, observe_generation, observe_stream, render_metrics,
+)
+from migrations import MigrationError, migrate
+from oauth import DiscoveryDocument, http
+from pregenerate import load_pregenerated
+from prompts import DURATION, INTERESTS, MONTHS, PromptTooLong, build_prompt, canonical_trip
+from providers import ProviderError
+from search import index_trip, search_trips
+from singleflight import FlightGroup
+from startup import startup, STARTUP_REQUEST_WAIT
+from streaming import SSE_HEADERS, batch_chunks, sse_event
+from writebehind import WriteBehindQueue
 from helpers import apology, email_check, password_check, generate_email_password_reset, send_email_password_reset
 
 # SETUP: Load .env
 load_dotenv()
 
 # SETUP: OpenAI
-# - Define variables
-openai.api_key = os.environ.get("OPENAI_API_KEY")
-openai.Model.list()
-
-# Define function for calling the API with custom prompt
-def send_prompt(prompt):
-    return openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are Cicero, an experienced travel guide who has visited the whole world. Use a professional, but friendly tone."},
-                {"role": "user", "content": f"{prompt}"}
-            ],
-            stream=True
-        )
+# - API key and endpoint are set in itineraries.py, which generates the itineraries through the
+#   provider layer (timeouts, retries, hedging and circuit breaking: see providers.py)
 
 # SETUP: Google OAuth
 # - Set variables
@@ -41,10 +50,13 @@ GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET", None)
 GOOGLE_DISCOVERY_URL = ("https://accounts.google.com/.well-known/openid-configuration")
 client = WebApplicationClient(GOOGLE_CLIENT_ID)
 
+# - Google's provider configuration, cached for the max-age Google sends
+google_discovery = DiscoveryDocument(GOOGLE_DISCOVERY_URL)
+
 # - Retrieve Google's provider configuration
 def get_google_provider_cfg():
     try:
-        return requests.get(GOOGLE_DISCOVERY_URL).json()
+        return google_discovery.get()
     except:
          return apology("google internal error", 500)
 
@@ -60,8 +72,186 @@ if __name__ == "__main__":
 login_manager = LoginManager()
 login_manager.init_app(app)
 
+# SETUP: Metrics (see metrics.py, served on /metrics)
+# - Latency of every route, until the response starts (for streams: until the first byte)
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def keep_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+# - Recorded on teardown, which runs for failed requests too: those without a response are 500s
+@app.teardown_request
+def record_request_latency(exc):
+    if "request_start" not in g:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    status = g.get("response_status", 500) if exc is None else 500
+    REQUEST_SECONDS.labels(route, request.method, status).observe(time.perf_counter() - g.request_start)
+    queue_sampler.start()
+
+# SETUP: Startup
+# - Warm-ups run in the background (see startup.py), so importing the app never waits on the network
+# - Pending schema migrations are applied at startup, unless DB_MIGRATE_ON_STARTUP is "0":
+#   requests wait for them (up to STARTUP_REQUEST_WAIT seconds), /readyz reports when they are done.
+#   A migration the data rules out fails once, with its error on /healthz, instead of being retried
+if os.environ.get("DB_MIGRATE_ON_STARTUP", "1") == "1":
+    startup.add("migrations", migrate, required=True, fatal=(MigrationError,))
+
+# - Check the OpenAI key, and fetch Google's discovery document before the first login
+startup.add("openai", lambda: openai.Model.list())
+startup.add("google_discovery", google_discovery.fetch)
+
+# Hold requests until the required startup tasks are done
+@app.before_request
+def wait_for_startup():
+    if request.endpoint in ("healthz", "readyz", "metrics", "static") or startup.ready():
+        return None
+    if not startup.wait(STARTUP_REQUEST_WAIT):
+        return apology("starting up, try again", 503)
+
+# Record the cold start time, from process start to the first response
+@app.after_request
+def record_first_byte(response):
+    startup.mark_first_byte()
+    return response
+
 # SETUP: SQLAlchemy
-db = create_engine("sqlite:///database.db")
+# - Engine, pragmas and the serialized writer are configured in database.py
+
+# Insert a generated trip, on an open connection (the travel plan is stored compressed).
+# A trip is inserted once per generation, so replayed write-behind jobs are ignored.
+# Jobs spooled before trips had interests insert them as NULL.
+def insert_trip(conn, generation, travel_plan):
+    stmt = sqlalchemy.text("INSERT OR IGNORE INTO trips (generation_id, user_id, generation_ts, destination, month, duration, interests, travel_plan) VALUES (:generation_id, :user_id, :ts, :destination, :month, :duration, :interests, :travel_plan)")
+    result = conn.execute(stmt, parameters=dict(generation, interests=generation.get("interests"), travel_plan=encode_plan(travel_plan)))
+
+    # Keep the full-text index in sync, in the same transaction
+    if result.rowcount == 1:
+        index_trip(conn, result.lastrowid, generation["user_id"], generation["destination"], travel_plan)
+
+# Generations: one row per user request attached to a flight, checkpointed while it runs
+# - status is one of "running", "done", "failed", "cancelled"
+# - Completed generations become a trip: their text is then kept (compressed) in trips only
+GENERATION_UPSERT = sqlalchemy.text("INSERT INTO generations (generation_id, flight_id, user_id, generation_ts, destination, month, duration, status, travel_plan) \
+    VALUES (:generation_id, :flight_id, :user_id, :ts, :destination, :month, :duration, :status, :travel_plan) \
+    ON CONFLICT (generation_id) DO UPDATE SET status = excluded.status, travel_plan = excluded.travel_plan")
+
+# Insert a running generation into DB, unless it already ended
+def create_generation(generation, flight):
+    stmt = sqlalchemy.text("INSERT OR IGNORE INTO generations (generation_id, flight_id, user_id, generation_ts, destination, month, duration, status, travel_plan) \
+        VALUES (:generation_id, :flight_id, :user_id, :ts, :destination, :month, :duration, 'running', :travel_plan)")
+    execute_write(stmt, dict(generation, flight_id=flight.id, travel_plan=flight.text))
+
+# Save the partial output of every generation attached to a flight, without waiting for the
+# write: return its Future (raises queue.Full when the writer is backed up)
+def checkpoint_generations(flight):
+    stmt = sqlalchemy.text("UPDATE generations SET travel_plan = :travel_plan WHERE flight_id = :flight_id AND status = 'running'")
+    parameters = {"travel_plan": flight.text, "flight_id": flight.id}
+    return writer.submit(lambda conn: conn.execute(stmt, parameters=parameters), "update", block=False)
+
+# Outcome of a flight: "done", "failed" or "cancelled"
+def flight_status(flight):
+    if flight.error is not None:
+        return "failed"
+    if flight.cancelled:
+        return "cancelled"
+    return "done"
+
+# Outcome of a flight told to its clients: its status, unless the generations couldn't be
+# stored (end_generation failed), in which case the trip isn't saved
+def stream_outcome(flight):
+    if flight.callback_error is not None:
+        return "db insert error"
+    return flight_status(flight)
+
+# Apply a batch of ended generations in one transaction: the generation row gets its
+# outcome (when there is one: cached trips have no flight), completed ones become a trip
+def apply_generations(jobs):
+    def write(conn):
+        for job in jobs:
+            if job["flight_id"] is not None:
+                travel_plan = "" if job["status"] == "done" else job["travel_plan"]
+                conn.execute(GENERATION_UPSERT, parameters=dict(job["generation"], flight_id=job["flight_id"], status=job["status"], travel_plan=travel_plan))
+            if job["status"] == "done":
+                insert_trip(conn, job["generation"], job["travel_plan"])
+
+    writer.run(write, "trip_batch")
+
+# SETUP: Write-behind queue for ended generations, drained in batches by a background thread
+trip_queue = WriteBehindQueue(apply_generations)
+
+# - Jobs left in the spool by a previous run are applied once the schema is migrated
+def start_trip_queue():
+    startup.wait(None)
+    trip_queue.start()
+
+startup.add("write_behind", start_trip_queue)
+
+# - Queue depths, sampled in the background for the metrics
+def sample_queues():
+    QUEUE_DEPTH.labels("db_writer").set(writer.depth())
+    QUEUE_DEPTH.labels("mail").set(mailer.depth())
+    depth = admission.depth()
+    QUEUE_DEPTH.labels("admission").set(depth["queued"])
+    GENERATIONS_INFLIGHT.set(depth["inflight"])
+    depth = trip_queue.depth()
+    SPOOL_DEPTH.labels("pending").set(depth["pending"])
+    SPOOL_DEPTH.labels("dead").set(depth["dead"])
+
+queue_sampler = Sampler(sample_queues)
+
+# Hand an ended generation over to the write-behind queue: durable once this returns
+def queue_generation(generation, status, travel_plan, flight_id=None):
+    trip_queue.put({"generation": generation, "flight_id": flight_id, "status": status, "travel_plan": travel_plan})
+
+# Store the outcome of a generation: completed ones also become a trip of the user
+def end_generation(generation, flight):
+    queue_generation(generation, flight_status(flight), flight.text, flight.id)
+
+# Load a generation from DB, None if it doesn't exist.
+# The text of completed generations is read from their trip
+def load_generation(generation_id):
+    stmt = sqlalchemy.text("SELECT generations.*, trips.travel_plan AS trip_plan FROM generations \
+        LEFT JOIN trips ON trips.generation_id = generations.generation_id WHERE generations.generation_id = :id")
+    with db.connect() as conn:
+        row = conn.execute(stmt, parameters={"id": generation_id}).mappings().first()
+    if row is None:
+        return None
+
+    generation = dict(row)
+    trip_plan = generation.pop("trip_plan")
+    if generation["status"] == "done" and trip_plan is not None:
+        generation["travel_plan"] = decode_plan(trip_plan)
+    return generation
+
+# SETUP: Itinerary cache
+# - Identical trips (same destination, month, duration and interests) are served from memory
+ITINERARY_CACHE_SIZE = int(os.environ.get("ITINERARY_CACHE_SIZE", 512))
+ITINERARY_CACHE_TTL = int(os.environ.get("ITINERARY_CACHE_TTL", 86400))
+itinerary_cache = TTLCache(maxsize=ITINERARY_CACHE_SIZE, ttl=ITINERARY_CACHE_TTL)
+
+# - Identical trips requested at the same time share a single upstream generation
+# - Partial output is checkpointed every STREAM_CHECKPOINT_INTERVAL seconds, so dropped clients can resume
+# - STREAM_ORPHAN_POLICY decides what happens when nobody listens for STREAM_ORPHAN_GRACE seconds:
+#   "finish" completes the trip into storage, "cancel" stops the upstream stream
+STREAM_CHECKPOINT_INTERVAL = float(os.environ.get("STREAM_CHECKPOINT_INTERVAL", 2))
+STREAM_ORPHAN_POLICY = os.environ.get("STREAM_ORPHAN_POLICY", "finish")
+STREAM_ORPHAN_GRACE = float(os.environ.get("STREAM_ORPHAN_GRACE", 30))
+itinerary_flights = FlightGroup(
+    checkpoint=checkpoint_generations,
+    checkpoint_interval=STREAM_CHECKPOINT_INTERVAL,
+    orphan_policy=STREAM_ORPHAN_POLICY,
+    orphan_grace=STREAM_ORPHAN_GRACE,
+)
+
+# - Resumed generations running in another worker are followed through their checkpoints,
+#   polled every STREAM_RESUME_POLL seconds, until STREAM_RESUME_TIMEOUT seconds pass without progress
+STREAM_RESUME_POLL = float(os.environ.get("STREAM_RESUME_POLL", 1))
+STREAM_RESUME_TIMEOUT = float(os.environ.get("STREAM_RESUME_TIMEOUT", 120))
 
 # SETUP: Mail variables
 MAIL_SERVER = os.environ.get("MAIL_SERVER")
@@ -70,12 +260,26 @@ MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
 MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
 #MAIL_RECIPIENT = os.environ.get("MAIL_RECIPIENT")
 
+# - Password reset emails need a From address (see mailer.py): report a missing one at startup
+if not MAIL_SENDER:
+    app.logger.warning("MAIL_SENDER is not set (nor MAIL_USERNAME as an email address): password reset emails are disabled")
+
 # Define signing key
 signing_key = URLSafeSerializer(os.environ.get("SECRET_KEY"))
 
 # Define timestamps format
 ts_format = "%m-%d-%Y, %H:%M:%S"
 
+# Define number of trips per history page
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", 20))
+
+# SETUP: User cache
+# - Users loaded by login_manager are kept in memory, so authenticated requests skip the DB.
+#   Entries are invalidated when a user record changes; other workers see the change within USER_CACHE_TTL
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 4096))
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 60))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
 # SETUP: Flask-Login
 # - Define User class
 class User(UserMixin):
@@ -89,6 +293,11 @@ class User(UserMixin):
     @staticmethod
     def get(user_id):
 
+        # Most authenticated requests are served from the user cache
+        user = user_cache.get(str(user_id))
+        if user is not None:
+            return user
+
         # DB search
         stmt = sqlalchemy.text("SELECT * FROM users WHERE cicero_id = :id")
         try:
@@ -103,9 +312,15 @@ class User(UserMixin):
 
         # Load user from its DB entity
         user = User(rows[0][0], rows[0][2], rows[0][3], rows[0][4])
+        user_cache.set(str(user_id), user)
 
         return user
 
+    # Drop a user from the cache after its DB record changed
+    @staticmethod
+    def invalidate(user_id):
+        user_cache.invalidate(str(user_id))
+
 # - Helper to retrieve a user from db
 @login_manager.user_loader
 def load_user(user_id):
@@ -161,14 +376,17 @@ def register():
         # Prepare variables for DB insert
         name = request.form.get("name")
         email = request.form.get("email")
-        hash = generate_password_hash(request.form.get("password"))
+
+        # Hash the password in the hashing pool
+        try:
+            hash = hasher.hash(request.form.get("password"))
+        except:
+            return apology("server busy, try again", 503)
 
         # DB insert new user
         try:
-            with db.connect() as conn:
-                stmt2 = sqlalchemy.text("INSERT INTO users (name, email, hash) VALUES (:name, :email, :hash)")
-                conn.execute(stmt2, parameters={"name": name, "email": email, "hash": hash})
-                conn.commit()
+            stmt2 = sqlalchemy.text("INSERT INTO users (name, email, hash) VALUES (:name, :email, :hash)")
+            execute_write(stmt2, {"name": name, "email": email, "hash": hash})
         except:
             return apology("db insert error", 400)
 
@@ -210,10 +428,23 @@ def login():
         if len(rows) == 1 and (not rows[0][5] or rows[0][5] == ""):
             return apology("password not set: login with google again", 403)
 
-        # Check account exists and password hash matches
-        if len(rows) != 1 or not check_password_hash(rows[0][5], request.form.get("password")):
+        # Check account exists and password hash matches (checked in the hashing pool)
+        try:
+            valid = len(rows) == 1 and hasher.verify(rows[0][5], request.form.get("password"))
+        except:
+            return apology("server busy, try again", 503)
+        if not valid:
             return apology("invalid email and/or password", 403)
 
+        # Upgrade a hash made with an old work factor, now that the password is known.
+        # Best effort: the user is logged in either way, and it's tried again on the next login
+        if hasher.needs_rehash(rows[0][5]):
+            try:
+                stmt = sqlalchemy.text("UPDATE users SET hash = :new_hash WHERE cicero_id = :id AND hash = :old_hash")
+                execute_write(stmt, {"new_hash": hasher.hash(request.form.get("password")), "id": rows[0][0], "old_hash": rows[0][5]})
+            except:
+                pass
+
         # Load account info into user object
         user = User(rows[0][0], rows[0][2], rows[0][3], rows[0][4])
 
@@ -262,7 +493,7 @@ def callback():
         redirect_url=request.base_url,
         code=code
     )
-    token_response = requests.post(
+    token_response = http.post(
         token_url,
         headers=headers,
         data=body,
@@ -275,7 +506,7 @@ def callback():
     # Find and hit the URL from Google that gives the user's profile information
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
     uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    userinfo_response = http.get(uri, headers=headers, data=body)
 
     # Confirm email is verified, then gather user information
     if userinfo_response.json().get("email_verified"):
@@ -303,12 +534,13 @@ def callback():
             # Update it
             stmt2 = sqlalchemy.text("UPDATE users SET google_id = :g_id, profile_pic = :profile_pic WHERE email = :email")
             try:
-                with db.connect() as conn:
-                    conn.execute(stmt2, parameters={"g_id": unique_id, "profile_pic": picture, "email": users_email})
-                    conn.commit()
+                execute_write(stmt2, {"g_id": unique_id, "profile_pic": picture, "email": users_email})
             except:
                 return apology("db access error", 400)
 
+            # Drop the stale user from the cache
+            User.invalidate(rows[0][0])
+
 
 
         # Load account info into user object
@@ -319,10 +551,8 @@ def callback():
         
         # Insert into DB
         try:
-            with db.connect() as conn:
-                stmt3 = sqlalchemy.text("INSERT INTO users (google_id, name, email, profile_pic) VALUES (:id, :name, :email, :profile_pic)")
-                conn.execute(stmt3, parameters={"id": unique_id, "name": users_name, "email": users_email, "profile_pic": picture})
-                conn.commit()
+            stmt3 = sqlalchemy.text("INSERT INTO users (google_id, name, email, profile_pic) VALUES (:id, :name, :email, :profile_pic)")
+            execute_write(stmt3, {"id": unique_id, "name": users_name, "email": users_email, "profile_pic": picture})
         except:
             return apology("db insert error", 400)
         
@@ -381,11 +611,12 @@ def change_name():
     # Update DB record
     stmt = sqlalchemy.text("UPDATE users SET name = :new_name WHERE cicero_id = :id;")
     try:
-        with db.connect() as conn:
-            conn.execute(stmt, parameters={"new_name": user_name, "id": user_id})
-            conn.commit()
+        execute_write(stmt, {"new_name": user_name, "id": user_id})
     except:
         return apology("db access error", 400)
+
+    # Drop the stale user from the cache
+    User.invalidate(user_id)
     
     # Redirect to account page
     return redirect(url_for("account"))
@@ -413,7 +644,11 @@ def change_password():
     except:
         return apology("db access error", 400)
 
-    if len(rows) != 1 or not check_password_hash(rows[0][5], old_pass):
+    try:
+        valid = len(rows) == 1 and hasher.verify(rows[0][5], old_pass)
+    except:
+        return apology("server busy, try again", 503)
+    if not valid:
         return apology("invalid password", 403)
     
     # Ensure new password was submitted and is confirmed
@@ -430,17 +665,21 @@ def change_password():
         return apology("password needs min 10 characters, 1 digit, 1 symbol, 1 lower and 1 uppercase letter", 403)
 
     # Hash new password
-    hash = generate_password_hash(new_pass_1)
+    try:
+        hash = hasher.hash(new_pass_1)
+    except:
+        return apology("server busy, try again", 503)
 
     # Update DB record
     stmt2 = sqlalchemy.text("UPDATE users SET hash = :new_hash WHERE cicero_id = :id;")
     try:
-        with db.connect() as conn:
-            conn.execute(stmt2, parameters={"new_hash": hash, "id": user_id})
-            conn.commit()
+        execute_write(stmt2, {"new_hash": hash, "id": user_id})
     except:
         return apology("db access error", 400)
 
+    # Drop the stale user from the cache
+    User.invalidate(user_id)
+
     # Redirect to account page
     return redirect(url_for("account"))
 
@@ -449,11 +688,6 @@ def change_password():
 @login_required
 def generate():
     
-    # Set lists for input page
-    INTERESTS = ["History, Culture and Arts", "Outdoor and Nature", "Food and Dining", "Shopping", "Entertainment and Nightlife", "Sports and Adventure", "Religious and Spiritual Interests", "Family-Friendly Activities", "Wellness and Relaxation"]
-    MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
-    DURATION = ["A weekend", "One week", "Two weeks", "Three weeks", "Four weeks"]
-
     # User reached route via POST (as by submitting a form via POST)
     if request.method == "POST":
 
@@ -464,7 +698,7 @@ def generate():
         interests = request.form.getlist("interests")
         
         # Input validation
-        if not destination:
+        if not destination or not destination.strip():
             return apology("you must input a destination", 403)
         
         if month not in MONTHS:
@@ -476,39 +710,26 @@ def generate():
         if not interests:
             return apology("you must select at least one interest", 403)
         
-        # Validate interests input and combine in a single string
-        interests_list = ""
+        # Validate interests input
         for i in interests:
             if i not in INTERESTS:
                 return apology("do not mess with the code please", 403)    
-            interests_list += i + ", "
-        interests_list = interests_list.rstrip(", ")
-
-        # Prompt generation      
-        PROMPT = f"Please provide me with personalized advice for my next holiday to {destination}.\
-            I will be there in {month} for {duration}.\
-            My interests are: {interests}.\
-            The advice should be structured as follows:\
-            1. A first paragraph with general advice regarding {destination}, must-view places and hidden gems.\
-            2. One paragraph for each of the interests I've expressed, with each destination on a seperate bullet point, for example:\
-            Shopping, brief introduction about shopping in {destination}.\
-            - relevant shopping place #1, description;\
-            - relevant shopping place #2, description;\
-            - etc..\
-            3. A final paragraph with a proposed schedule for my trip, which must be relevant to my interests.\
-            All of the above should also be relevant to the moment of the year I'm visiting.\
-            For example you would suggest attending the cherry trees blossom if I were to go to Tokio at the end of March.\
-            Please output your response with HTML formatting, for example: the paragraph headers should be in H5, \
-            you also should account for new lines.\
-            Also, make sure to give your warm regards at the end."
-
-        # Load stream page with necessary variables
+
+        # Prompt generation (see prompts.py), within the token budget
+        trip = canonical_trip(destination, month, duration, interests)
+        try:
+            prompt = build_prompt(trip)
+        except PromptTooLong:
+            return apology("destination is too long", 403)
+
+        # Load stream page with a signed reference to the trip: the prompt itself stays on the server.
+        # A destination matched by a guess is kept as typed, and the page offers the guess instead
         return render_template(
             "stream.html", 
-            your_prompt=PROMPT, 
-            your_destination=destination,
-            your_month=month,
-            your_duration=duration,
+            your_destination=trip["destination"],
+            your_trip=signing_key.dumps({"trip": trip, "prompt": prompt.id}),
+            trip=trip,
+            suggestion=trip["canonical"] if trip["canonical"] != trip["destination"] else None,
             )
     
     # User reached route via GET (as by clicking a link or via redirect)
@@ -516,60 +737,214 @@ def generate():
         # Load generate page with data for the form
         return render_template("/generate.html", interests=INTERESTS, months=MONTHS, duration=DURATION)
 
+# Extract the trip variables from the body of a /stream request, None if its trip reference is not valid
+def stream_parameters(data):
+
+    # Load the trip signed by /generate, and rebuild its prompt
+    try:
+        reference = signing_key.loads((data or {}).get("trip", ""))
+        trip = reference["trip"]
+        prompt = build_prompt(trip, reference["prompt"])
+    except (AttributeError, BadSignature, KeyError, TypeError, PromptTooLong):
+        return None
+
+    return {
+        "prompt": prompt,
+        "trip": trip,
+        "destination": trip["destination"],
+        "month": trip["month"],
+        "duration": trip["duration"],
+        # Key used to share itineraries between identical trips, from the same prompt template.
+        # Built from the signed trip the prompt is rendered from: a destination matched by a
+        # guess is another trip until the user confirms the guess
+        "cache_key": itinerary_key(trip["destination"], trip["month"], trip["duration"], trip["interests"], prompt.id),
+    }
+
+# Itinerary of a trip generated ahead by pregenerate.py, None if there is none.
+# Found itineraries join the itinerary cache; a DB error is a miss, and the trip is generated
+def pregenerated_itinerary(params):
+    try:
+        full_output = load_pregenerated(db, params["trip"], params["prompt"].id)
+    except:
+        return None
+    if full_output is not None:
+        itinerary_cache.set(params["cache_key"], full_output)
+    return full_output
+
+# Follow the checkpoints of a generation that isn't running in this worker
+def poll_generation(generation_id, position=0):
+    last_progress = time.monotonic()
+    while True:
+        generation = load_generation(generation_id)
+
+        # Yield the text checkpointed since the last poll
+        text = generation["travel_plan"][position:]
+        if text:
+            yield text
+            position += len(text)
+            last_progress = time.monotonic()
+
+        # Stop once the generation ended, or looks abandoned by a dead worker
+        if generation["status"] != "running" or time.monotonic() - last_progress > STREAM_RESUME_TIMEOUT:
+            return
+        time.sleep(STREAM_RESUME_POLL)
+
+# Stream itinerary text as SSE events, then the outcome of the generation
+# - event ids are the character offset reached, for resuming with Last-Event-ID
+# - outcome() tells how the generation ended, once its text is all sent
+# - ticket, while the generation waits for an upstream slot, sends the client its place in the queue
+def event_stream(chunks, generation_id=None, position=0, outcome=None, ticket=None):
+
+    # Tell the client which generation to resume if the connection drops
+    if generation_id is not None:
+        yield sse_event(generation_id, event="generation")
+
+    if ticket is not None:
+        for place in ticket.positions():
+            yield sse_event(str(place), event="queued")
+
+    # Send text as batched deltas
+    offset = position
+    try:
+        for text in batch_chunks(chunks):
+            offset += len(text)
+            yield sse_event(text, id=offset)
+    except (AdmissionRejected, ProviderError) as e:
+        yield sse_event(str(e), event="error")
+        return
+    except Exception:
+        yield sse_event("generation error", event="error")
+        return
+
+    # Tell the client whether the trip is complete and saved (queued for the DB, durably)
+    status = "done"
+    if outcome is not None:
+        try:
+            status = outcome()
+        except:
+            status = "db access error"
+
+    if status == "done":
+        yield sse_event("", event="done")
+    else:
+        yield sse_event(status, event="error")
+
 # Stream function for the GPT API
 @app.route("/stream", methods=["POST"])
 @login_required
 def stream():
 
-    # Extract body content from the POST fetch request
-    data = request.get_json()
-
-    # Extract variables from body
-    prompt = data.get("prompt")
-    destination = data.get("destination")
-    month = data.get("month")
-    duration = data.get("duration")   
+    # Extract variables from the POST fetch request
+    params = stream_parameters(request.get_json(silent=True))
+    if params is None:
+        return apology("page expired, generate your trip again", 400)
+    cache_key = params["cache_key"]
 
     # Prepare other variables for DB insert
-    user_id = current_user.get_id()
-    timestamp = datetime.utcnow().strftime(ts_format)
-
-    # Define the stream function
-    def event_stream():
-
-        # Init a list for all the collected text
-        collected_text = []
+    generation = {
+        "generation_id": uuid.uuid4().hex,
+        "user_id": current_user.get_id(),
+        "ts": datetime.utcnow().strftime(ts_format),
+        "destination": params["destination"],
+        "month": params["month"],
+        "duration": params["duration"],
+        "interests": json.dumps(params["trip"]["interests"]),
+    }
+
+    # If the same trip was generated recently, or ahead by pregenerate.py, save and replay it without calling the API
+    full_output = itinerary_cache.get(cache_key)
+    if full_output is None:
+        full_output = pregenerated_itinerary(params)
+    if full_output is not None:
+        try:
+            queue_generation(generation, "done", full_output)
+        except Exception:
+            return apology("db insert error", 400)
 
-        # For every partial API response
-        for line in send_prompt(prompt):
+        return Response(observe_stream(event_stream([full_output]), "/stream"), mimetype="text/event-stream", headers=SSE_HEADERS)
 
-            # Extract text
-            bad_text = line.choices[0].delta.get("content", "")
+    # Take a generation from the user's quota: one token per upstream request (see admission.py)
+    units = params["prompt"].requests
+    try:
+        admission.charge(generation["user_id"], units)
+    except RateLimited as e:
+        headers = dict(SSE_HEADERS)
+        if e.retry_after is not None:
+            headers["Retry-After"] = str(math.ceil(e.retry_after))
+        return Response(sse_event(str(e), event="error"), status=429, mimetype="text/event-stream", headers=headers)
+
+    # Store completed generations for identical trips
+    def store_itinerary(full_output):
+        if full_output:
+            itinerary_cache.set(cache_key, full_output)
+
+    # Attach to the generation of this trip, starting it if nobody else is running it.
+    # A new generation waits for an upstream slot (see admission.py) before calling the API.
+    # The trip is saved when the flight ends, whether or not this client is still connected.
+    # The generation is recorded, so it can be resumed, before a new flight starts: if that fails,
+    # the request is detached from the flight and gets its tokens back.
+    ticket = admission.ticket(generation["user_id"], units)
+    try:
+        flight = itinerary_flights.join(
+            cache_key,
+            lambda: admission.admitted(ticket, lambda: observe_generation(generate_itinerary(params["prompt"]), "/stream")),
+            on_complete=store_itinerary,
+            on_done=lambda flight: end_generation(generation, flight),
+            ticket=ticket,
+            on_join=lambda flight: create_generation(generation, flight),
+        )
+    except Exception:
+        admission.refund(generation["user_id"], units)
+        return apology("db insert error", 400)
+
+    # Joining a generation that is already running costs nothing upstream: give the token back
+    if flight.ticket is not ticket:
+        admission.refund(generation["user_id"], units)
+
+    # Stream API response into current page: chunks already generated come first, then the live tail
+    return Response(
+        observe_stream(event_stream(flight.subscribe(), generation["generation_id"], outcome=lambda: stream_outcome(flight), ticket=flight.ticket), "/stream"),
+        mimetype="text/event-stream",
+        headers=SSE_HEADERS,
+    )
 
-            # Convert text into HTML friendly
-            text = bad_text.replace("\n", '<br>')
+# Resume a generation after a dropped connection, from the Last-Event-ID offset
+@app.route("/stream/<generation_id>")
+@login_required
+def stream_resume(generation_id):
 
-            # Append to list of collected text
-            collected_text.append(text)
+    # Load generation from DB
+    try:
+        generation = load_generation(generation_id)
+    except:
+        return apology("db access error", 400)
 
-            # If text is not empty > yield
-            if len(text):
-                yield text
+    # Users can only resume their own generations
+    if generation is None or str(generation["user_id"]) != current_user.get_id():
+        return apology("generation not found", 404)
 
-        # Collect full API response in a single string
-        full_output = ''.join(collected_text)
+    # Offset reached by the client before the connection dropped
+    try:
+        position = int(request.headers.get("Last-Event-ID") or request.args.get("offset") or 0)
+    except ValueError:
+        return apology("invalid offset", 400)
+
+    # Follow the flight live if it runs in this worker, its checkpoints otherwise
+    flight = itinerary_flights.get(generation["flight_id"])
+    ticket = None
+    if flight is not None:
+        chunks = flight.subscribe(position)
+        outcome = lambda: stream_outcome(flight)
+        ticket = flight.ticket
+    else:
+        chunks = poll_generation(generation_id, position)
+        outcome = lambda: load_generation(generation_id)["status"]
 
-        # Insert trip into DB
-        try:
-            with db.connect() as conn:
-                stmt = sqlalchemy.text("INSERT INTO trips (user_id, generation_ts, destination, month, duration, travel_plan) VALUES (:id, :ts, :destination, :month, :duration, :travel_plan)")
-                conn.execute(stmt, parameters={"id": user_id, "ts": timestamp, "destination": destination, "month": month, "duration": duration, "travel_plan": full_output})
-                conn.commit()
-        except:
-            return apology("db insert error", 400)
-        
-    # Stream API response into current page
-    return Response(event_stream(), mimetype="text/event-stream")
+    return Response(
+        observe_stream(event_stream(chunks, generation_id, position, outcome, ticket), "/stream/<generation_id>"),
+        mimetype="text/event-stream",
+        headers=SSE_HEADERS,
+    )
 
 # View previously generated trips
 @app.route("/history", methods=["GET", "POST"])
@@ -579,12 +954,12 @@ def history():
     # User clicked on "View trip" button
     if request.method == "POST":
 
-        # Load trip from DB
-        stmt2 = sqlalchemy.text("SELECT * FROM trips WHERE trip_id = :id")
+        # Load trip from DB: the only place where the full travel plan is read
+        stmt2 = sqlalchemy.text("SELECT destination, travel_plan FROM trips WHERE trip_id = :id AND user_id = :user_id")
         trip_id = request.form.get("trip_id")
         try:
             with db.connect() as conn:
-                ROWS = conn.execute(stmt2, parameters={"id": trip_id}).fetchall()
+                ROWS = conn.execute(stmt2, parameters={"id": trip_id, "user_id": current_user.get_id()}).fetchall()
         except:
             return apology("db access error", 400)
         
@@ -593,8 +968,8 @@ def history():
             return apology("db internal error", 400)
         
         # Setup variables for output page
-        destination = ROWS[0][3]
-        OUTPUT = ROWS[0][6]
+        destination = ROWS[0][0]
+        OUTPUT = decode_plan(ROWS[0][1])
 
         # Load output page to display selected trip
         return render_template("output.html", your_destination=destination, output=OUTPUT)
@@ -602,17 +977,67 @@ def history():
     # User reached route via GET (as by clicking a link or via redirect) 
     else:
 
-        # Query DB for current user's trips
-        stmt2 = sqlalchemy.text("SELECT * FROM trips WHERE user_id = :id ORDER BY trip_id DESC")
+        # Cursor: only trips older than this trip_id (keyset pagination)
+        before = request.args.get("before", type=int)
+
+        # Query DB for one page of current user's trips, summary columns only.
+        # One extra row tells whether there is an older page.
+        if before is None:
+            stmt2 = sqlalchemy.text("SELECT trip_id, generation_ts, destination, month, duration FROM trips WHERE user_id = :id ORDER BY trip_id DESC LIMIT :limit")
+        else:
+            stmt2 = sqlalchemy.text("SELECT trip_id, generation_ts, destination, month, duration FROM trips WHERE user_id = :id AND trip_id < :before ORDER BY trip_id DESC LIMIT :limit")
         id = current_user.get_id()
         try:
             with db.connect() as conn:
-                TRIPS = conn.execute(stmt2, parameters={"id": id}).fetchall()
+                TRIPS = conn.execute(stmt2, parameters={"id": id, "before": before, "limit": HISTORY_PAGE_SIZE + 1}).fetchall()
         except:
             return apology("db access error", 400)
 
-        # Return history page with list of trips (dicts)
-        return render_template("/history.html", trips=TRIPS)
+        # Cursor of the next (older) page, if any
+        next_before = None
+        if len(TRIPS) > HISTORY_PAGE_SIZE:
+            TRIPS = TRIPS[:HISTORY_PAGE_SIZE]
+            next_before = TRIPS[-1][0]
+
+        # Return history page with one page of trips (dicts)
+        return render_template("/history.html", trips=TRIPS, next_before=next_before, paginated=before is not None)
+
+# Search the current user's trips
+@app.route("/search")
+@login_required
+def search():
+
+    # Extract the query from the URL
+    query = request.args.get("q", "").strip()
+    if not query:
+        return redirect(url_for("history"))
+
+    # Ranked matches, with highlighted snippets
+    try:
+        with db.connect() as conn:
+            RESULTS = search_trips(conn, current_user.get_id(), query)
+    except:
+        return apology("db access error", 400)
+
+    # Return search page with the list of matching trips (dicts)
+    return render_template("/search.html", query=query, results=RESULTS)
+
+# Liveness probe: the process serves requests; reports startup tasks and cold start time
+@app.route("/healthz")
+def healthz():
+    return jsonify(startup.status())
+
+# Readiness probe: 503 until the required startup tasks are done
+@app.route("/readyz")
+def readyz():
+    status = startup.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+# Prometheus metrics, aggregated across workers
+@app.route("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
 
 # Simple FAQ page
 @app.route("/faq")
@@ -661,6 +1086,10 @@ def send_password_reset():
     except:
         return apology("db access error", 400)
     
+    # Password reset emails can't be sent without a From address
+    if not MAIL_SENDER:
+        return apology("password reset by email is not configured", 500)
+
     # If the email matches with one account
     if len(rows) == 1:
 
@@ -676,15 +1105,18 @@ def send_password_reset():
 
         # DB insert new password_reset row
         try:
-            with db.connect() as conn:
-                stmt1 = sqlalchemy.text("INSERT INTO password_resets (user_id, expiration_ts, secret_key) VALUES (:user_id, :expiration_ts, :secret_key)")
-                conn.execute(stmt1, parameters={"user_id": USER_ID, "expiration_ts": EXPIRATION_TS, "secret_key": RESET_STRING})
-                conn.commit()
+            stmt1 = sqlalchemy.text("INSERT INTO password_resets (user_id, expiration_ts, secret_key) VALUES (:user_id, :expiration_ts, :secret_key)")
+            execute_write(stmt1, {"user_id": USER_ID, "expiration_ts": EXPIRATION_TS, "secret_key": RESET_STRING})
         except:            
             return apology("db insert error", 400)
 
-        # Send the password reset email
-        send_email_password_reset(MAIL_RECIPIENT, RESET_STRING)
+        # Queue the password reset email, the mailer sends it in the background
+        try:
+            send_email_password_reset(MAIL_RECIPIENT, RESET_STRING)
+        except queue.Full:
+            return apology("mail queue full", 503)
+        except:
+            return apology("mail error", 500)
 
     return render_template("/password_reset_sent.html")
 
@@ -718,9 +1150,7 @@ def password_reset_callback(reset_string):
     # Delete used row from DB
     stmt2 = sqlalchemy.text("DELETE FROM password_resets WHERE secret_key = :secret_key")
     try:
-        with db.connect() as conn:
-            rows = conn.execute(stmt2, parameters={"secret_key": reset_string})
-            conn.commit()
+        execute_write(stmt2, {"secret_key": reset_string})
     except:
         return apology("db access error", 400)
 
@@ -745,17 +1175,21 @@ def password_reset_execution():
         return apology("password needs min 10 characters, 1 digit, 1 symbol, 1 lower and 1 uppercase letter", 403)
 
     # Hash new password
-    hash = generate_password_hash(new_pass_1)
+    try:
+        hash = hasher.hash(new_pass_1)
+    except:
+        return apology("server busy, try again", 503)
 
     # Update DB record with new password
     stmt = sqlalchemy.text("UPDATE users SET hash = :new_hash WHERE cicero_id = :id;")
     try:
-        with db.connect() as conn:
-            conn.execute(stmt, parameters={"new_hash": hash, "id": USER_ID})
-            conn.commit()
+        execute_write(stmt, {"new_hash": hash, "id": USER_ID})
     except:
         return apology("db access error", 400)
 
+    # Drop the stale user from the cache
+    User.invalidate(USER_ID)
+
     # Redirect to login page
     return redirect(url_for("login"))
     
@@ -0,0 +1,279 @@
+import asyncio
+import contextvars
+import json
+import math
+import time
+import uuid
+
+from asgiref.wsgi import WsgiToAsgi
+from datetime import datetime
+from flask import request
+from flask_login import current_user
+from werkzeug.test import EnvironBuilder
+
+from app import (
+    app, agenerate_itinerary, checkpoint_generations, create_generation, end_generation,
+    itinerary_cache, pregenerated_itinerary, queue_generation, stream_outcome, stream_parameters, ts_format,
+    STREAM_CHECKPOINT_INTERVAL, STREAM_ORPHAN_GRACE, STREAM_ORPHAN_POLICY,
+)
+from admission import AdmissionRejected, RateLimited, admission
+from metrics import REQUEST_SECONDS, STREAM_BYTES, STREAM_DISCONNECTS, aobserve_generation
+from providers import ProviderError
+from singleflight import AsyncFlightGroup
+from startup import startup, STARTUP_REQUEST_WAIT
+from streaming import SSE_HEADERS, abatch_chunks, sse_event
+
+# ASGI serving mode: /stream runs on the event loop, so an open itinerary stream
+# costs a coroutine instead of a whole worker. Every other route is the
+# unchanged Flask app, run in asgiref's thread pool. That includes GET /stream/<id>,
+# which resumes generations of this engine through their DB checkpoints.
+# Run with: uvicorn asgi:application --workers 4
+
+# SETUP: Flask app wrapped as an ASGI app
+flask_app = WsgiToAsgi(app)
+
+# SETUP: Identical trips requested at the same time share a single upstream generation
+itinerary_flights = AsyncFlightGroup(
+    checkpoint=checkpoint_generations,
+    checkpoint_interval=STREAM_CHECKPOINT_INTERVAL,
+    orphan_policy=STREAM_ORPHAN_POLICY,
+    orphan_grace=STREAM_ORPHAN_GRACE,
+)
+
+
+# Read the whole body of an ASGI HTTP request
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+# Resolve the logged in user and the trip variables, the same way the Flask route does
+def authenticate_stream(scope, body):
+
+    # Build a WSGI environ so Flask-Login can read the session cookie
+    environ = EnvironBuilder(
+        path=scope["path"],
+        method=scope["method"],
+        headers=[(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]],
+        data=body,
+    ).get_environ()
+
+    with app.request_context(environ):
+        if not current_user.is_authenticated:
+            return None, None
+        return current_user.get_id(), stream_parameters(request.get_json(silent=True))
+
+# Send a plain text response
+async def send_text(send, status, text):
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"text/plain")]})
+    await send({"type": "http.response.body", "body": text.encode()})
+
+# Response headers of an SSE stream, with extra (name, value) pairs
+def sse_headers(*extra):
+    headers = [(b"content-type", b"text/event-stream")]
+    headers += [(k.lower().encode(), v.encode()) for k, v in SSE_HEADERS.items()]
+    return headers + [(k.encode(), v.encode()) for k, v in extra]
+
+# Send one SSE event, keeping the response open
+async def send_event(send, event):
+    await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+
+# Async iterator over an already complete itinerary
+async def replay(full_output):
+    yield full_output
+
+# Async version of the /stream route
+async def stream(scope, receive, send):
+
+    # Wait for the required startup tasks, like the Flask routes
+    if not startup.ready() and not await asyncio.to_thread(startup.wait, STARTUP_REQUEST_WAIT):
+        return await send_text(send, 503, "starting up, try again")
+    startup.mark_first_byte()
+
+    # Session lookup touches the DB: keep it off the event loop
+    body = await read_body(receive)
+    user_id, params = await asyncio.to_thread(authenticate_stream, scope, body)
+    if user_id is None:
+        return await send_text(send, 401, "unauthorized")
+    if params is None:
+        return await send_text(send, 400, "page expired, generate your trip again")
+
+    cache_key = params["cache_key"]
+
+    # Prepare other variables for DB insert
+    generation = {
+        "generation_id": uuid.uuid4().hex,
+        "user_id": user_id,
+        "ts": datetime.utcnow().strftime(ts_format),
+        "destination": params["destination"],
+        "month": params["month"],
+        "duration": params["duration"],
+        "interests": json.dumps(params["trip"]["interests"]),
+    }
+
+    # If the same trip was generated recently, or ahead by pregenerate.py, save and replay it without calling the API
+    full_output = itinerary_cache.get(cache_key)
+    if full_output is None:
+        full_output = await asyncio.to_thread(pregenerated_itinerary, params)
+    if full_output is not None:
+        try:
+            await asyncio.to_thread(queue_generation, generation, "done", full_output)
+        except Exception:
+            return await send_text(send, 400, "db insert error")
+        return await send_stream(send, receive, replay(full_output))
+
+    # Take a generation from the user's quota: one token per upstream request (see admission.py)
+    units = params["prompt"].requests
+    try:
+        admission.charge(user_id, units)
+    except RateLimited as e:
+        retry_after = [] if e.retry_after is None else [("retry-after", str(math.ceil(e.retry_after)))]
+        await send({"type": "http.response.start", "status": 429, "headers": sse_headers(*retry_after)})
+        return await send({"type": "http.response.body", "body": sse_event(str(e), event="error").encode()})
+
+    # Store completed generations for identical trips
+    def store_itinerary(full_output):
+        if full_output:
+            itinerary_cache.set(cache_key, full_output)
+
+    # Attach to the generation of this trip, starting it if nobody else is running it.
+    # A new generation waits for an upstream slot (see admission.py) before calling the API.
+    # The trip is saved when the flight ends, whether or not this client is still connected.
+    # The generation is recorded, so it can be resumed, before a new flight starts: if that fails,
+    # the request is detached from the flight and gets its tokens back.
+    ticket = admission.ticket(user_id, units)
+    try:
+        flight = await itinerary_flights.join(
+            cache_key,
+            lambda: admission.aadmitted(ticket, lambda: aobserve_generation(agenerate_itinerary(params["prompt"]), "/stream")),
+            on_complete=store_itinerary,
+            on_done=lambda flight: end_generation(generation, flight),
+            ticket=ticket,
+            on_join=lambda flight: asyncio.to_thread(create_generation, generation, flight),
+        )
+    except Exception:
+        admission.refund(user_id, units)
+        return await send_text(send, 400, "db insert error")
+
+    # Joining a generation that is already running costs nothing upstream: give the token back
+    if flight.ticket is not ticket:
+        admission.refund(user_id, units)
+
+    await send_stream(send, receive, flight.subscribe(), generation["generation_id"], outcome=lambda: stream_outcome(flight), ticket=flight.ticket)
+
+# Return once the client disconnects
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+# Send itinerary text as SSE events, then the outcome of the generation.
+# The client's disconnect is watched for while sending: uvicorn's send() doesn't fail once the
+# client is gone, so without it a dropped client would never leave the flight (see orphan_policy)
+async def send_stream(send, receive, chunks, generation_id=None, outcome=None, ticket=None):
+    await send({"type": "http.response.start", "status": 200, "headers": sse_headers()})
+
+    # Count the bytes sent, for the metrics
+    sent = 0
+    async def send_counted(message):
+        nonlocal sent
+        sent += len(message.get("body", b""))
+        await send(message)
+
+    sender = asyncio.ensure_future(send_events(send_counted, chunks, generation_id, outcome, ticket))
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        done, pending = await asyncio.wait({sender, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if sender in done:
+            return sender.result()
+
+        # Client gone before the end
+        STREAM_DISCONNECTS.labels("/stream").inc()
+    except BaseException:
+        # Send failed, or server shutting down, before the end
+        STREAM_DISCONNECTS.labels("/stream").inc()
+        raise
+    finally:
+        for task in (sender, watcher):
+            task.cancel()
+        await asyncio.gather(sender, watcher, return_exceptions=True)
+        STREAM_BYTES.labels("/stream").observe(sent)
+
+        # Detach from the flight right away, even if the client went away
+        await chunks.aclose()
+        await send({"type": "http.response.body", "body": b""})
+
+# Send the SSE events of a stream: generation id, places in the queue, text, outcome
+async def send_events(send, chunks, generation_id=None, outcome=None, ticket=None):
+
+    # Tell the client which generation to resume if the connection drops
+    if generation_id is not None:
+        await send_event(send, sse_event(generation_id, event="generation"))
+
+    # While the generation waits for an upstream slot, send the client its place in the queue
+    if ticket is not None:
+        async for place in ticket.apositions():
+            await send_event(send, sse_event(str(place), event="queued"))
+
+    # Send text as batched deltas, with the offset reached as event id
+    offset = 0
+    try:
+        async for text in abatch_chunks(chunks):
+            offset += len(text)
+            await send_event(send, sse_event(text, id=offset))
+    except (AdmissionRejected, ProviderError) as e:
+        return await send_event(send, sse_event(str(e), event="error"))
+    except Exception:
+        return await send_event(send, sse_event("generation error", event="error"))
+
+    # Tell the client whether the trip is complete and saved (queued for the DB, durably)
+    status = outcome() if outcome is not None else "done"
+
+    if status == "done":
+        await send_event(send, sse_event("", event="done"))
+    else:
+        await send_event(send, sse_event(status, event="error"))
+
+# Answer the ASGI lifespan protocol, Flask has no startup or shutdown hooks
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+# Run an ASGI route, recording its latency like the Flask routes: until the response starts,
+# or until it failed (a 500) if it never started
+async def timed(route, rule, scope, receive, send):
+    start = time.perf_counter()
+    started = False
+
+    async def send_timed(message):
+        nonlocal started
+        if message["type"] == "http.response.start":
+            started = True
+            REQUEST_SECONDS.labels(rule, scope["method"], message["status"]).observe(time.perf_counter() - start)
+        await send(message)
+
+    try:
+        return await route(scope, receive, send_timed)
+    finally:
+        if not started:
+            REQUEST_SECONDS.labels(rule, scope["method"], 500).observe(time.perf_counter() - start)
+
+# ASGI entry point: route /stream to the async engine, everything else to Flask
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    if scope["type"] == "http" and scope["path"] == "/stream" and scope["method"] == "POST":
+        return await timed(stream, "/stream", scope, receive, send)
+
+    # Flask routes run in a task with a fresh context. uvicorn resumes reading a keep-alive connection
+    # from inside the request task, so the next request on it inherits that task's context vars,
+    # asgiref's included: it then refuses to run it ("CurrentThreadExecutor already quit or is broken")
+    return await contextvars.Context().run(asyncio.ensure_future, flask_app(scope, receive, send))
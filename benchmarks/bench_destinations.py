@@ -0,0 +1,90 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import TTLCache, itinerary_key
+from destinations import Gazetteer
+
+# Itinerary cache hit rate with destinations as typed vs canonicalized, on synthetic traffic:
+# --requests trips to the --places most popular destinations (Zipf-like), each typed as one of
+# its variants: other case or spacing, an alias, ", Country", or a one-letter typo.
+# Also times the lookups, first (uncached) and repeated.
+#   python benchmarks/bench_destinations.py --requests 20000 --places 100
+
+MONTHS = ["March", "July"]
+DURATIONS = ["A weekend", "One week"]
+INTERESTS = [["Food and Dining"], ["History, Culture and Arts"]]
+
+
+# A variant of a place name, as a user might type it
+def variant(rng, name, country, aliases):
+    kind = rng.random()
+    if kind < 0.4:
+        return name
+    if kind < 0.55:
+        return rng.choice([name.lower(), name.upper(), f" {name}  "])
+    if kind < 0.7 and aliases:
+        return rng.choice(aliases)
+    if kind < 0.85 and country != name:
+        return f"{name}, {country}"
+    letters = list(name)
+    index = rng.randrange(len(letters))
+    letters[index] = letters[index] * 2
+    return "".join(letters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Itinerary cache hit rate, raw vs canonical destinations")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--places", type=int, default=100, help="distinct destinations requested")
+    parser.add_argument("--cache-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    gazetteer = Gazetteer()
+    rng = random.Random(1)
+
+    # Places from the gazetteer file, with their aliases
+    places = {}
+    for destination in gazetteer.aliases.values():
+        places[destination.name] = (destination.name, destination.country, [])
+    for alias, destination in gazetteer.aliases.items():
+        if alias != destination.name.casefold():
+            places[destination.name][2].append(alias)
+    places = rng.sample(sorted(places.values()), min(args.places, len(places)))
+    weights = [1 / (rank + 1) for rank in range(len(places))]
+
+    requests = []
+    for i in range(args.requests):
+        name, country, aliases = rng.choices(places, weights)[0]
+        requests.append((variant(rng, name, country, aliases), rng.choice(MONTHS), rng.choice(DURATIONS), rng.choice(INTERESTS)))
+
+    print(f"{'':<14}{'hit rate':>10}{'distinct keys':>15}")
+    for label, canonical in [("as typed", lambda text: " ".join(text.split())), ("canonical", lambda text: gazetteer.canonical(text))]:
+        cache = TTLCache(maxsize=args.cache_size, ttl=3600)
+        hits = 0
+        keys = set()
+        for destination, month, duration, interests in requests:
+            key = itinerary_key(canonical(destination), month, duration, interests)
+            keys.add(key)
+            if cache.get(key) is not None:
+                hits += 1
+            else:
+                cache.set(key, True)
+        print(f"{label:<14}{hits / len(requests):>10.1%}{len(keys):>15}")
+
+    # Lookup cost over the same traffic: starting from an empty lookup cache, then again with it warm
+    texts = [request[0] for request in requests]
+    gazetteer = Gazetteer()
+    for label in ["cold cache", "warm cache"]:
+        start = time.perf_counter()
+        for text in texts:
+            gazetteer.canonical(text)
+        print(f"{label:<14}{(time.perf_counter() - start) / len(texts) * 1e6:>10.1f} us per lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import email
+import os
+import sys
+import time
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from string import Template
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from emails import EMAIL_TEMPLATES_DIR, render_email
+
+# Benchmark of password reset email rendering: messages per second when the template and
+# MIME message are built on every call (as before), and with the precompiled template:
+#   python benchmarks/bench_email.py --messages 20000
+
+SENDER = "noreply@cicerotravel.com"
+LINK = "https://cicerotravel.com/password_reset/callback/"
+
+
+# Build the message from scratch, like generate_email_password_reset() used to
+def render_per_call(html, recipient, link):
+    message = MIMEMultipart()
+    message['From'] = SENDER
+    message['To'] = recipient
+    message['Subject'] = "Cicero - Password Reset"
+    message.attach(MIMEText(Template(html).substitute(LINK=link), "html"))
+    return message.as_string()
+
+def render_compiled(html, recipient, link):
+    return render_email("password_reset", SENDER, recipient, LINK=link)
+
+# Messages rendered per second
+def measure(render, html, messages):
+    start = time.perf_counter()
+    for i in range(messages):
+        render(html, f"user{i}@example.com", LINK + f"token{i}")
+    return messages / (time.perf_counter() - start)
+
+# Both renderers must produce the same headers and body
+def check(html):
+    expected = email.message_from_string(render_per_call(html, "user@example.com", LINK + "token"))
+    actual = email.message_from_string(render_compiled(html, "user@example.com", LINK + "token"))
+    assert expected.items()[1:] == actual.items()[1:], "headers differ"
+    assert [part.get_payload() for part in expected.walk()][1:] == [part.get_payload() for part in actual.walk()][1:], "bodies differ"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Password reset email rendering throughput")
+    parser.add_argument("--messages", type=int, default=20000, help="messages rendered per measurement")
+    args = parser.parse_args()
+
+    with open(os.path.join(EMAIL_TEMPLATES_DIR, "password_reset.html")) as f:
+        html = f.read()
+    check(html)
+
+    before = measure(render_per_call, html, args.messages)
+    after = measure(render_compiled, html, args.messages)
+
+    print(f"{'renderer':<12}{'messages/s':>14}")
+    print(f"{'per call':<12}{before:>14.0f}")
+    print(f"{'compiled':<12}{after:>14.0f}")
+    print(f"speedup: {after / before:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migrations import apply_migrations
+
+# Benchmark of the login and history lookups, before and after the hot path indexes.
+# Builds a throwaway database with --rows users and --rows trips:
+#   python benchmarks/bench_indexes.py --rows 1000000
+
+
+# Fill users and trips with synthetic rows
+def populate(conn, rows, users):
+    conn.executemany(
+        "INSERT INTO users (name, email, hash) VALUES (?, ?, ?)",
+        ((f"user{i}", f"user{i}@example.com", "x" * 60) for i in range(rows)),
+    )
+    conn.executemany(
+        "INSERT INTO trips (user_id, generation_ts, destination, month, duration, travel_plan) VALUES (?, ?, ?, ?, ?, ?)",
+        ((random.randint(1, users), "01-01-2024, 00:00:00", "Tokyo", "May", "One week", "<h5>Plan</h5>" * 20) for i in range(rows)),
+    )
+    conn.commit()
+
+# Time the queries run by login and history, return the mean latency in ms of each
+def measure(conn, rows, users, lookups):
+    results = {}
+
+    start = time.perf_counter()
+    for i in range(lookups):
+        email = f"user{random.randrange(rows)}@example.com"
+        conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchall()
+    results["login"] = (time.perf_counter() - start) / lookups * 1000
+
+    start = time.perf_counter()
+    for i in range(lookups):
+        conn.execute("SELECT * FROM trips WHERE user_id = ? ORDER BY trip_id DESC", (random.randint(1, users),)).fetchall()
+    results["history"] = (time.perf_counter() - start) / lookups * 1000
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login and history latency, before and after the hot path indexes")
+    parser.add_argument("--rows", type=int, default=1000000, help="rows in users and in trips")
+    parser.add_argument("--users", type=int, default=10000, help="distinct owners of the trips")
+    parser.add_argument("--lookups", type=int, default=20, help="queries timed per measurement")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        conn = sqlite3.connect(os.path.join(directory, "bench.db"))
+
+        # Schema as it was before the indexes migration
+        apply_migrations(conn, target=2)
+        print(f"populating {args.rows} users and {args.rows} trips...")
+        populate(conn, args.rows, args.users)
+        before = measure(conn, args.rows, args.users, args.lookups)
+
+        # Then apply the remaining migrations
+        start = time.perf_counter()
+        apply_migrations(conn)
+        print(f"migrations applied in {time.perf_counter() - start:.1f}s")
+        after = measure(conn, args.rows, args.users, args.lookups)
+
+        print(f"{'query':<10}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+        for query in before:
+            print(f"{query:<10}{before[query]:>14.3f}{after[query]:>14.3f}{before[query] / after[query]:>9.0f}x")
+
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import check_password_hash, generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashing import PasswordHasher, PASSWORD_HASH_METHOD
+
+# Benchmark of password checks during a login burst: --concurrency request threads each
+# verify --logins passwords, inline (as before) and through the hashing pool. Meanwhile a
+# probe thread does small pure-Python tasks, like the other requests of the worker would:
+# its latency shows how much the burst stalls them.
+#   python benchmarks/bench_login.py --concurrency 16 --workers 4
+
+PASSWORD = "Correct-horse-9"
+
+
+# Latencies in ms of a small task run every 5ms until stop is set
+def probe(stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        sum(i * i for i in range(2000))
+        latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(0.005)
+
+# Run the login burst with verify(); return logins per second and the probe latencies
+def measure(verify, pwhash, concurrency, logins):
+    stop = threading.Event()
+    latencies = []
+    thread = threading.Thread(target=probe, args=(stop, latencies))
+    thread.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda i: verify(pwhash, PASSWORD), range(concurrency * logins)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    thread.join()
+    assert all(results)
+    return concurrency * logins / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login throughput and stall, inline hashing vs the hashing pool")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent login requests")
+    parser.add_argument("--logins", type=int, default=5, help="logins per request thread")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="processes in the hashing pool")
+    parser.add_argument("--method", default=PASSWORD_HASH_METHOD, help="work factor, as a werkzeug method")
+    args = parser.parse_args()
+
+    pwhash = generate_password_hash(PASSWORD, args.method)
+    hasher = PasswordHasher(method=args.method, workers=args.workers, max_pending=args.concurrency)
+
+    # Start the pool processes before timing
+    hasher.verify(pwhash, PASSWORD)
+
+    print(f"{'':<10}{'logins/s':>10}{'probe p50 (ms)':>16}{'probe p99 (ms)':>16}")
+    for label, verify in [("inline", check_password_hash), ("pool", hasher.verify)]:
+        rate, latencies = measure(verify, pwhash, args.concurrency, args.logins)
+        p99 = statistics.quantiles(latencies, n=100)[98] if len(latencies) > 1 else latencies[0]
+        print(f"{label:<10}{rate:>10.1f}{statistics.median(latencies):>16.2f}{p99:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+
+from itsdangerous import URLSafeSerializer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompts import INTERESTS, PROMPT_TEMPLATES, build_prompt, canonical_trip, estimate_message_tokens
+
+# Size of the prompt sent upstream and of the /stream request body, for the old inline
+# f-string prompt and for every registered template (tokens are estimates, see prompts.py):
+#   python benchmarks/bench_prompt.py
+
+SYSTEM = "You are Cicero, an experienced travel guide who has visited the whole world. Use a professional, but friendly tone."
+TRIPS = [
+    ("Tokyo", "March", "One week", ["History, Culture and Arts", "Food and Dining"]),
+    ("Reykjavik", "January", "A weekend", ["Outdoor and Nature"]),
+    ("Rio de Janeiro", "February", "Two weeks", INTERESTS),
+]
+
+
+# The prompt as /generate built it before prompts.py, indentation included
+def old_prompt(destination, month, duration, interests):
+    return f"Please provide me with personalized advice for my next holiday to {destination}.\
+            I will be there in {month} for {duration}.\
+            My interests are: {interests}.\
+            The advice should be structured as follows:\
+            1. A first paragraph with general advice regarding {destination}, must-view places and hidden gems.\
+            2. One paragraph for each of the interests I've expressed, with each destination on a seperate bullet point, for example:\
+            Shopping, brief introduction about shopping in {destination}.\
+            - relevant shopping place #1, description;\
+            - relevant shopping place #2, description;\
+            - etc..\
+            3. A final paragraph with a proposed schedule for my trip, which must be relevant to my interests.\
+            All of the above should also be relevant to the moment of the year I'm visiting.\
+            For example you would suggest attending the cherry trees blossom if I were to go to Tokio at the end of March.\
+            Please output your response with HTML formatting, for example: the paragraph headers should be in H5, \
+            you also should account for new lines.\
+            Also, make sure to give your warm regards at the end."
+
+# The old /stream body: the prompt and the trip, echoed back by the page
+def old_body(destination, month, duration, interests):
+    return json.dumps({"prompt": old_prompt(destination, month, duration, interests), "destination": destination,
+                       "month": month, "duration": duration, "interests": ", ".join(interests)})
+
+
+def main():
+    print(f"{'':<16}{'prompt chars':>14}{'est. tokens':>13}{'/stream body (bytes)':>22}")
+    for destination, month, duration, interests in TRIPS:
+        print(f"{destination}, {duration}, {len(interests)} interests")
+
+        messages = [{"role": "system", "content": SYSTEM}, {"role": "user", "content": old_prompt(destination, month, duration, interests)}]
+        chars = sum(len(message["content"]) for message in messages)
+        print(f"{'  inline':<16}{chars:>14}{estimate_message_tokens(messages):>13}{len(old_body(destination, month, duration, interests)):>22}")
+
+        # The page now posts a signed reference to the trip
+        trip = canonical_trip(destination, month, duration, interests)
+        for template_id in sorted(PROMPT_TEMPLATES):
+            prompt = build_prompt(trip, template_id)
+            # Sectioned templates: every section's prompt counts
+            messages = [message for section in prompt.sections or [prompt] for message in section.messages]
+            chars = sum(len(message["content"]) for message in messages)
+            body = json.dumps({"trip": URLSafeSerializer("benchmark").dumps({"trip": trip, "prompt": template_id})})
+            print(f"{'  ' + template_id:<16}{chars:>14}{prompt.tokens:>13}{len(body):>22}")
+
+
+if __name__ == "__main__":
+    main()
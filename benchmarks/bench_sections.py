@@ -0,0 +1,53 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_openai
+
+# Itinerary generation time, in one completion vs section by section (ITINERARY_SECTIONS), against
+# the fake OpenAI API: time to first text and to the whole itinerary, for 1, 3 and 5 interests.
+# Every section is --section-tokens long, so the single completion is sections x --section-tokens.
+#   python benchmarks/bench_sections.py --tokens-per-second 40 --section-tokens 200
+
+PORT = 8731
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Itinerary generation time, single completion vs sectioned")
+    parser.add_argument("--ttft", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=40)
+    parser.add_argument("--section-tokens", type=int, default=200)
+    args = parser.parse_args()
+
+    fake_openai.serve(PORT, ttft=args.ttft, jitter=0, tokens_per_second=args.tokens_per_second)
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{PORT}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+
+    from itineraries import generate_itinerary
+    from prompts import INTERESTS, build_prompt, canonical_trip
+
+    print(f"{'':<24}{'sections':>10}{'first text (s)':>16}{'total (s)':>11}")
+    for count in [1, 3, 5]:
+        trip = canonical_trip("Tokyo", "March", "One week", INTERESTS[:count])
+        for label, template_id in [("single completion", "itinerary/2"), ("sectioned", "sections/1")]:
+            prompt = build_prompt(trip, template_id)
+            sections = prompt.requests
+
+            # The fake API answers every request with the same length: the whole itinerary, or one section
+            fake_openai.Settings.tokens = args.section_tokens * (count + 2) // sections
+
+            start = time.perf_counter()
+            first = None
+            for text in generate_itinerary(prompt):
+                if first is None:
+                    first = time.perf_counter() - start
+            total = time.perf_counter() - start
+            print(f"{f'{count} interests, ' + label:<24}{sections:>10}{first:>16.2f}{total:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold start benchmark: time from launching a server process to the first byte of a response.
+# Starts the application --runs times on a throwaway database and polls /healthz:
+#   python benchmarks/bench_startup.py --runs 5
+#   python benchmarks/bench_startup.py --server uvicorn
+# Track the median across changes to catch cold start regressions.
+
+SERVERS = {
+    "gunicorn": lambda port: [sys.executable, "-m", "gunicorn", "--workers", "1", "--bind", f"127.0.0.1:{port}", "app:app"],
+    "uvicorn": lambda port: [sys.executable, "-m", "uvicorn", "--port", str(port), "asgi:application"],
+}
+
+
+# GET path, return (status, body), or None while the server isn't listening yet
+def get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    except OSError:
+        return None
+    finally:
+        conn.close()
+
+# Launch the server once; return the client side and server side cold start, and readiness time
+def run(server, port, timeout):
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ)
+        env.setdefault("SECRET_KEY", "benchmark")
+        env["DATABASE_URL"] = "sqlite:///" + os.path.join(directory, "database.db")
+        env["WRITE_BEHIND_SPOOL"] = os.path.join(directory, "spool.db")
+
+        start = time.perf_counter()
+        process = subprocess.Popen(SERVERS[server](port), cwd=ROOT, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # First byte: the first answer to /healthz
+            while (result := get(port, "/healthz")) is None:
+                if time.perf_counter() - start > timeout or process.poll() is not None:
+                    raise RuntimeError(f"{server} did not start")
+                time.sleep(0.01)
+            first_byte = time.perf_counter() - start
+
+            # Ready: the required startup tasks are done
+            while (result := get(port, "/readyz")) is None or result[0] != 200:
+                if time.perf_counter() - start > timeout:
+                    raise RuntimeError(f"{server} did not get ready")
+                time.sleep(0.01)
+            ready = time.perf_counter() - start
+
+            # Cold start as measured by the worker itself, from its process start
+            reported = json.loads(result[1])["first_byte_seconds"]
+        finally:
+            process.terminate()
+            process.wait()
+
+    return first_byte, reported, ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time from server launch to the first byte served")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts measured")
+    parser.add_argument("--server", choices=SERVERS, default="gunicorn")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before a start counts as failed")
+    args = parser.parse_args()
+
+    results = [run(args.server, args.port, args.timeout) for i in range(args.runs)]
+
+    print(f"{'':<34}{'median (s)':>12}{'max (s)':>10}")
+    for index, label in enumerate(["launch to first byte (client)", "worker start to first byte", "launch to ready"]):
+        values = [result[index] for result in results]
+        print(f"{label:<34}{statistics.median(values):>12.3f}{max(values):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
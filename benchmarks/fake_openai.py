@@ -0,0 +1,156 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI API, for load tests that don't spend tokens.
+# Streams ChatCompletion chunks in the format of the real API, with a configurable time to
+# first token, token rate and length, and injects errors on demand. Point the app at it with
+# OPENAI_API_BASE=http://127.0.0.1:8700/v1 (any OPENAI_API_KEY is accepted):
+#   python benchmarks/fake_openai.py --ttft 0.5 --tokens-per-second 40 --error-rate 0.02
+
+# Words the fake itineraries are made of, markup included like the real ones
+WORDS = (
+    "<h5>General Advice</h5> is a great place to visit in spring, you can also explore the "
+    "old town, local markets, museums and hidden gems along the river. "
+    "<h5>Food and Dining</h5> - traditional restaurants, street food and a cooking class; "
+    "<h5>Proposed Schedule</h5> Day 1: Morning: walking tour. Afternoon: museum. Evening: dinner. "
+    "I hope you have a wonderful trip! Warm regards, Cicero"
+).split(" ")
+
+
+class Settings:
+    ttft = 0.5
+    jitter = 0.2
+    tokens_per_second = 40.0
+    tokens = 400
+    error_rate = 0.0
+    rate_limit_rate = 0.0
+    drop_rate = 0.0
+
+
+# Random stand-in for a token, with the odd line break
+def token():
+    word = random.choice(WORDS)
+    return (" " + word) if random.random() > 0.05 else ("\n" + word)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, kind):
+        self.send_json(status, {"error": {"message": message, "type": kind, "param": None, "code": None}})
+
+    # Model list, used by the application's startup check
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            return self.send_json(200, {"object": "list", "data": [{"id": "gpt-3.5-turbo", "object": "model", "owned_by": "fake"}]})
+        self.send_error_json(404, "not found", "invalid_request_error")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self.send_error_json(404, "not found", "invalid_request_error")
+
+        # Injected failures, before any token
+        roll = random.random()
+        if roll < Settings.rate_limit_rate:
+            return self.send_error_json(429, "Rate limit reached (fake)", "requests")
+        if roll < Settings.rate_limit_rate + Settings.error_rate:
+            return self.send_error_json(500, "The server had an error (fake)", "server_error")
+
+        completion_id = "chatcmpl-" + uuid.uuid4().hex[:24]
+        model = request.get("model", "gpt-3.5-turbo")
+        tokens = [token() for i in range(Settings.tokens)]
+        time.sleep(max(0, Settings.ttft + random.uniform(-Settings.jitter, Settings.jitter)))
+
+        if not request.get("stream"):
+            message = {"role": "assistant", "content": "".join(tokens)}
+            return self.send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 200, "completion_tokens": len(tokens), "total_tokens": 200 + len(tokens)},
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        def chunk(delta, finish_reason=None):
+            body = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            self.wfile.write(b"data: " + json.dumps(body).encode() + b"\n\n")
+            self.wfile.flush()
+
+        # Stream the tokens at the configured rate; a dropped stream just stops, like a cut connection
+        try:
+            chunk({"role": "assistant"})
+            drop_at = random.randrange(len(tokens)) if random.random() < Settings.drop_rate else None
+            start = time.monotonic()
+            for index, text in enumerate(tokens):
+                if index == drop_at:
+                    return
+                delay = start + index / Settings.tokens_per_second - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                chunk({"content": text})
+            chunk({}, "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+# Start the server on a background thread, return it (stop it with shutdown())
+def serve(port=8700, **settings):
+    for name, value in settings.items():
+        setattr(Settings, name, value)
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI streaming API for load tests")
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--ttft", type=float, default=Settings.ttft, help="seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=Settings.jitter, help="random +/- seconds on the ttft")
+    parser.add_argument("--tokens-per-second", type=float, default=Settings.tokens_per_second)
+    parser.add_argument("--tokens", type=int, default=Settings.tokens, help="tokens per completion")
+    parser.add_argument("--error-rate", type=float, default=Settings.error_rate, help="share of requests answered 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=Settings.rate_limit_rate, help="share of requests answered 429")
+    parser.add_argument("--drop-rate", type=float, default=Settings.drop_rate, help="share of streams cut short")
+    args = parser.parse_args()
+
+    settings = vars(args)
+    port = settings.pop("port")
+    server = serve(port, **settings)
+    print(f"fake OpenAI API on http://127.0.0.1:{port}/v1", file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+import argparse
+import collections
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from urllib.parse import unquote
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_openai
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Load test of the whole user flow, without spending tokens: login -> /generate -> /stream
+# -> /history, run by --users simulated users at once, each doing --flows generations.
+# By default it starts the fake OpenAI API (fake_openai.py) and a gunicorn server on a
+# throwaway database; with --url it targets a running server instead (point that server's
+# OPENAI_API_BASE at fake_openai.py). Reports throughput, latency percentiles per step,
+# errors, and DB lock errors (from the responses and, when it started the server, its log):
+#   python benchmarks/load_test.py --users 50 --flows 3 --workers 2
+#   python benchmarks/load_test.py --server-env ADMISSION_MAX_INFLIGHT=4 --error-rate 0.05
+# Run it before and after a change, with the same options, to compare against the baseline.
+
+PASSWORD = "Load-test-password-1"
+INTERESTS = ["History, Culture and Arts", "Food and Dining"]
+
+# Settings of the started server: the per-user quota would turn the simulated users away
+SERVER_ENV = {
+    "SECRET_KEY": "load-test",
+    "ADMISSION_RATE": "100000",
+    "ADMISSION_BURST": "100000",
+}
+
+# Apology pages carry their message in the meme URL
+APOLOGY = re.compile(r"/images/custom/(\d+)/([^\"?]*)\.png")
+HIDDEN = re.compile(r'<input type="hidden"\s+id="([^"]+)" value="([^"]*)"')
+
+
+# A free local port
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# Error message of an apology page, or None
+def apology_message(html):
+    match = APOLOGY.search(html)
+    if match is None:
+        return None
+    text = unquote(match.group(2))
+    text = re.sub(r"--|-", lambda m: "-" if m.group() == "--" else " ", text)
+    for old, new in [("__", "_"), ("~q", "?"), ("~p", "%"), ("~h", "#"), ("~s", "/"), ("''", "\"")]:
+        text = text.replace(old, new)
+    return text
+
+# Unescape the HTML of a hidden input value, as the browser does
+def unescape(value):
+    for old, new in [("&#34;", "\""), ("&#39;", "'"), ("&lt;", "<"), ("&gt;", ">"), ("&amp;", "&")]:
+        value = value.replace(old, new)
+    return value
+
+# Parse an SSE response into (event, data) pairs as they arrive
+def sse_events(response):
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[6:] if line.startswith("data: ") else line[5:])
+    if data:
+        yield event, "\n".join(data)
+
+
+class Results:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.defaultdict(collections.Counter)
+        self.flows = 0
+        self._lock = threading.Lock()
+
+    def record(self, step, seconds, outcome="ok"):
+        with self._lock:
+            if outcome == "ok":
+                self.latencies[step].append(seconds)
+            self.outcomes[step][outcome] += 1
+
+    def flow_done(self):
+        with self._lock:
+            self.flows += 1
+
+    # Responses whose error came from the database
+    def db_errors(self):
+        return sum(count for outcomes in self.outcomes.values() for outcome, count in outcomes.items() if outcome.startswith("db "))
+
+
+class SimulatedUser:
+    def __init__(self, base_url, index, destinations, results, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.index = index
+        self.email = f"load{index}@loadtest.example.com"
+        self.destinations = destinations
+        self.results = results
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.flow = 0
+
+    # Timed request: record its latency, or the reason it failed
+    def request(self, step, method, path, check=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.results.record(step, 0, type(e).__name__)
+            return None
+        elapsed = time.perf_counter() - start
+
+        if response.status_code != 200 or (check is not None and not check(response)):
+            message = apology_message(response.text)
+            self.results.record(step, elapsed, message or f"http {response.status_code}")
+            return None
+        self.results.record(step, elapsed)
+        return response
+
+    def register(self):
+        form = {"name": f"Load {self.index}", "email": self.email, "password": PASSWORD, "confirmation": PASSWORD}
+        response = self.session.post(self.base_url + "/register", data=form, timeout=self.timeout)
+        message = apology_message(response.text)
+        if message and "already exists" not in message:
+            raise RuntimeError(f"registering {self.email} failed: {message}")
+
+    def login(self):
+        form = {"email": self.email, "password": PASSWORD}
+        return self.request("login", "POST", "/login", data=form, check=lambda r: apology_message(r.text) is None)
+
+    # One generation: the form, the stream page, the stream itself, then the history
+    def generate(self):
+        self.flow += 1
+        if self.destinations:
+            destination = f"Load test city {(self.index * 7919 + self.flow) % self.destinations}"
+        else:
+            destination = f"Load test city {self.index}-{self.flow}"
+
+        if self.request("generate_form", "GET", "/generate") is None:
+            return False
+        form = {"destination": destination, "month": "May", "duration": "One week", "interests": INTERESTS}
+        page = self.request("generate", "POST", "/generate", data=form, check=lambda r: HIDDEN.search(r.text) is not None)
+        if page is None:
+            return False
+
+        # The page posts its hidden fields to /stream
+        post_data = {name: unescape(value) for name, value in HIDDEN.findall(page.text)}
+        if not self.stream(post_data):
+            return False
+        return self.request("history", "GET", "/history") is not None
+
+    # Read the stream to its end: time to the first text, and to the last event
+    def stream(self, post_data):
+        start = time.perf_counter()
+        first = None
+        outcome = "no end event"
+        try:
+            with self.session.post(self.base_url + "/stream", json=post_data, stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    outcome = f"http {response.status_code}"
+                else:
+                    for event, data in sse_events(response):
+                        if event == "message" and first is None:
+                            first = time.perf_counter() - start
+                        elif event == "done":
+                            outcome = "ok"
+                            break
+                        elif event == "error":
+                            outcome = data
+                            break
+        except requests.RequestException as e:
+            outcome = type(e).__name__
+
+        if first is not None:
+            self.results.record("stream_first_text", first)
+        self.results.record("stream", time.perf_counter() - start, outcome)
+        return outcome == "ok"
+
+    def run(self, flows):
+        if self.login() is None:
+            return
+        for i in range(flows):
+            if self.generate():
+                self.results.flow_done()
+
+
+# Start the fake API and a gunicorn server on a throwaway database; return the processes
+def start_server(args, directory, api_port):
+    env = dict(os.environ)
+    env.update(SERVER_ENV)
+    env["DATABASE_URL"] = "sqlite:///" + os.path.join(directory, "database.db")
+    env["WRITE_BEHIND_SPOOL"] = os.path.join(directory, "spool.db")
+    env["OPENAI_API_BASE"] = f"http://127.0.0.1:{api_port}/v1"
+    env["OPENAI_API_KEY"] = "sk-fake"
+    for setting in args.server_env:
+        name, value = setting.split("=", 1)
+        env[name] = value
+
+    port = free_port()
+    command = [sys.executable, "-m", "gunicorn", "--workers", str(args.workers), "--worker-class", "gthread",
+               "--threads", str(args.threads), "--timeout", "120", "--bind", f"127.0.0.1:{port}", "app:app"]
+    log = open(os.path.join(directory, "server.log"), "w")
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    # Wait until every required startup task is done
+    url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    while True:
+        try:
+            if requests.get(url + "/readyz", timeout=5).status_code == 200:
+                return url, process
+        except requests.RequestException:
+            pass
+        if process.poll() is not None or time.perf_counter() - start > 60:
+            process.terminate()
+            raise RuntimeError("the server did not start, see " + log.name)
+        time.sleep(0.1)
+
+def percentile(values, p):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+def report(results, elapsed, users, log_path=None):
+    print(f"{results.flows} flows by {users} users in {elapsed:.1f}s: {results.flows / elapsed:.2f} flows/s")
+    print()
+    print(f"{'step':<20}{'ok':>7}{'failed':>8}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}")
+    for step in ["login", "generate_form", "generate", "stream_first_text", "stream", "history"]:
+        latencies = results.latencies.get(step, [])
+        failed = sum(count for outcome, count in results.outcomes[step].items() if outcome != "ok")
+        if latencies:
+            p50, p95, p99 = (percentile(latencies, p) for p in (50, 95, 99))
+            print(f"{step:<20}{len(latencies):>7}{failed:>8}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}")
+        else:
+            print(f"{step:<20}{0:>7}{failed:>8}{'-':>10}{'-':>10}{'-':>10}")
+
+    errors = [(step, outcome, count) for step, outcomes in results.outcomes.items() for outcome, count in outcomes.items() if outcome != "ok"]
+    if errors:
+        print()
+        print("errors:")
+        for step, outcome, count in sorted(errors, key=lambda error: -error[2]):
+            print(f"  {count:>6}  {step}: {outcome}")
+
+    # DB lock errors: failed requests, plus the lock contention logged by the server
+    print()
+    print(f"DB errors in responses: {results.db_errors()}")
+    if log_path is not None:
+        with open(log_path) as log:
+            locked = sum(1 for line in log if "database is locked" in line)
+        print(f"'database is locked' in the server log: {locked}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the login -> generate -> stream -> history flow")
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--flows", type=int, default=3, help="generations per user")
+    parser.add_argument("--destinations", type=int, default=0,
+                        help="pick destinations from this many, so identical trips hit the cache (0: all different)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds before a request counts as failed")
+    parser.add_argument("--url", help="target a running server instead of starting one")
+
+    # Started server
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=32, help="threads per gunicorn worker")
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="environment variable of the server, e.g. ADMISSION_MAX_INFLIGHT=4 (repeatable)")
+
+    # Fake OpenAI API
+    parser.add_argument("--ttft", type=float, default=fake_openai.Settings.ttft)
+    parser.add_argument("--tokens-per-second", type=float, default=fake_openai.Settings.tokens_per_second)
+    parser.add_argument("--tokens", type=int, default=fake_openai.Settings.tokens)
+    parser.add_argument("--error-rate", type=float, default=fake_openai.Settings.error_rate)
+    parser.add_argument("--rate-limit-rate", type=float, default=fake_openai.Settings.rate_limit_rate)
+    parser.add_argument("--drop-rate", type=float, default=fake_openai.Settings.drop_rate)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        process = None
+        log_path = None
+        if args.url is None:
+            api_port = free_port()
+            api = fake_openai.serve(api_port, ttft=args.ttft, tokens_per_second=args.tokens_per_second, tokens=args.tokens,
+                                    error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, drop_rate=args.drop_rate)
+            url, process = start_server(args, directory, api_port)
+            log_path = os.path.join(directory, "server.log")
+        else:
+            url = args.url
+
+        try:
+            results = Results()
+            users = [SimulatedUser(url, index, args.destinations, results, args.timeout) for index in range(args.users)]
+
+            # Accounts are created before the timed run
+            for user in users:
+                user.register()
+
+            threads = [threading.Thread(target=user.run, args=(args.flows,)) for user in users]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            report(results, elapsed, args.users, log_path)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+                api.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+# Bounded in-process cache with LRU eviction and a time-to-live per entry
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Return the cached value, or None if missing or expired
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+
+            # Drop stale entries lazily, on lookup
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            return value
+
+    # Store a value, evicting the least recently used entries when full
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    # Remove a single entry, if present
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    # Remove every entry
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+# Build the cache key of an itinerary from the trip parameters
+def itinerary_key(destination, month, duration, interests, template_id=None):
+
+    # Collapse whitespace and case so trivial variants share an entry
+    destination = " ".join(destination.split()).casefold()
+
+    # Interests are a set: order of the checkboxes does not matter
+    interests = tuple(sorted(set(interests)))
+
+    # Itineraries from different prompt templates are different itineraries
+    return (destination, month, duration, interests, template_id)
@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import zlib
+
+from dotenv import load_dotenv
+
+# Storage codec for trips.travel_plan.
+# Plans are stored as BLOBs: one version byte, then the zlib stream compressed with that
+# version's preset dictionary. Rows written before compression existed are TEXT and are
+# returned as they are, so old and new rows can live side by side.
+#   python codec.py migrate    compress the existing TEXT rows, in small batches
+#   python codec.py report     compression ratio and decode cost per read
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Codec variables
+PLAN_COMPRESSION_LEVEL = int(os.environ.get("PLAN_COMPRESSION_LEVEL", 6))
+PLAN_MIGRATION_BATCH = int(os.environ.get("PLAN_MIGRATION_BATCH", 500))
+
+# Preset dictionaries, by version. Built from the markup and phrasing of our itineraries:
+# zlib favours the strings at the end, so the most frequent ones come last.
+# Never edit a published dictionary: add a new version instead.
+DICTIONARIES = {
+    1: (
+        "Family-Friendly Activities Religious and Spiritual Interests Wellness and Relaxation "
+        "Sports and Adventure Entertainment and Nightlife Shopping Food and Dining "
+        "Outdoor and Nature History, Culture and Arts "
+        "January February March April May June July August September October November December "
+        "A weekend One week Two weeks Three weeks Four weeks "
+        "hidden gems must-see must-visit local cuisine traditional restaurants museums "
+        "markets festival beaches hiking neighborhood boutique nightlife spa temple "
+        "Proposed Schedule Day 1: Day 2: Day 3: Day 4: Day 5: Day 6: Day 7: "
+        "Morning: Afternoon: Evening: "
+        "I hope you have a wonderful trip! Warm regards, Cicero "
+        "<p></p><ul><li></li></ul><strong></strong>"
+        "General Advice</h5><br><h5>"
+        " is a great place to visit in</h5><br>"
+        " you can also explore the <br><br>"
+        "<br>- <br>- <br>- "
+    ).encode(),
+}
+
+# Version used for new rows
+CURRENT_VERSION = max(DICTIONARIES)
+
+
+# Compress a travel plan for storage
+def encode_plan(text, version=CURRENT_VERSION):
+    compressor = zlib.compressobj(PLAN_COMPRESSION_LEVEL, zdict=DICTIONARIES[version])
+    return bytes([version]) + compressor.compress(text.encode()) + compressor.flush()
+
+# Decompress a stored travel plan; legacy uncompressed rows are returned unchanged
+def decode_plan(value):
+    if value is None or isinstance(value, str):
+        return value
+
+    version = value[0]
+    decompressor = zlib.decompressobj(zdict=DICTIONARIES[version])
+    return (decompressor.decompress(value[1:]) + decompressor.flush()).decode()
+
+
+# Compress the existing TEXT rows of trips, one small transaction per batch, so the
+# application keeps running. Safe to interrupt and run again. Returns the rows migrated.
+def migrate_plans(engine, batch=PLAN_MIGRATION_BATCH, pause=0.05):
+    import sqlalchemy
+
+    select = sqlalchemy.text("SELECT trip_id, travel_plan FROM trips WHERE typeof(travel_plan) = 'text' LIMIT :batch")
+    update = sqlalchemy.text("UPDATE trips SET travel_plan = :travel_plan WHERE trip_id = :id AND typeof(travel_plan) = 'text'")
+
+    migrated = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select, parameters={"batch": batch}).fetchall()
+            for row in rows:
+                conn.execute(update, parameters={"travel_plan": encode_plan(row[1]), "id": row[0]})
+
+        migrated += len(rows)
+        if len(rows) < batch:
+            return migrated
+
+        # Leave room for the application's writers
+        time.sleep(pause)
+
+# Measure storage and decode cost of the stored travel plans
+def report(engine, sample=1000):
+    import sqlalchemy
+
+    with engine.connect() as conn:
+        counts = conn.execute(sqlalchemy.text(
+            "SELECT typeof(travel_plan), COUNT(*), SUM(length(CAST(travel_plan AS BLOB))) FROM trips GROUP BY 1"
+        )).fetchall()
+        blobs = [row[0] for row in conn.execute(sqlalchemy.text(
+            "SELECT travel_plan FROM trips WHERE typeof(travel_plan) = 'blob' LIMIT :sample"
+        ), parameters={"sample": sample})]
+
+    for kind, count, size in counts:
+        print(f"{kind} rows: {count}, {size or 0} bytes stored")
+
+    if not blobs:
+        print("no compressed rows")
+        return
+
+    # Decode cost per read, and ratio on the sample
+    start = time.perf_counter()
+    plans = [decode_plan(blob) for blob in blobs]
+    elapsed = time.perf_counter() - start
+
+    raw = sum(len(plan.encode()) for plan in plans)
+    stored = sum(len(blob) for blob in blobs)
+    print(f"compression ratio: {raw / stored:.2f}x ({raw} -> {stored} bytes over {len(blobs)} rows)")
+    print(f"decode cost: {elapsed / len(blobs) * 1e6:.1f} us per read")
+
+
+if __name__ == "__main__":
+    from database import db
+
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        print(f"compressed {migrate_plans(db)} rows (run VACUUM to return the freed pages to the filesystem)")
+    else:
+        report(db)
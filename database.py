@@ -0,0 +1,116 @@
+import os
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event
+
+from metrics import DB_WRITE_SECONDS
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Database variables
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///database.db")
+
+# - SQLite pragmas, applied to every new connection
+#   WAL lets readers run concurrently with the (single) writer
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", -65536))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 268435456))
+
+# - Connection pool, per worker process
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+
+# - Writes waiting for the writer thread
+DB_WRITE_QUEUE_SIZE = int(os.environ.get("DB_WRITE_QUEUE_SIZE", 1000))
+
+
+# SETUP: SQLAlchemy engine
+db = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    connect_args={"check_same_thread": False},
+)
+
+# Tune every new SQLite connection
+@event.listens_for(db, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA foreign_keys = ON")
+    cursor.close()
+
+# Connections must not be shared across a fork (gunicorn --preload): each worker builds its own pool
+os.register_at_fork(after_in_child=lambda: db.dispose(close=False))
+
+
+# Serialized writer: every write runs on one thread, one transaction at a time,
+# so writers of the same worker never fight over the SQLite write lock
+class Writer:
+    def __init__(self, engine, maxsize=DB_WRITE_QUEUE_SIZE):
+        self.engine = engine
+        self.maxsize = maxsize
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # Queue fn(conn) to run inside a transaction, return a Future of its result
+    # - operation labels the write's latency in the metrics
+    # - with block=False, a full queue raises queue.Full instead of waiting
+    def submit(self, fn, operation="write", block=True):
+        future = Future()
+        self._ensure_started().put((fn, future, operation, time.perf_counter()), block=block)
+        return future
+
+    # Run fn(conn) inside a transaction and wait for its result
+    def run(self, fn, operation="write"):
+        return self.submit(fn, operation).result()
+
+    # Number of writes waiting for the writer thread
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    # Start the writer thread lazily, once per process
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.maxsize)
+                self._pid = os.getpid()
+                thread = threading.Thread(target=self._loop, args=(self._queue,), daemon=True)
+                thread.start()
+            return self._queue
+
+    def _loop(self, jobs):
+        while True:
+            fn, future, operation, submitted = jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with self.engine.begin() as conn:
+                    result = fn(conn)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            DB_WRITE_SECONDS.labels(operation).observe(time.perf_counter() - submitted)
+
+
+writer = Writer(db)
+
+
+# Execute one write statement through the writer, labelled by its SQL verb
+def execute_write(stmt, parameters=None):
+    operation = str(stmt).split(None, 1)[0].lower()
+    writer.run(lambda conn: conn.execute(stmt, parameters=parameters), operation)
@@ -0,0 +1,233 @@
+import functools
+import os
+import re
+import sys
+import unicodedata
+
+import sqlalchemy
+
+from collections import Counter, defaultdict
+from dotenv import load_dotenv
+
+from metrics import DESTINATION_LOOKUPS
+
+# Destination normalization.
+# Destinations are free text: "Tokyo", "tokyo ", "Tokio" and "Tokyo, Japan" are the same trip.
+# They are looked up in a local gazetteer (data/destinations.tsv: canonical name, country and
+# aliases), ignoring case, accents and punctuation, then canonicalized before the itinerary is
+# keyed and saved. Lookup order:
+# - exact: any name or alias
+# - qualified: a known place followed by its country or region ("Tokyo, Japan", "Rome Italy")
+# - fuzzy: the closest name or alias by edit distance, for typos ("Barcelonna"). Candidates
+#   are shortlisted with a trigram index, so only a few aliases are compared per lookup. Short
+#   names allow no edits (real places are one letter apart: "Lagos" and "Laos"), and the match
+#   must be clearly closer than any other place
+# Unknown destinations are kept as typed, with whitespace collapsed. Fuzzy matches only key the
+# trip: the prompt and the saved trip keep the destination as typed until the user confirms it.
+#   python destinations.py lookup "Tokio"    canonical form of a destination
+#   python destinations.py report            how many destinations of saved trips collapse together
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Destination variables
+DESTINATIONS_FILE = os.environ.get("DESTINATIONS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "destinations.tsv"))
+
+# - Fuzzy matches allow one edit (a letter added, dropped, changed or swapped) per this many
+#   letters, and need this many edits fewer than the runner-up place
+DESTINATION_CHARS_PER_EDIT = int(os.environ.get("DESTINATION_CHARS_PER_EDIT", 8))
+DESTINATION_MATCH_MARGIN = int(os.environ.get("DESTINATION_MATCH_MARGIN", 2))
+
+# - Shortlisted aliases compared per fuzzy lookup
+DESTINATION_CANDIDATES = int(os.environ.get("DESTINATION_CANDIDATES", 20))
+
+# - Lookups remembered per worker
+DESTINATION_CACHE_SIZE = int(os.environ.get("DESTINATION_CACHE_SIZE", 4096))
+
+# Fuzzy matching is only tried on inputs of this many characters: shorter ones are too ambiguous,
+# longer ones aren't place names
+FUZZY_MIN_LENGTH = 4
+FUZZY_MAX_LENGTH = 64
+
+
+# Lookup key of a name: lowercase ASCII letters and digits, single spaces.
+# Dots and apostrophes are dropped ("U.S.A." -> "usa", "Xi'an" -> "xian"), other punctuation splits words
+def normalize(text):
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    text = re.sub(r"[.'’]", "", text)
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text).split())
+
+# Edits (insertions, deletions, substitutions, swaps of adjacent letters) between two keys
+def edit_distance(a, b):
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[len(b)]
+
+# Trigrams of a lookup key, padded so that word starts weigh more
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Destination:
+    def __init__(self, name, country):
+        self.name = name
+        self.country = country
+
+
+class Gazetteer:
+    def __init__(self, path=DESTINATIONS_FILE, chars_per_edit=DESTINATION_CHARS_PER_EDIT, margin=DESTINATION_MATCH_MARGIN, candidates=DESTINATION_CANDIDATES):
+        self.chars_per_edit = chars_per_edit
+        self.margin = margin
+        self.candidates = candidates
+        self.aliases = {}
+        self.index = defaultdict(set)
+
+        # Aliases shared by two places (e.g. a city and a country) are left out: they'd be a guess
+        ambiguous = set()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                name, country, aliases = (line.rstrip("\n").split("\t") + ["", ""])[:3]
+                destination = Destination(name, country)
+                for alias in [name] + aliases.split("|"):
+                    key = normalize(alias)
+                    if not key:
+                        continue
+                    if key in self.aliases and self.aliases[key].name != name:
+                        ambiguous.add(key)
+                    self.aliases.setdefault(key, destination)
+
+        for key in ambiguous:
+            del self.aliases[key]
+        for key in self.aliases:
+            for trigram in trigrams(key):
+                self.index[trigram].add(key)
+
+    # Closest alias by edit distance, among the aliases sharing the most trigrams; None if it
+    # takes more edits than the key's length allows, or another place is nearly as close
+    def fuzzy(self, key):
+        if not FUZZY_MIN_LENGTH <= len(key) <= FUZZY_MAX_LENGTH:
+            return None
+        max_edits = len(key) // self.chars_per_edit
+        if max_edits == 0:
+            return None
+
+        shared = Counter()
+        for trigram in trigrams(key):
+            shared.update(self.index.get(trigram, ()))
+
+        # Fewest edits to every shortlisted place, over its aliases
+        distances = {}
+        for alias, count in shared.most_common(self.candidates):
+            destination = self.aliases[alias]
+            distance = edit_distance(key, alias)
+            if distance < distances.get(destination.name, (len(key) + len(alias) + 1, None))[0]:
+                distances[destination.name] = (distance, destination)
+        ranked = sorted(distances.values(), key=lambda item: item[0])
+        if not ranked or ranked[0][0] > max_edits or (len(ranked) > 1 and ranked[1][0] - ranked[0][0] < self.margin):
+            return None
+        return ranked[0][1]
+
+    # True if every qualifier is a known place of the destination's country ("Japan", "Tuscany")
+    def qualifies(self, destination, qualifiers):
+        for qualifier in qualifiers:
+            place = self.aliases.get(qualifier)
+            if place is None or place.country != destination.country:
+                return False
+        return True
+
+    # Look a destination up: (Destination, how it matched) or (None, "unknown")
+    def lookup(self, text):
+        key = normalize(text)
+        if not key:
+            return None, "unknown"
+
+        destination = self.aliases.get(key)
+        if destination is not None:
+            return destination, "exact"
+
+        # "Place, Country" or "Place, Region, Country": the place may be misspelled, not the qualifiers
+        parts = [normalize(part) for part in text.split(",")]
+        parts = [part for part in parts if part]
+        if len(parts) > 1:
+            head = self.aliases.get(parts[0])
+            if head is not None and self.qualifies(head, parts[1:]):
+                return head, "qualified"
+            head = self.fuzzy(parts[0])
+            if head is not None and self.qualifies(head, parts[1:]):
+                return head, "fuzzy"
+
+        # "Place Country", without a comma: try every split, longest place first
+        words = key.split()
+        for split in range(len(words) - 1, 0, -1):
+            head = self.aliases.get(" ".join(words[:split]))
+            if head is not None and self.qualifies(head, [" ".join(words[split:])]):
+                return head, "qualified"
+
+        destination = self.fuzzy(key)
+        if destination is not None:
+            return destination, "fuzzy"
+        return None, "unknown"
+
+    # Canonical name of a destination, or the text as typed (whitespace collapsed) if unknown
+    @functools.lru_cache(maxsize=DESTINATION_CACHE_SIZE)
+    def _canonical(self, text):
+        destination, match = self.lookup(text)
+        return (destination.name if destination is not None else " ".join(text.split())), match
+
+    def canonical(self, text):
+        return self.resolve(text)[0]
+
+    # Canonical name of a destination and how it matched
+    def resolve(self, text):
+        name, match = self._canonical(text)
+        DESTINATION_LOOKUPS.labels(match).inc()
+        return name, match
+
+
+# SETUP: Gazetteer, loaded at import (a few hundred places: a few milliseconds)
+gazetteer = Gazetteer()
+
+# Canonical form of a destination, used for keying trips
+def canonical_destination(text):
+    return gazetteer.canonical(text)
+
+# Canonical form of a destination and how it matched ("exact", "qualified", "fuzzy" or "unknown")
+def resolve_destination(text):
+    return gazetteer.resolve(text)
+
+
+# Distinct destinations of the saved trips, as typed and once canonicalized
+def report(db):
+    with db.connect() as conn:
+        rows = conn.execute(sqlalchemy.text("SELECT destination, COUNT(*) FROM trips GROUP BY destination")).fetchall()
+    groups = defaultdict(list)
+    for destination, count in rows:
+        groups[canonical_destination(destination)].append((destination, count))
+
+    trips = sum(count for destination, count in rows)
+    print(f"{trips} trips, {len(rows)} distinct destinations as typed, {len(groups)} once canonicalized")
+    merged = sorted((group for group in groups.items() if len(group[1]) > 1), key=lambda group: -sum(c for d, c in group[1]))
+    for name, variants in merged[:20]:
+        print(f"  {name}: " + ", ".join(f"{destination!r} ({count})" for destination, count in variants))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "lookup":
+        for text in sys.argv[2:]:
+            destination, match = gazetteer.lookup(text)
+            print(f"{text!r}: {destination.name + ', ' + destination.country if destination else 'unknown'} ({match})")
+    elif sys.argv[1:] == ["report"]:
+        from database import db
+        report(db)
+    else:
+        print('usage: python destinations.py lookup "destination" | report')
@@ -0,0 +1,71 @@
+import os
+import re
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from string import Template
+
+# Transactional email templates.
+# Each template is compiled once, at import: the HTML (a string.Template, $NAME fields) is
+# wrapped in its MIME message, encoded, and split around the per-message fields, so
+# rendering a message only joins strings. Add an email with register_email_template().
+
+EMAIL_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "email")
+
+
+# A field has no value: in practice, the mail settings are incomplete (no MAIL_SENDER)
+class EmailConfigError(ValueError):
+    pass
+
+
+class EmailTemplate:
+    def __init__(self, subject, html):
+        fields = ["sender", "recipient"] + Template(html).get_identifiers()
+        tokens = {field: f"@@EMAIL-FIELD-{index}@@" for index, field in enumerate(fields)}
+
+        # Build and encode the message once, with a placeholder token for every field
+        message = MIMEMultipart()
+        message['From'] = tokens["sender"]
+        message['To'] = tokens["recipient"]
+        message['Subject'] = subject
+        message.attach(MIMEText(Template(html).substitute(tokens), "html"))
+        encoded = message.as_string()
+
+        # Split around the tokens: static parts at even indexes, field names at odd ones
+        names = {token: field for field, token in tokens.items()}
+        self.parts = re.split("(" + "|".join(re.escape(token) for token in names) + ")", encoded)
+        self.parts[1::2] = [names[token] for token in self.parts[1::2]]
+        self.fields = set(fields)
+
+    # Render the message for one recipient
+    def render(self, **values):
+        if values.keys() != self.fields:
+            raise KeyError(f"expected fields {sorted(self.fields)}, got {sorted(values)}")
+
+        for field, value in values.items():
+            if not value:
+                raise EmailConfigError(f"email {field} is not set" + (" (MAIL_SENDER)" if field == "sender" else ""))
+
+            # Values go in headers too: refuse anything that could add a header
+            if "\r" in value or "\n" in value:
+                raise ValueError("line break in email field")
+
+        parts = self.parts[:]
+        parts[1::2] = [values[field] for field in parts[1::2]]
+        return "".join(parts)
+
+
+# SETUP: Email template registry
+EMAIL_TEMPLATES = {}
+
+# Compile a template from EMAIL_TEMPLATES_DIR and register it under name
+def register_email_template(name, subject, filename):
+    with open(os.path.join(EMAIL_TEMPLATES_DIR, filename)) as f:
+        EMAIL_TEMPLATES[name] = EmailTemplate(subject, f.read())
+
+# Render a registered email as a full MIME string, ready for sendmail
+def render_email(name, sender, recipient, **values):
+    return EMAIL_TEMPLATES[name].render(sender=sender, recipient=recipient, **values)
+
+
+register_email_template("password_reset", "Cicero - Password Reset", "password_reset.html")
@@ -0,0 +1,26 @@
+import glob
+import os
+
+from dotenv import load_dotenv
+from prometheus_client import multiprocess
+
+# Gunicorn settings, read from the working directory by `gunicorn app:app`.
+# With PROMETHEUS_MULTIPROC_DIR set, /metrics aggregates the samples of every worker:
+# they are cleared when gunicorn starts, and dropped for the workers that exit.
+
+# SETUP: Load .env
+load_dotenv()
+
+
+# Start from an empty metrics directory: samples of a previous run would add up
+def on_starting(server):
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(path)
+
+# Stop counting the live gauges of a worker that exited
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
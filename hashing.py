@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Password hashing service.
+# Hashes are computed in a small process pool, so a burst of logins uses the pool's cores
+# instead of stalling every thread of the worker. At most PASSWORD_HASH_QUEUE hashes per
+# worker are in flight: past that, callers get HashingBusy right away instead of queueing.
+# The pool is started with forkserver (spawn where unavailable): its processes start from a
+# clean interpreter, not from a copy of the worker with its threads and open connections.
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Hashing variables
+# - Work factor, as a werkzeug method string; hashes made with other parameters are
+#   upgraded on the next successful login
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256:260000")
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", 32))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))
+
+
+# Raised when too many hashes are already queued: the caller should answer 503
+class HashingBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS,
+                 max_pending=PASSWORD_HASH_QUEUE, timeout=PASSWORD_HASH_TIMEOUT):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # Hash a new password with the configured work factor
+    def hash(self, password):
+        return self._call(generate_password_hash, password, self.method)
+
+    # Check a password against a stored hash
+    def verify(self, pwhash, password):
+        return self._call(check_password_hash, pwhash, password)
+
+    # True if a stored hash was made with other parameters than the configured ones
+    def needs_rehash(self, pwhash):
+        return pwhash.split("$", 1)[0] != self.method
+
+    def _call(self, fn, *args):
+        try:
+            future = self._submit(fn, *args)
+            try:
+                return future.result(self.timeout)
+            except FuturesTimeout:
+                # Drop the hash if it hasn't started yet
+                future.cancel()
+                raise
+        except BrokenProcessPool:
+            # A pool process died: start a new pool for the next call
+            with self._lock:
+                self._pid = None
+            raise
+
+    # Submit a hash to the pool, within the bound on hashes in flight.
+    # The slot is freed once the hash is done, not when the caller stops waiting for it
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._pool().submit(fn, *args)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    # Start the pool lazily, once per worker process
+    def _pool(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+                self._pid = os.getpid()
+            return self._executor
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,80 @@
+import openai
+import os
+
+from dotenv import load_dotenv
+
+from providers import llm
+from streaming import amerge_streams, merge_streams
+
+# Itinerary generation: a prompt built by prompts.py goes upstream through the provider layer
+# (timeouts, retries, hedging and circuit breaking: see providers.py), and comes back as a
+# stream of HTML friendly text chunks. Used by the /stream routes and by pregenerate.py.
+# Sectioned prompts (ITINERARY_SECTIONS, see prompts.py) send every section upstream at once and
+# stream them back in document order, so an itinerary takes about as long as its longest section.
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: OpenAI
+# - Define variables
+openai.api_key = os.environ.get("OPENAI_API_KEY")
+
+# - API endpoint: OPENAI_API_BASE points the app at a stand-in for load tests (benchmarks/fake_openai.py).
+#   Set here because the openai package reads it at import, before .env is loaded
+openai.api_base = os.environ.get("OPENAI_API_BASE", openai.api_base)
+
+# Text between the sections of a sectioned itinerary
+SECTION_SEPARATOR = "<br><br>"
+
+
+# Define function for calling the API with a prompt built by prompts.py, through the provider layer
+def send_prompt(prompt):
+    return llm.stream(prompt.messages, max_tokens=prompt.max_tokens)
+
+# Define async version of send_prompt, for the ASGI serving mode
+async def asend_prompt(prompt):
+    return llm.astream(prompt.messages, max_tokens=prompt.max_tokens)
+
+# Extract the HTML friendly text of a partial API response
+def chunk_text(line):
+
+    # Extract text
+    bad_text = line.choices[0].delta.get("content", "")
+
+    # Convert text into HTML friendly
+    return bad_text.replace("\n", '<br>')
+
+# Define generator of the HTML friendly text chunks of a completion
+def generate_completion(prompt):
+
+    # For every partial API response
+    for line in send_prompt(prompt):
+        text = chunk_text(line)
+
+        # If text is not empty > yield
+        if len(text):
+            yield text
+
+# Define async generator of the HTML friendly text chunks of a completion
+async def agenerate_completion(prompt):
+
+    # For every partial API response
+    async for line in await asend_prompt(prompt):
+        text = chunk_text(line)
+
+        # If text is not empty > yield
+        if len(text):
+            yield text
+
+# Define generator of the HTML friendly text chunks of an itinerary: one completion, or one per
+# section, all running at once and merged in document order
+def generate_itinerary(prompt):
+    if prompt.sections:
+        return merge_streams([generate_completion(section) for section in prompt.sections], SECTION_SEPARATOR)
+    return generate_completion(prompt)
+
+# Define async version of generate_itinerary
+def agenerate_itinerary(prompt):
+    if prompt.sections:
+        return amerge_streams([agenerate_completion(section) for section in prompt.sections], SECTION_SEPARATOR)
+    return agenerate_completion(prompt)
@@ -0,0 +1,165 @@
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Outbound mail: requests only enqueue messages, a background thread per worker sends them
+# over one reused, authenticated SMTP session, retrying transient failures with backoff.
+# For local testing, point MAIL_SERVER/MAIL_PORT at a stand-in SMTP server with
+# MAIL_STARTTLS=0 and no MAIL_USERNAME, e.g.: python -m aiosmtpd -n -l localhost:1025
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Mail variables
+MAIL_SERVER = os.environ.get("MAIL_SERVER")
+MAIL_PORT = os.environ.get("MAIL_PORT")
+MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
+MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+
+# - From address of outgoing mail; defaults to MAIL_USERNAME when the login is an email address
+MAIL_SENDER = os.environ.get("MAIL_SENDER") or (MAIL_USERNAME if MAIL_USERNAME and "@" in MAIL_USERNAME else None)
+MAIL_STARTTLS = os.environ.get("MAIL_STARTTLS", "1") == "1"
+MAIL_TIMEOUT = float(os.environ.get("MAIL_TIMEOUT", 10))
+MAIL_BATCH = int(os.environ.get("MAIL_BATCH", 20))
+MAIL_MAX_RETRIES = int(os.environ.get("MAIL_MAX_RETRIES", 5))
+MAIL_IDLE_TIMEOUT = float(os.environ.get("MAIL_IDLE_TIMEOUT", 60))
+MAIL_QUEUE_SIZE = int(os.environ.get("MAIL_QUEUE_SIZE", 1000))
+
+
+class Mailer:
+    def __init__(self, server=MAIL_SERVER, port=MAIL_PORT, username=MAIL_USERNAME, password=MAIL_PASSWORD,
+                 starttls=MAIL_STARTTLS, timeout=MAIL_TIMEOUT, batch_size=MAIL_BATCH, max_retries=MAIL_MAX_RETRIES,
+                 idle_timeout=MAIL_IDLE_TIMEOUT, queue_size=MAIL_QUEUE_SIZE):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.idle_timeout = idle_timeout
+        self.queue_size = queue_size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._smtp = None
+        self._last_used = 0
+
+    # Queue a message (a full MIME string) for delivery; raises queue.Full when the queue is full
+    def send(self, sender, recipient, message):
+        self._ensure_started().put_nowait((sender, recipient, message, 0))
+
+    # Number of messages waiting to be sent
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    # Start the sender thread lazily, once per process
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                self._pid = os.getpid()
+                self._smtp = None
+                thread = threading.Thread(target=self._loop, args=(self._queue,), daemon=True)
+                thread.start()
+            return self._queue
+
+    def _loop(self, jobs):
+        while True:
+            # Hang up once the session has been idle for a while
+            try:
+                job = jobs.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._close()
+                continue
+
+            # Send everything already queued over the same session
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            # A message that fails unexpectedly is dropped: the sender thread must keep running
+            for job in batch:
+                try:
+                    self._deliver(jobs, job)
+                except Exception:
+                    logger.exception("mail to %s dropped", job[1])
+                    self._close()
+
+    def _deliver(self, jobs, job):
+        sender, recipient, message, attempt = job
+        try:
+            self._session().sendmail(sender, [recipient], message)
+            self._last_used = time.monotonic()
+
+        # Permanent failures (5xx, refused recipient): retrying won't help
+        except smtplib.SMTPRecipientsRefused:
+            logger.error("mail to %s refused", recipient)
+        except smtplib.SMTPResponseException as e:
+            if e.smtp_code >= 500:
+                logger.error("mail to %s rejected: %s %s", recipient, e.smtp_code, e.smtp_error)
+            else:
+                self._retry(jobs, job, e)
+
+        # Transient failures: start a new session and retry later
+        except (smtplib.SMTPException, OSError) as e:
+            self._retry(jobs, job, e)
+
+    # Put a message back in the queue after an exponential backoff
+    def _retry(self, jobs, job, error):
+        sender, recipient, message, attempt = job
+        self._close()
+
+        if attempt + 1 >= self.max_retries:
+            logger.error("mail to %s dropped after %s attempts: %s", recipient, attempt + 1, error)
+            return
+
+        delay = 2 ** attempt
+        logger.warning("mail to %s failed (%s), retrying in %ss", recipient, error, delay)
+        timer = threading.Timer(delay, jobs.put, args=((sender, recipient, message, attempt + 1),))
+        timer.daemon = True
+        timer.start()
+
+    # Open SMTP session, reconnecting if the server dropped it while idle
+    def _session(self):
+        if self._smtp is not None and time.monotonic() - self._last_used > 10:
+            try:
+                if self._smtp.noop()[0] != 250:
+                    self._close()
+            except (smtplib.SMTPException, OSError):
+                self._close()
+
+        if self._smtp is None:
+            smtp = smtplib.SMTP(self.server, int(self.port), timeout=self.timeout)
+            smtp.ehlo()
+            if self.starttls:
+                smtp.starttls()
+                smtp.ehlo()
+            if self.username:
+                smtp.login(self.username, self.password)
+            self._smtp = smtp
+
+        return self._smtp
+
+    def _close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._smtp = None
+
+
+mailer = Mailer()
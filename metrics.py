@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+# SETUP: Load .env, before prometheus_client reads PROMETHEUS_MULTIPROC_DIR
+load_dotenv()
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Prometheus metrics of the generation pipeline and the routes, served on /metrics.
+# With several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory before
+# starting: every worker writes its samples there and /metrics aggregates all of them
+# (gunicorn.conf.py clears the directory at start and drops the samples of dead workers).
+
+# SETUP: Metrics variables
+METRICS_SAMPLE_INTERVAL = float(os.environ.get("METRICS_SAMPLE_INTERVAL", 5))
+
+# SETUP: Metrics
+# - Routes
+REQUEST_SECONDS = Histogram(
+    "cicero_request_seconds", "Time to build the response of a request", ["route", "method", "status"],
+)
+
+# - Generations, labelled by the route that started them; a token is one streamed delta
+GENERATION_TTFT_SECONDS = Histogram(
+    "cicero_generation_ttft_seconds", "Time from calling the API to the first token", ["route"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 8, 13, 20, 30),
+)
+GENERATION_TOKENS_PER_SECOND = Histogram(
+    "cicero_generation_tokens_per_second", "Tokens per second after the first token", ["route"],
+    buckets=(5, 10, 20, 30, 40, 50, 75, 100, 150, 200, 300),
+)
+GENERATION_SECONDS = Histogram(
+    "cicero_generation_seconds", "Time from calling the API to the last token", ["route"],
+    buckets=(1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300),
+)
+GENERATIONS = Counter(
+    "cicero_generations_total", "Generations by outcome: done, error or cancelled", ["route", "outcome"],
+)
+PROVIDER_ATTEMPTS = Counter(
+    "cicero_provider_attempts_total",
+    "Upstream requests by provider and outcome: first_token, error, invalid, timeout, abandoned or hedged", ["provider", "outcome"],
+)
+
+# - Destination lookups by match: exact, qualified, fuzzy or unknown (see destinations.py)
+DESTINATION_LOOKUPS = Counter(
+    "cicero_destination_lookups_total", "Destinations canonicalized, by how they matched the gazetteer", ["match"],
+)
+
+# - Streams sent to clients
+STREAM_BYTES = Histogram(
+    "cicero_stream_bytes", "Bytes sent in one SSE response", ["route"],
+    buckets=(256, 1024, 4096, 8192, 16384, 32768, 65536, 131072),
+)
+STREAM_DISCONNECTS = Counter(
+    "cicero_stream_disconnects_total", "SSE responses cut short by the client", ["route"],
+)
+
+# - Database writes, from submission to the writer thread until committed
+DB_WRITE_SECONDS = Histogram(
+    "cicero_db_write_seconds", "Latency of a write through the serialized writer", ["operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+# - Queue depths, sampled every METRICS_SAMPLE_INTERVAL seconds by each worker.
+#   Per worker queues add up across workers, the shared spool is the same for all of them
+QUEUE_DEPTH = Gauge(
+    "cicero_queue_depth", "Jobs waiting in a per worker queue", ["queue"], multiprocess_mode="livesum",
+)
+SPOOL_DEPTH = Gauge(
+    "cicero_spool_depth", "Jobs in the write-behind spool, pending or dead", ["state"], multiprocess_mode="livemax",
+)
+GENERATIONS_INFLIGHT = Gauge(
+    "cicero_generations_inflight", "Upstream slots held by generations, one per section of sectioned ones", multiprocess_mode="livesum",
+)
+
+
+# Pass a generation's chunks through, recording its latency and throughput
+def observe_generation(chunks, route):
+    start = time.perf_counter()
+    first = None
+    tokens = 0
+    outcome = "error"
+    try:
+        for chunk in chunks:
+            if first is None:
+                first = time.perf_counter()
+                GENERATION_TTFT_SECONDS.labels(route).observe(first - start)
+            tokens += 1
+            yield chunk
+        outcome = "done"
+    except GeneratorExit:
+        outcome = "cancelled"
+        raise
+    finally:
+        record_generation(route, start, first, tokens, outcome)
+
+# Async counterpart of observe_generation()
+async def aobserve_generation(chunks, route):
+    start = time.perf_counter()
+    first = None
+    tokens = 0
+    outcome = "error"
+    try:
+        async for chunk in chunks:
+            if first is None:
+                first = time.perf_counter()
+                GENERATION_TTFT_SECONDS.labels(route).observe(first - start)
+            tokens += 1
+            yield chunk
+        outcome = "done"
+    except GeneratorExit:
+        outcome = "cancelled"
+        raise
+    finally:
+        record_generation(route, start, first, tokens, outcome)
+
+def record_generation(route, start, first, tokens, outcome):
+    end = time.perf_counter()
+    GENERATIONS.labels(route, outcome).inc()
+    if outcome == "done":
+        GENERATION_SECONDS.labels(route).observe(end - start)
+        if first is not None and tokens > 1 and end > first:
+            GENERATION_TOKENS_PER_SECOND.labels(route).observe((tokens - 1) / (end - first))
+
+
+# Pass an SSE response through, recording its size and whether the client left before the end
+def observe_stream(events, route):
+    sent = 0
+    finished = False
+    try:
+        for event in events:
+            sent += len(event)
+            yield event
+        finished = True
+    finally:
+        STREAM_BYTES.labels(route).observe(sent)
+        if not finished:
+            STREAM_DISCONNECTS.labels(route).inc()
+
+
+# Run sample() every METRICS_SAMPLE_INTERVAL seconds, on a thread started once per process
+class Sampler:
+    def __init__(self, sample, interval=METRICS_SAMPLE_INTERVAL):
+        self.sample = sample
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            # A failed sample (e.g. the spool is busy) is simply taken again next round
+            try:
+                self.sample()
+            except Exception:
+                pass
+            time.sleep(self.interval)
+
+
+# Metrics of every worker, in the Prometheus text format: (body, content type)
+def render_metrics():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,131 @@
+import os
+import re
+import sqlite3
+import sys
+
+from datetime import datetime
+
+# Versioned schema migrations: migrations/NNNN_name.sql files, applied in order, once each.
+# Run at application startup, or from the command line:
+#   python migrations.py           apply pending migrations
+#   python migrations.py status    list applied and pending migrations
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Define timestamps format
+ts_format = "%m-%d-%Y, %H:%M:%S"
+
+
+# A migration can't be applied to the data in the database: applying it again won't help
+class MigrationError(Exception):
+    pass
+
+
+# Checks run before a migration, on data it would fail on: they return the problem, None if there is none
+# - 0003 makes users.email unique
+def duplicate_emails(conn):
+    rows = conn.execute("SELECT email, COUNT(*) FROM users GROUP BY email HAVING COUNT(*) > 1 ORDER BY email").fetchall()
+    if rows:
+        emails = ", ".join(f"{email} ({count} accounts)" for email, count in rows)
+        return f"several users share an email address, merge or delete the extra accounts first: {emails}"
+
+PRECHECKS = {3: duplicate_emails}
+
+
+# List the available migrations as (version, name, path), sorted by version
+def discover(directory=MIGRATIONS_DIR):
+    migrations = []
+    for filename in os.listdir(directory):
+        match = re.match(r"^(\d+)_(\w+)\.sql$", filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+    return sorted(migrations)
+
+# Split a SQL script into complete statements (trigger bodies included)
+def split_statements(script):
+    statements = []
+    buffer = ""
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ""
+    return statements
+
+# Versions already applied to a database
+def applied_versions(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_ts VARCHAR(20))")
+    return {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+
+# Apply pending migrations (up to target, if given) on a sqlite3 connection, return their names
+def apply_migrations(conn, target=None, directory=MIGRATIONS_DIR):
+
+    # Manual transactions: everything, or nothing, is applied
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        # Take the write lock first, so concurrent workers apply each migration only once
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            applied = applied_versions(conn)
+            names = []
+            for version, name, path in discover(directory):
+                if version in applied or (target is not None and version > target):
+                    continue
+
+                check = PRECHECKS.get(version)
+                problem = check(conn) if check is not None else None
+                if problem is not None:
+                    raise MigrationError(f"migration {version:04d}_{name} can't be applied: {problem}")
+
+                with open(path) as f:
+                    for statement in split_statements(f.read()):
+                        conn.execute(statement)
+
+                conn.execute(
+                    "INSERT INTO schema_migrations (version, name, applied_ts) VALUES (?, ?, ?)",
+                    (version, name, datetime.utcnow().strftime(ts_format)),
+                )
+                names.append(name)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.isolation_level = isolation_level
+
+    return names
+
+# Apply pending migrations through a SQLAlchemy engine (the application's, by default)
+def migrate(engine=None, target=None):
+    if engine is None:
+        from database import db as engine
+
+    raw = engine.raw_connection()
+    try:
+        return apply_migrations(raw.driver_connection, target)
+    finally:
+        raw.close()
+
+# Print applied and pending migrations
+def status(engine=None):
+    if engine is None:
+        from database import db as engine
+
+    raw = engine.raw_connection()
+    try:
+        applied = applied_versions(raw.driver_connection)
+        raw.commit()
+    finally:
+        raw.close()
+
+    for version, name, path in discover():
+        print(f"{version:04d} {name}: {'applied' if version in applied else 'pending'}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "status":
+        status()
+    else:
+        for name in migrate():
+            print(f"applied {name}")
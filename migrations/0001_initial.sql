@@ -1,4 +1,6 @@
-CREATE TABLE users (
+-- Initial schema, as deployed before migrations existed
+
+CREATE TABLE IF NOT EXISTS users (
     cicero_id INTEGER PRIMARY KEY, 
     google_id VARCHAR(30), 
     name VARCHAR(30) NOT NULL, 
@@ -7,7 +9,7 @@ CREATE TABLE users (
     hash VARCHAR(60)
     );
 
-CREATE TABLE trips (
+CREATE TABLE IF NOT EXISTS trips (
     trip_id INTEGER PRIMARY KEY, 
     user_id INTEGER FOREIGN_KEY REFERENCES users(cicero_id), 
     generation_ts VARCHAR(20), 
@@ -17,9 +19,9 @@ CREATE TABLE trips (
     travel_plan TEXT NOT NULL
     );
 
-CREATE TABLE password_resets (
+CREATE TABLE IF NOT EXISTS password_resets (
     pwd_reset_id INTEGER PRIMARY KEY,
     user_id INTEGER FOREIGN_KEY REFERENCES users(cicero_id),
     expiration_ts VARCHAR(30),
     secret_key VARCHAR(30) NOT NULL
-    );
\ No newline at end of file
+    );
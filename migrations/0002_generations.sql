@@ -0,0 +1,16 @@
+-- Resumable generations, checkpointed while they run
+
+CREATE TABLE IF NOT EXISTS generations (
+    generation_id VARCHAR(32) PRIMARY KEY,
+    flight_id VARCHAR(32) NOT NULL,
+    user_id INTEGER FOREIGN_KEY REFERENCES users(cicero_id),
+    generation_ts VARCHAR(20),
+    destination VARCHAR(90) NOT NULL,
+    month VARCHAR(15) NOT NULL,
+    duration VARCHAR(15) NOT NULL,
+    status VARCHAR(10) NOT NULL,
+    travel_plan TEXT NOT NULL
+    );
+
+-- Checkpoints update every generation of a flight
+CREATE INDEX IF NOT EXISTS generations_flight_id ON generations (flight_id);
@@ -0,0 +1,10 @@
+-- Indexes for the lookups on the request path
+
+-- login, register, callback and send_password_reset look users up by email
+CREATE UNIQUE INDEX IF NOT EXISTS users_email ON users (email);
+
+-- history lists the trips of a user, newest first
+CREATE INDEX IF NOT EXISTS trips_user_id ON trips (user_id, trip_id);
+
+-- the reset callback looks the reset up by its secret
+CREATE INDEX IF NOT EXISTS password_resets_secret_key ON password_resets (secret_key);
@@ -0,0 +1,12 @@
+-- Full-text index over the destination and itinerary of trips.
+-- Contentless: travel plans are stored compressed in trips, the index only keeps the terms.
+-- rowid is trips.trip_id, owner holds the "u<user_id>" token that scopes searches to one user.
+-- Kept in sync by insert_trip(); rows that existed before are indexed by "python search.py reindex".
+
+CREATE VIRTUAL TABLE IF NOT EXISTS trips_fts USING fts5(
+    owner,
+    destination,
+    travel_plan,
+    content = '',
+    tokenize = 'unicode61 remove_diacritics 2'
+    );
@@ -0,0 +1,5 @@
+-- Trips remember the generation they come from, so replayed write-behind jobs insert them only once
+
+ALTER TABLE trips ADD COLUMN generation_id VARCHAR(32);
+
+CREATE UNIQUE INDEX IF NOT EXISTS trips_generation_id ON trips (generation_id);
@@ -0,0 +1,20 @@
+-- Trips remember their interests (a JSON list, in the form's order), so the most requested
+-- trips can be generated ahead by pregenerate.py
+
+ALTER TABLE trips ADD COLUMN interests TEXT;
+
+-- Itineraries generated ahead of demand, served by /stream without calling the API.
+-- One row per trip and prompt template; travel_plan is compressed like trips.travel_plan
+CREATE TABLE IF NOT EXISTS pregenerated (
+    template_id VARCHAR(30) NOT NULL,
+    destination VARCHAR(90) NOT NULL COLLATE NOCASE,
+    month VARCHAR(15) NOT NULL,
+    duration VARCHAR(15) NOT NULL,
+    interests TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    requests INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    travel_plan BLOB NOT NULL,
+    PRIMARY KEY (template_id, destination, month, duration, interests)
+    );
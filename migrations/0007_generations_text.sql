@@ -0,0 +1,5 @@
+-- Completed generations are also a trip, which keeps their text (compressed):
+-- drop the duplicate copy from generations
+
+UPDATE generations SET travel_plan = ''
+    WHERE status = 'done' AND generation_id IN (SELECT generation_id FROM trips WHERE generation_id IS NOT NULL);
@@ -0,0 +1,124 @@
+import logging
+import os
+import re
+import threading
+import time
+
+import requests
+
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# HTTP for Google OAuth.
+# One keep-alive session per worker, with timeouts, so login reuses TLS connections to Google.
+# The OpenID discovery document is cached for the max-age Google sends, and refreshed in the
+# background before it expires: login doesn't wait on it, except for the very first fetch.
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: OAuth HTTP variables
+OAUTH_CONNECT_TIMEOUT = float(os.environ.get("OAUTH_CONNECT_TIMEOUT", 3.05))
+OAUTH_READ_TIMEOUT = float(os.environ.get("OAUTH_READ_TIMEOUT", 10))
+OAUTH_POOL_SIZE = int(os.environ.get("OAUTH_POOL_SIZE", 10))
+
+# - Discovery document: cache lifetime when Google sends no max-age, and the share of the
+#   lifetime after which a background refresh starts
+OAUTH_DISCOVERY_TTL = float(os.environ.get("OAUTH_DISCOVERY_TTL", 3600))
+OAUTH_DISCOVERY_REFRESH_AT = float(os.environ.get("OAUTH_DISCOVERY_REFRESH_AT", 0.8))
+OAUTH_RETRY_DELAY = float(os.environ.get("OAUTH_RETRY_DELAY", 30))
+
+
+# Session applying default timeouts to every request
+class TimeoutSession(requests.Session):
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+# SETUP: Shared session
+http = TimeoutSession((OAUTH_CONNECT_TIMEOUT, OAUTH_READ_TIMEOUT))
+http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=OAUTH_POOL_SIZE))
+
+# Pooled sockets must not be shared across a fork: each worker opens its own
+os.register_at_fork(after_in_child=http.close)
+
+
+# Seconds a response may be cached for, from its Cache-Control and Age headers
+def max_age(response, default):
+    match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+    if not match:
+        return default
+    try:
+        age = int(response.headers.get("Age", 0))
+    except ValueError:
+        age = 0
+    return max(int(match.group(1)) - age, 0)
+
+
+# Cached JSON document, refreshed in the background before it expires
+class DiscoveryDocument:
+    def __init__(self, url, session=http, default_ttl=OAUTH_DISCOVERY_TTL, refresh_at=OAUTH_DISCOVERY_REFRESH_AT):
+        self.url = url
+        self.session = session
+        self.default_ttl = default_ttl
+        self.refresh_at = refresh_at
+        self._document = None
+        self._refresh_after = 0
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    # Return the document: fetched now only if there is none, or it has expired
+    def get(self):
+        now = time.monotonic()
+        if self._document is None:
+            return self.fetch()
+        if now >= self._expires:
+            # Google unreachable: an expired document beats a failed login
+            try:
+                return self.fetch()
+            except (requests.RequestException, ValueError) as e:
+                logger.warning("discovery document expired, serving it stale: %s", e)
+                return self._document
+        if now >= self._refresh_after:
+            self.refresh()
+        return self._document
+
+    # Fetch the document and cache it; raises on failure
+    def fetch(self):
+        response = self.session.get(self.url)
+        response.raise_for_status()
+        document = response.json()
+
+        ttl = max_age(response, self.default_ttl)
+        now = time.monotonic()
+        self._document = document
+        self._refresh_after = now + ttl * self.refresh_at
+        self._expires = now + ttl
+        return document
+
+    # Fetch the document on a background thread, unless a refresh is already running
+    def refresh(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self):
+        try:
+            self.fetch()
+        except (requests.RequestException, ValueError) as e:
+            # Keep serving the current document, try again a bit later
+            logger.warning("discovery document refresh failed: %s", e)
+            self._refresh_after = time.monotonic() + OAUTH_RETRY_DELAY
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -0,0 +1,322 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+import openai
+import sqlalchemy
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from codec import decode_plan, encode_plan
+from itineraries import generate_itinerary
+from prompts import DURATION, ITINERARY_PROMPT, MONTHS, PROMPT_MAX_COMPLETION_TOKENS, build_prompt, canonical_trip, current_template_id
+from providers import ProviderError, retry_after
+
+# Batch pre-generation of the most requested itineraries.
+# The most requested trips (canonical destination, month, duration and interests) are read from
+# the trips table, generated ahead through the provider layer, and stored in the pregenerated
+# table. /stream looks trips up there on an itinerary cache miss, so popular trips are served
+# at peak hours without calling the API. Run it off-peak, e.g. nightly from cron.
+# - Idempotent and resumable: trips already stored for the current prompt template (and younger
+#   than --max-age days) are skipped, and every itinerary is saved as soon as it is complete, so an
+#   interrupted run picks up where it stopped
+# - Bounded: at most --concurrency generations at a time, within --rpm requests and --tpm tokens
+#   per minute; a rate limit error (429) pauses every worker for the time the API asks
+# - Reports progress per trip, then tokens and estimated cost (tokens are estimates: see prompts.py)
+# Trips saved before they recorded their interests are not counted.
+#   python pregenerate.py run --limit 200 --dry-run    list the trips to generate, and the estimated cost
+#   python pregenerate.py run --limit 200              generate them
+#   python pregenerate.py status                       stored itineraries, and the share of requests they cover
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Pre-generation variables
+# - Trips generated per run, and the requests a trip needs to be generated
+PREGENERATE_LIMIT = int(os.environ.get("PREGENERATE_LIMIT", 200))
+PREGENERATE_MIN_REQUESTS = int(os.environ.get("PREGENERATE_MIN_REQUESTS", 3))
+
+# - Concurrent generations, and the share of the account's rate limits the job may use
+PREGENERATE_CONCURRENCY = int(os.environ.get("PREGENERATE_CONCURRENCY", 4))
+PREGENERATE_RPM = int(os.environ.get("PREGENERATE_RPM", 60))
+PREGENERATE_TPM = int(os.environ.get("PREGENERATE_TPM", 40000))
+
+# - Stored itineraries are generated again after this many days
+PREGENERATE_MAX_AGE_DAYS = int(os.environ.get("PREGENERATE_MAX_AGE_DAYS", 30))
+
+# - Price per 1000 prompt and completion tokens, in dollars, and the expected completion length
+PREGENERATE_PROMPT_PRICE = float(os.environ.get("PREGENERATE_PROMPT_PRICE", 0.0015))
+PREGENERATE_COMPLETION_PRICE = float(os.environ.get("PREGENERATE_COMPLETION_PRICE", 0.002))
+PREGENERATE_COMPLETION_TOKENS = int(os.environ.get("PREGENERATE_COMPLETION_TOKENS", PROMPT_MAX_COMPLETION_TOKENS or 1000))
+
+# Attempts of a trip that keeps hitting the rate limit, and the pause when the API gives no Retry-After
+RATE_LIMIT_ATTEMPTS = 5
+RATE_LIMIT_PAUSE = 20
+
+
+# Key of a trip in the pregenerated table: the destination its prompt is rendered with (the
+# column ignores case). Stored trips use the canonical name, so a guessed match is a miss
+def trip_key(trip):
+    return (trip["destination"].casefold(), trip["month"], trip["duration"], json.dumps(trip["interests"]))
+
+# Estimated cost of a number of prompt and completion tokens, in dollars
+def cost(prompt_tokens, completion_tokens):
+    return (prompt_tokens * PREGENERATE_PROMPT_PRICE + completion_tokens * PREGENERATE_COMPLETION_PRICE) / 1000
+
+# Itinerary of a trip generated ahead, from a template, None if there is none
+def load_pregenerated(db, trip, template_id):
+    stmt = sqlalchemy.text("SELECT travel_plan FROM pregenerated WHERE template_id = :template_id AND destination = :destination AND month = :month AND duration = :duration AND interests = :interests")
+    with db.connect() as conn:
+        row = conn.execute(stmt, parameters=dict(trip, template_id=template_id, interests=json.dumps(trip["interests"]))).first()
+    return decode_plan(row[0]) if row is not None else None
+
+# Store the itinerary of a trip; running a trip again replaces its row
+def save_pregenerated(trip, template_id, requests, prompt_tokens, completion_tokens, travel_plan):
+    from database import execute_write
+
+    stmt = sqlalchemy.text("INSERT INTO pregenerated (template_id, destination, month, duration, interests, created_at, requests, prompt_tokens, completion_tokens, travel_plan) \
+        VALUES (:template_id, :destination, :month, :duration, :interests, :created_at, :requests, :prompt_tokens, :completion_tokens, :travel_plan) \
+        ON CONFLICT (template_id, destination, month, duration, interests) DO UPDATE SET created_at = excluded.created_at, requests = excluded.requests, \
+        prompt_tokens = excluded.prompt_tokens, completion_tokens = excluded.completion_tokens, travel_plan = excluded.travel_plan")
+    execute_write(stmt, dict(
+        trip,
+        template_id=template_id,
+        interests=json.dumps(trip["interests"]),
+        created_at=int(time.time()),
+        requests=requests,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        travel_plan=encode_plan(travel_plan),
+    ))
+
+
+# Most requested trips, as (canonical trip, requests), most requested first.
+# Destinations are canonicalized again, so trips saved before destinations.py count together
+def popular_trips(db, min_requests=PREGENERATE_MIN_REQUESTS):
+    stmt = sqlalchemy.text("SELECT destination, month, duration, interests, COUNT(*) FROM trips WHERE interests IS NOT NULL GROUP BY destination, month, duration, interests")
+    with db.connect() as conn:
+        rows = conn.execute(stmt).fetchall()
+
+    requests = Counter()
+    trips = {}
+    for destination, month, duration, interests, count in rows:
+        try:
+            trip = canonical_trip(destination, month, duration, json.loads(interests))
+        except (TypeError, ValueError):
+            continue
+        if month not in MONTHS or duration not in DURATION or not trip["interests"]:
+            continue
+
+        # Typos count with the canonical spelling, which the prompt uses
+        trip = dict(trip, destination=trip["canonical"])
+        key = trip_key(trip)
+        requests[key] += count
+        trips[key] = trip
+
+    return [(trips[key], count) for key, count in requests.most_common() if count >= min_requests]
+
+# Keys of the trips stored for a template, younger than max_age seconds (None: of any age)
+def stored_trips(db, template_id, max_age=None):
+    stmt = sqlalchemy.text("SELECT destination, month, duration, interests FROM pregenerated WHERE template_id = :template_id AND created_at >= :since")
+    with db.connect() as conn:
+        rows = conn.execute(stmt, parameters={"template_id": template_id, "since": 0 if max_age is None else int(time.time() - max_age)}).fetchall()
+    return {(destination.casefold(), month, duration, interests) for destination, month, duration, interests in rows}
+
+
+# Requests and tokens per minute, shared by every worker: acquire() waits until a request fits.
+# Budgets refill continuously; pause() holds every request back, after a rate limit error
+class Throttle:
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.updated = now
+
+    def acquire(self, tokens, requests=1):
+        # A request larger than the whole budget waits for a full budget
+        tokens = min(tokens, self.tpm)
+        requests = min(requests, self.rpm)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.requests >= requests and self.tokens >= tokens:
+                    self.requests -= requests
+                    self.tokens -= tokens
+                    return
+                wait = max(
+                    self.paused_until - now,
+                    (requests - self.requests) * 60 / self.rpm,
+                    (tokens - self.tokens) * 60 / self.tpm,
+                )
+            time.sleep(max(wait, 0.01))
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# A run of the job: generates trips with bounded concurrency, and keeps the counts
+class Job:
+    def __init__(self, trips, template_id, throttle, concurrency=PREGENERATE_CONCURRENCY):
+        self.trips = trips
+        self.template_id = template_id
+        self.throttle = throttle
+        self.concurrency = concurrency
+        self.stopping = threading.Event()
+        self.done = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.requests = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Generate and store the itinerary of a trip, retrying it while the API rate limits us
+    def generate(self, trip, requests):
+        prompt = build_prompt(trip, self.template_id)
+        for attempt in range(RATE_LIMIT_ATTEMPTS):
+            if self.stopping.is_set():
+                return
+            # Sectioned prompts send one request per section
+            self.throttle.acquire(prompt.tokens + PREGENERATE_COMPLETION_TOKENS, prompt.requests)
+            start = time.monotonic()
+            try:
+                # Every streamed chunk is about one token
+                chunks = list(generate_itinerary(prompt))
+            except ProviderError as e:
+                if isinstance(e.__cause__, openai.error.RateLimitError) and attempt < RATE_LIMIT_ATTEMPTS - 1:
+                    self.throttle.pause(retry_after(e.__cause__) or RATE_LIMIT_PAUSE)
+                    continue
+                self.report(trip, requests, f"failed: {e.__cause__ or e}")
+                return
+            break
+
+        try:
+            save_pregenerated(trip, self.template_id, requests, prompt.tokens, len(chunks), "".join(chunks))
+        except Exception as e:
+            self.report(trip, requests, f"failed: db error {e}")
+            return
+        self.report(trip, requests, f"{prompt.tokens} + {len(chunks)} tokens, {time.monotonic() - start:.1f}s", prompt.tokens, len(chunks))
+
+    # Count a finished trip, and print a progress line
+    def report(self, trip, requests, outcome, prompt_tokens=None, completion_tokens=None):
+        with self._lock:
+            if prompt_tokens is None:
+                self.failed += 1
+            else:
+                self.done += 1
+                self.requests += requests
+                self.prompt_tokens += prompt_tokens
+                self.completion_tokens += completion_tokens
+            finished = self.done + self.failed
+            print(f"[{finished}/{len(self.trips)}] {describe(trip)} ({requests} requests): {outcome}", flush=True)
+
+    # Generate every trip; on Ctrl-C, running generations finish and are saved, the others are left for the next run
+    def run(self):
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        futures = [executor.submit(self.generate, trip, requests) for trip, requests in self.trips]
+        try:
+            for future in futures:
+                future.result()
+        except KeyboardInterrupt:
+            print("interrupted: finishing the running generations, run again to resume", flush=True)
+            self.stopping.set()
+            executor.shutdown(cancel_futures=True)
+        executor.shutdown()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        print(f"{self.done} generated, {self.failed} failed, {len(self.trips) - self.done - self.failed} left, in {elapsed:.0f}s")
+        print(f"tokens: {self.prompt_tokens} prompt + {self.completion_tokens} completion, about ${cost(self.prompt_tokens, self.completion_tokens):.3f}")
+        print(f"the generated trips were requested {self.requests} times")
+
+
+# Trip as printed in progress lines
+def describe(trip):
+    return f"{trip['destination']}, {trip['month']}, {trip['duration']}, {' + '.join(trip['interests'])}"
+
+
+# Pick the trips to generate and run the job
+def run(db, limit, min_requests, concurrency, rpm, tpm, max_age_days, dry_run=False):
+    from migrations import migrate
+
+    migrate(db)
+    template_id = current_template_id(ITINERARY_PROMPT)
+
+    # Most requested trips, without the ones already stored
+    popular = popular_trips(db, min_requests)
+    stored = stored_trips(db, template_id, max_age_days * 86400)
+    pending = [(trip, requests) for trip, requests in popular if trip_key(trip) not in stored]
+    trips = pending[:limit]
+    print(f"{len(popular)} trips requested at least {min_requests} times, {len(popular) - len(pending)} already stored for {template_id}, {len(trips)} to generate")
+
+    if dry_run:
+        prompt_tokens = 0
+        for trip, requests in trips:
+            tokens = build_prompt(trip, template_id).tokens
+            prompt_tokens += tokens
+            print(f"  {describe(trip)} ({requests} requests): {tokens} prompt tokens")
+        completion_tokens = len(trips) * PREGENERATE_COMPLETION_TOKENS
+        print(f"estimated: {prompt_tokens} prompt + {completion_tokens} completion tokens, about ${cost(prompt_tokens, completion_tokens):.3f}")
+        return
+
+    job = Job(trips, template_id, Throttle(rpm, tpm), concurrency)
+    job.run()
+    job.summary()
+
+# Stored itineraries by template, and the share of recorded requests they cover
+def status(db):
+    with db.connect() as conn:
+        rows = conn.execute(sqlalchemy.text(
+            "SELECT template_id, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), MIN(created_at) FROM pregenerated GROUP BY template_id"
+        )).fetchall()
+    for template_id, count, prompt_tokens, completion_tokens, oldest in rows:
+        print(f"{template_id}: {count} itineraries, {prompt_tokens} + {completion_tokens} tokens (about ${cost(prompt_tokens, completion_tokens):.3f}), oldest from {time.strftime('%Y-%m-%d', time.gmtime(oldest))}")
+
+    template_id = current_template_id(ITINERARY_PROMPT)
+    popular = popular_trips(db, 1)
+    stored = stored_trips(db, template_id)
+    requests = sum(count for trip, count in popular)
+    covered = sum(count for trip, count in popular if trip_key(trip) in stored)
+    print(f"{covered} of {requests} recorded requests ({covered / max(requests, 1):.0%}) are for trips stored for {template_id}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the most requested itineraries ahead of demand")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="generate the most requested trips that aren't stored yet")
+    run_parser.add_argument("--limit", type=int, default=PREGENERATE_LIMIT, help="trips generated in this run")
+    run_parser.add_argument("--min-requests", type=int, default=PREGENERATE_MIN_REQUESTS)
+    run_parser.add_argument("--concurrency", type=int, default=PREGENERATE_CONCURRENCY)
+    run_parser.add_argument("--rpm", type=int, default=PREGENERATE_RPM, help="requests per minute")
+    run_parser.add_argument("--tpm", type=int, default=PREGENERATE_TPM, help="tokens per minute")
+    run_parser.add_argument("--max-age", type=int, default=PREGENERATE_MAX_AGE_DAYS, help="days before a stored trip is generated again")
+    run_parser.add_argument("--dry-run", action="store_true", help="list the trips and the estimated cost, without calling the API")
+    commands.add_parser("status", help="stored itineraries, and the share of requests they cover")
+    args = parser.parse_args()
+
+    from database import db
+
+    if args.command == "run":
+        run(db, args.limit, args.min_requests, args.concurrency, args.rpm, args.tpm, args.max_age, args.dry_run)
+    else:
+        status(db)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import math
+import os
+import re
+
+from dotenv import load_dotenv
+from string import Template
+
+from destinations import resolve_destination
+
+# Prompt builder.
+# Prompts are versioned templates in templates/prompt/ (string.Template, $NAME fields), compacted
+# once when registered: indentation, runs of spaces and blank lines are dropped. Trip values are
+# canonicalized before substitution, so identical trips give identical prompts. The tokens of
+# every prompt are estimated and checked against PROMPT_MAX_TOKENS.
+# Pages never carry the prompt: they hold a signed reference to the trip and the template id,
+# and the prompt is rebuilt on the server. Add a template version with register_prompt_template().
+# Sectioned templates split the itinerary into one prompt per section (general advice, one per
+# interest, schedule), generated concurrently and merged in order (see itineraries.py).
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Prompt variables
+PROMPT_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "prompt")
+
+# - New itineraries are generated in one completion ("itinerary" templates), or section by section
+#   when ITINERARY_SECTIONS is "1" ("sections" templates)
+ITINERARY_SECTIONS = os.environ.get("ITINERARY_SECTIONS", "0") == "1"
+ITINERARY_PROMPT = "sections" if ITINERARY_SECTIONS else "itinerary"
+
+# - Template version used for new trips, per template name (0: the latest registered):
+#   PROMPT_VERSION for "itinerary", SECTIONS_PROMPT_VERSION for "sections"
+PROMPT_VERSIONS = {
+    "itinerary": int(os.environ.get("PROMPT_VERSION", 0)),
+    "sections": int(os.environ.get("SECTIONS_PROMPT_VERSION", 0)),
+}
+
+# - Budget of the prompt, in estimated tokens, and cap of the completion (0: no cap)
+PROMPT_MAX_TOKENS = int(os.environ.get("PROMPT_MAX_TOKENS", 600))
+PROMPT_MAX_COMPLETION_TOKENS = int(os.environ.get("PROMPT_MAX_COMPLETION_TOKENS", 0))
+
+SYSTEM_MESSAGE = "You are Cicero, an experienced travel guide who has visited the whole world. Use a professional, but friendly tone."
+
+# Trip choices offered by the form
+INTERESTS = ["History, Culture and Arts", "Outdoor and Nature", "Food and Dining", "Shopping", "Entertainment and Nightlife", "Sports and Adventure", "Religious and Spiritual Interests", "Family-Friendly Activities", "Wellness and Relaxation"]
+MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
+DURATION = ["A weekend", "One week", "Two weeks", "Three weeks", "Four weeks"]
+
+# Pieces of text priced by estimate_tokens(): words, numbers, runs of whitespace, single symbols
+TOKEN_PIECES = re.compile(r"[^\W\d_]+|\d+|\s+|[^\w\s]|_")
+
+
+# The prompt is over budget (in practice: the destination is too long)
+class PromptTooLong(ValueError):
+    pass
+
+
+# Drop indentation, runs of spaces and blank lines
+def compact(text):
+    return "\n".join(" ".join(line.split()) for line in text.splitlines() if line.strip())
+
+# Rough token count of a text, on the high side of the GPT tokenizers: a word costs one token
+# per 6 letters (common words are one token), digits one per 3, a space before a word nothing,
+# and symbols one each
+def estimate_tokens(text):
+    tokens = 0
+    for piece in TOKEN_PIECES.findall(text):
+        if piece[0].isalpha():
+            tokens += math.ceil(len(piece) / 6)
+        elif piece[0].isdigit():
+            tokens += math.ceil(len(piece) / 3)
+        elif piece.isspace():
+            tokens += 0 if piece == " " else math.ceil(len(piece) / 4)
+        else:
+            tokens += 1
+    return tokens
+
+# Estimated tokens of chat messages, with the few tokens of framing each message costs
+def estimate_message_tokens(messages):
+    return sum(estimate_tokens(message["content"]) + 4 for message in messages) + 3
+
+
+# Canonical trip values: the destination's canonical name (see destinations.py), interests
+# deduplicated in the form's order. A fuzzy match of the destination only keys the trip
+# ("canonical"): the prompt and the saved trip keep the destination as typed
+def canonical_trip(destination, month, duration, interests):
+    name, match = resolve_destination(destination)
+    return {
+        "destination": " ".join(destination.split()) if match == "fuzzy" else name,
+        "canonical": name,
+        "month": month,
+        "duration": duration,
+        "interests": [interest for interest in INTERESTS if interest in interests],
+    }
+
+
+# A rendered prompt: the messages to send, and their estimated tokens.
+# Sectioned prompts have no messages of their own: they hold the prompt of every section, in order
+class Prompt:
+    def __init__(self, id, messages, tokens, max_tokens=None, sections=None):
+        self.id = id
+        self.messages = messages
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.sections = sections
+
+    # Upstream requests sent to generate the prompt: one per section
+    @property
+    def requests(self):
+        return len(self.sections) if self.sections else 1
+
+
+class PromptTemplate:
+    def __init__(self, name, version, system, text):
+        self.id = f"{name}/{version}"
+        self.system = compact(system)
+        self.template = Template(compact(text))
+
+    # Render the prompt of a canonical trip, within the token budget; values fill extra fields
+    def render(self, trip, budget=PROMPT_MAX_TOKENS, max_completion=PROMPT_MAX_COMPLETION_TOKENS, **values):
+        values = dict(trip, interests=", ".join(trip["interests"]), **values)
+        messages = [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.template.substitute(values)},
+        ]
+        tokens = estimate_message_tokens(messages)
+        if tokens > budget:
+            raise PromptTooLong(f"prompt of {tokens} tokens, over the budget of {budget}")
+        return Prompt(self.id, messages, tokens, max_completion or None)
+
+
+# Templates of the sections of an itinerary: the general advice, one per interest ($interest),
+# and the schedule. Every section is within the token budget on its own
+class SectionedTemplate:
+    def __init__(self, name, version, system, general, interest, schedule):
+        self.id = f"{name}/{version}"
+        self.general = PromptTemplate(name, version, system, general)
+        self.interest = PromptTemplate(name, version, system, interest)
+        self.schedule = PromptTemplate(name, version, system, schedule)
+
+    # Render the prompt of every section of a canonical trip, in document order
+    def render(self, trip, budget=PROMPT_MAX_TOKENS, max_completion=PROMPT_MAX_COMPLETION_TOKENS):
+        sections = [self.general.render(trip, budget, max_completion)]
+        sections += [self.interest.render(trip, budget, max_completion, interest=interest) for interest in trip["interests"]]
+        sections.append(self.schedule.render(trip, budget, max_completion))
+        return Prompt(self.id, None, sum(section.tokens for section in sections), max_completion or None, sections)
+
+
+# SETUP: Prompt template registry, by id ("name/version")
+PROMPT_TEMPLATES = {}
+
+# Compile a template from PROMPT_TEMPLATES_DIR and register it as name/version
+def register_prompt_template(name, version, filename, system=SYSTEM_MESSAGE):
+    with open(os.path.join(PROMPT_TEMPLATES_DIR, filename)) as f:
+        template = PromptTemplate(name, version, system, f.read())
+    PROMPT_TEMPLATES[template.id] = template
+
+# Compile the section templates of an itinerary from PROMPT_TEMPLATES_DIR and register them as name/version
+def register_sectioned_template(name, version, general, interest, schedule, system=SYSTEM_MESSAGE):
+    texts = []
+    for filename in (general, interest, schedule):
+        with open(os.path.join(PROMPT_TEMPLATES_DIR, filename)) as f:
+            texts.append(f.read())
+    template = SectionedTemplate(name, version, system, *texts)
+    PROMPT_TEMPLATES[template.id] = template
+
+# Id of the template used for new prompts of this name: its configured version, or the latest
+def current_template_id(name):
+    if PROMPT_VERSIONS.get(name):
+        return f"{name}/{PROMPT_VERSIONS[name]}"
+    versions = [int(id.split("/")[1]) for id in PROMPT_TEMPLATES if id.split("/")[0] == name]
+    return f"{name}/{max(versions)}"
+
+# Build the prompt of a trip; template_id defaults to the current version of ITINERARY_PROMPT.
+# A template that is no longer registered (e.g. a page from before a deploy) falls back to the current one
+def build_prompt(trip, template_id=None):
+    template = PROMPT_TEMPLATES.get(template_id) or PROMPT_TEMPLATES[current_template_id(ITINERARY_PROMPT)]
+    return template.render(trip)
+
+
+# - v1: the original prompt; v2: the same instructions, compacted
+register_prompt_template("itinerary", 1, "itinerary_v1.txt")
+register_prompt_template("itinerary", 2, "itinerary_v2.txt")
+
+# - sections v1: the v2 instructions, split by section
+register_sectioned_template("sections", 1, "sections_v1_general.txt", "sections_v1_interest.txt", "sections_v1_schedule.txt")
+
+# A pinned version that isn't registered would fail every new prompt: refuse to start instead
+if current_template_id(ITINERARY_PROMPT) not in PROMPT_TEMPLATES:
+    raise ValueError(f"prompt template {current_template_id(ITINERARY_PROMPT)} is not registered, check PROMPT_VERSION and SECTIONS_PROMPT_VERSION")
@@ -0,0 +1,463 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+import openai
+
+from dotenv import load_dotenv
+
+from metrics import PROVIDER_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+# LLM provider layer behind send_prompt().
+# Every stage of a generation has its own time limit: connecting, the first token, the gap
+# between two tokens, and the whole generation. Before the first token nothing has reached
+# the user, so failed or late attempts are retried with jittered backoff, and when a hedge
+# provider is configured (LLM_HEDGE_AFTER > 0) a second request is started once the first
+# token is late: whichever answers first is streamed, the other one is dropped. After the
+# first token a failure ends the generation, since the text already sent can't be taken back.
+# Each provider has a circuit breaker: after LLM_BREAKER_FAILURES failures in a row it is
+# skipped for LLM_BREAKER_COOLDOWN seconds (the hedge provider serves instead, if any), then
+# a single request probes it again.
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Provider variables
+LLM_MODEL = os.environ.get("LLM_MODEL", "gpt-3.5-turbo")
+
+# - Time limits, in seconds
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 3.05))
+LLM_FIRST_TOKEN_TIMEOUT = float(os.environ.get("LLM_FIRST_TOKEN_TIMEOUT", 15))
+LLM_STALL_TIMEOUT = float(os.environ.get("LLM_STALL_TIMEOUT", 20))
+LLM_TOTAL_TIMEOUT = float(os.environ.get("LLM_TOTAL_TIMEOUT", 180))
+
+# - Retries before the first token, with full jitter backoff
+LLM_RETRIES = int(os.environ.get("LLM_RETRIES", 2))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", 0.5))
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", 4))
+
+# - Hedge provider: another model and/or endpoint, asked when the first token is LLM_HEDGE_AFTER
+#   seconds late (0: never). Model, endpoint and key default to the primary ones
+LLM_HEDGE_AFTER = float(os.environ.get("LLM_HEDGE_AFTER", 0))
+LLM_HEDGE_MODEL = os.environ.get("LLM_HEDGE_MODEL", LLM_MODEL)
+LLM_HEDGE_API_BASE = os.environ.get("LLM_HEDGE_API_BASE")
+LLM_HEDGE_API_KEY = os.environ.get("LLM_HEDGE_API_KEY")
+
+# - Circuit breaker
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", 5))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", 30))
+
+
+# A generation failed upstream; the message is shown to the user
+class ProviderError(Exception):
+    pass
+
+
+class ProviderTimeout(ProviderError):
+    pass
+
+
+# Every provider's circuit breaker is open
+class ProviderUnavailable(ProviderError):
+    pass
+
+
+# Errors that a new request won't fix: the request itself is wrong
+def retryable(error):
+    return not isinstance(error, openai.error.InvalidRequestError)
+
+# Whether a chunk carries text: streams open with a role-only delta, which is not the first token
+def has_text(chunk):
+    return any(choice.delta.get("content") for choice in chunk.choices)
+
+# Seconds the upstream asked to wait (Retry-After of a 429), or None
+def retry_after(error):
+    try:
+        return float(getattr(error, "headers", {}).get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+# Full jitter backoff before retry number attempt (0-based)
+def backoff(attempt, base=LLM_RETRY_BASE_DELAY, cap=LLM_RETRY_MAX_DELAY):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# Closed: requests go through. Open: requests are refused for cooldown seconds.
+# Half-open: one probe request goes through, and closes or re-opens the breaker.
+class CircuitBreaker:
+    def __init__(self, failures=LLM_BREAKER_FAILURES, cooldown=LLM_BREAKER_COOLDOWN):
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    # True if a request may go through now
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.max_failures:
+                if self.opened_at is None or self.probing:
+                    logger.warning("circuit breaker open after %s failures", self.failures)
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    # A probe that ended without telling anything (e.g. dropped for another provider)
+    def release(self):
+        with self._lock:
+            self.probing = False
+
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if self.probing or time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+
+class OpenAIProvider:
+    def __init__(self, name, model=LLM_MODEL, api_base=None, api_key=None,
+                 connect_timeout=LLM_CONNECT_TIMEOUT, stall_timeout=LLM_STALL_TIMEOUT, total_timeout=LLM_TOTAL_TIMEOUT):
+        self.name = name
+        self.model = model
+        self.api_base = api_base
+        self.api_key = api_key
+        self.connect_timeout = connect_timeout
+        self.stall_timeout = stall_timeout
+        self.total_timeout = total_timeout
+        self.breaker = CircuitBreaker()
+
+    # Streamed completion of the messages; api_base and api_key default to the openai module's.
+    # Options are other API parameters (e.g. max_tokens), left out when None
+    def open(self, messages, options):
+        return openai.ChatCompletion.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            api_base=self.api_base,
+            api_key=self.api_key,
+            # A socket read timeout: bounds the wait for the headers and for every next chunk
+            request_timeout=(self.connect_timeout, self.stall_timeout),
+            **{name: value for name, value in options.items() if value is not None},
+        )
+
+    async def aopen(self, messages, options):
+        return await openai.ChatCompletion.acreate(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            api_base=self.api_base,
+            api_key=self.api_key,
+            # aiohttp only has a total timeout: token gaps are timed by the caller
+            request_timeout=(self.connect_timeout, self.total_timeout),
+            **{name: value for name, value in options.items() if value is not None},
+        )
+
+
+# One request to a provider, run in a thread up to its first chunk with text
+class Attempt:
+    def __init__(self, provider, messages, options):
+        self.provider = provider
+        self.future = Future()
+        self._settled = False
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, args=(messages, options), daemon=True).start()
+
+    def _run(self, messages, options):
+        try:
+            chunks = iter(self.provider.open(messages, options))
+            first = next(chunks, None)
+            while first is not None and not has_text(first):
+                first = next(chunks, None)
+        except BaseException as e:
+            self.settle("error" if retryable(e) else "invalid", e)
+            self.future.set_exception(e)
+            return
+        self.settle("first_token")
+        self.future.set_result((first, chunks))
+
+    # Record the attempt's outcome in the breaker and metrics, once
+    def settle(self, outcome, error=None):
+        with self._lock:
+            if self._settled:
+                return
+            self._settled = True
+
+        PROVIDER_ATTEMPTS.labels(self.provider.name, outcome).inc()
+        if outcome == "first_token":
+            self.provider.breaker.success()
+        elif outcome in ("error", "timeout"):
+            if error is not None:
+                logger.warning("%s request failed: %s", self.provider.name, error)
+            self.provider.breaker.failure()
+        else:
+            self.provider.breaker.release()
+
+    # Give up on the attempt: its stream is closed whenever it arrives
+    def abandon(self, outcome="abandoned"):
+        self.settle(outcome)
+        self.future.add_done_callback(close_attempt)
+
+
+def close_attempt(future):
+    if future.exception() is None:
+        chunks = future.result()[1]
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+class ProviderClient:
+    def __init__(self, primary, hedge=None, hedge_after=LLM_HEDGE_AFTER, first_token_timeout=LLM_FIRST_TOKEN_TIMEOUT,
+                 total_timeout=LLM_TOTAL_TIMEOUT, retries=LLM_RETRIES):
+        self.primary = primary
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.first_token_timeout = first_token_timeout
+        self.total_timeout = total_timeout
+        self.retries = retries
+
+    # Provider to ask first, skipping those whose breaker is open, and the ones left to hedge with
+    def _providers(self):
+        providers = [provider for provider in (self.primary, self.hedge) if provider is not None]
+        for index, provider in enumerate(providers):
+            if provider.breaker.allow():
+                return provider, (providers[index + 1:] if self.hedge_after > 0 else [])
+        raise ProviderUnavailable("Cicero is unavailable right now, try again in a minute")
+
+    # Next hedge provider whose breaker lets a request through, or None
+    def _next_hedge(self, hedges):
+        while hedges:
+            provider = hedges.pop(0)
+            if provider.breaker.allow():
+                PROVIDER_ATTEMPTS.labels(provider.name, "hedged").inc()
+                return provider
+        return None
+
+    # Wait before the next retry; False if the deadline doesn't leave time for another attempt
+    def _backoff_delay(self, attempt, error, deadline):
+        delay = backoff(attempt)
+        requested = retry_after(error)
+        if requested is not None:
+            delay = max(delay, requested)
+        if time.monotonic() + delay + 1 >= deadline:
+            return None
+        return delay
+
+    # Stream the chunks of a completion of the messages, options are passed to the API
+    def stream(self, messages, **options):
+        deadline = time.monotonic() + self.total_timeout
+        first, chunks = self._first_chunk(messages, options, deadline)
+        if first is None:
+            return
+        yield first
+
+        # Past the first token, a failure ends the generation: the text can't be taken back
+        try:
+            for chunk in chunks:
+                if time.monotonic() > deadline:
+                    raise ProviderTimeout("the itinerary took too long, try again")
+                yield chunk
+        except ProviderError:
+            raise
+        except Exception as e:
+            logger.warning("stream cut short: %s", e)
+            raise ProviderError("the itinerary was cut short, try again") from e
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    def _first_chunk(self, messages, options, deadline):
+        error = None
+        for attempt in range(self.retries + 1):
+            provider, hedges = self._providers()
+            started = time.monotonic()
+            first_deadline = min(deadline, started + self.first_token_timeout)
+            attempts = {Attempt(provider, messages, options)}
+
+            while attempts:
+                now = time.monotonic()
+                timeout = first_deadline - now
+                if hedges:
+                    timeout = min(timeout, started + self.hedge_after - now)
+                done, pending = wait([a.future for a in attempts], max(timeout, 0), return_when=FIRST_COMPLETED)
+
+                # First chunk wins: drop the other attempts
+                for a in list(attempts):
+                    if a.future not in done:
+                        continue
+                    attempts.discard(a)
+                    if a.future.exception() is None:
+                        for other in attempts:
+                            other.abandon()
+                        return a.future.result()
+                    error = a.future.exception()
+                    if not retryable(error):
+                        for other in attempts:
+                            other.abandon()
+                        raise ProviderError("the itinerary could not be generated") from error
+                if done and attempts:
+                    continue
+
+                # First token late, or the request failed: ask the hedge provider, or give up on this round
+                if hedges and time.monotonic() < first_deadline:
+                    hedge = self._next_hedge(hedges)
+                    if hedge is not None:
+                        attempts.add(Attempt(hedge, messages, options))
+                    continue
+                if done:
+                    break
+                for a in attempts:
+                    a.abandon("timeout")
+                error = ProviderTimeout("no answer from upstream")
+                attempts = set()
+
+            # Retry with backoff, while the deadline allows
+            if attempt == self.retries:
+                break
+            delay = self._backoff_delay(attempt, error, deadline)
+            if delay is None:
+                break
+            time.sleep(delay)
+
+        if isinstance(error, ProviderTimeout):
+            raise ProviderTimeout("Cicero is taking too long to answer, try again") from error
+        raise ProviderError("the itinerary could not be generated, try again") from error
+
+    # Async counterpart of stream()
+    async def astream(self, messages, **options):
+        deadline = time.monotonic() + self.total_timeout
+        first, chunks, provider = await self._afirst_chunk(messages, options, deadline)
+        if first is None:
+            return
+        yield first
+
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(chunks), max(0, min(provider.stall_timeout, deadline - time.monotonic())))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    if time.monotonic() >= deadline:
+                        raise ProviderTimeout("the itinerary took too long, try again")
+                    raise ProviderTimeout("the itinerary was cut short, try again")
+                yield chunk
+        except ProviderError:
+            raise
+        except Exception as e:
+            logger.warning("stream cut short: %s", e)
+            raise ProviderError("the itinerary was cut short, try again") from e
+        finally:
+            await chunks.aclose()
+
+    async def _afirst_chunk(self, messages, options, deadline):
+
+        # Request up to the first chunk with text; None for an empty completion
+        async def open_attempt(provider):
+            chunks = (await provider.aopen(messages, options)).__aiter__()
+            first = await anext(chunks, None)
+            while first is not None and not has_text(first):
+                first = await anext(chunks, None)
+            return first, chunks, provider
+
+        def settle(provider, outcome, error=None):
+            PROVIDER_ATTEMPTS.labels(provider.name, outcome).inc()
+            if outcome == "first_token":
+                provider.breaker.success()
+            elif outcome in ("error", "timeout"):
+                if error is not None:
+                    logger.warning("%s request failed: %s", provider.name, error)
+                provider.breaker.failure()
+            else:
+                provider.breaker.release()
+
+        async def abandon(tasks, outcome):
+            for task, provider in tasks.items():
+                task.cancel()
+                settle(provider, outcome)
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        error = None
+        for attempt in range(self.retries + 1):
+            provider, hedges = self._providers()
+            started = time.monotonic()
+            first_deadline = min(deadline, started + self.first_token_timeout)
+            tasks = {asyncio.ensure_future(open_attempt(provider)): provider}
+
+            try:
+                while tasks:
+                    now = time.monotonic()
+                    timeout = first_deadline - now
+                    if hedges:
+                        timeout = min(timeout, started + self.hedge_after - now)
+                    done, pending = await asyncio.wait(tasks, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+
+                    for task in done:
+                        provider = tasks.pop(task)
+                        if task.exception() is None:
+                            settle(provider, "first_token")
+                            await abandon(tasks, "abandoned")
+                            return task.result()
+                        error = task.exception()
+                        settle(provider, "error" if retryable(error) else "invalid", error)
+                        if not retryable(error):
+                            await abandon(tasks, "abandoned")
+                            raise ProviderError("the itinerary could not be generated") from error
+                    if done and tasks:
+                        continue
+
+                    if hedges and time.monotonic() < first_deadline:
+                        hedge = self._next_hedge(hedges)
+                        if hedge is not None:
+                            tasks[asyncio.ensure_future(open_attempt(hedge))] = hedge
+                        continue
+                    if done:
+                        break
+                    await abandon(tasks, "timeout")
+                    tasks = {}
+                    error = ProviderTimeout("no answer from upstream")
+            except asyncio.CancelledError:
+                await abandon(tasks, "abandoned")
+                raise
+
+            if attempt == self.retries:
+                break
+            delay = self._backoff_delay(attempt, error, deadline)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+
+        if isinstance(error, ProviderTimeout):
+            raise ProviderTimeout("Cicero is taking too long to answer, try again") from error
+        raise ProviderError("the itinerary could not be generated, try again") from error
+
+
+# SETUP: Providers
+primary = OpenAIProvider("primary")
+hedge = None
+if LLM_HEDGE_AFTER > 0:
+    hedge = OpenAIProvider("hedge", LLM_HEDGE_MODEL, LLM_HEDGE_API_BASE, LLM_HEDGE_API_KEY)
+
+llm = ProviderClient(primary, hedge)
@@ -0,0 +1,119 @@
+import html
+import os
+import re
+import sys
+
+import sqlalchemy
+
+from dotenv import load_dotenv
+
+from codec import decode_plan
+
+# Full-text search over the trips of a user, backed by the trips_fts FTS5 table.
+#   python search.py reindex    index the trips that existed before the FTS table
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Search variables
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", 20))
+SEARCH_SNIPPET_CHARS = int(os.environ.get("SEARCH_SNIPPET_CHARS", 200))
+
+# Destination matches weigh more than itinerary matches, owner is only a filter
+RANK = "bm25(trips_fts, 0.0, 10.0, 1.0)"
+
+
+# Plain text of an HTML itinerary
+def plain_text(travel_plan):
+    return html.unescape(re.sub(r"<[^>]+>", " ", travel_plan))
+
+# Search terms of a user query
+def query_terms(query):
+    return re.findall(r"\w+", query.lower())
+
+# Build the FTS5 query: every term must match, the last one as a prefix (search as you type)
+def fts_query(user_id, terms):
+    phrases = [f'"{term}"' for term in terms]
+    phrases[-1] += "*"
+    return f'owner : "u{user_id}" AND {{destination travel_plan}} : ({" AND ".join(phrases)})'
+
+# Index a trip, on an open connection (same transaction as the trip insert)
+def index_trip(conn, trip_id, user_id, destination, travel_plan):
+    stmt = sqlalchemy.text("INSERT INTO trips_fts (rowid, owner, destination, travel_plan) VALUES (:id, :owner, :destination, :travel_plan)")
+    conn.execute(stmt, parameters={"id": trip_id, "owner": f"u{user_id}", "destination": destination, "travel_plan": plain_text(travel_plan)})
+
+# Excerpt of the plain text around the first matching term, HTML escaped, with the terms highlighted
+def snippet(travel_plan, terms, size=SEARCH_SNIPPET_CHARS):
+    text = " ".join(plain_text(travel_plan).split())
+    pattern = re.compile(r"\b(" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+
+    # Center the excerpt on the first match, if the itinerary has one
+    match = pattern.search(text)
+    start = max(0, match.start() - size // 4) if match else 0
+    excerpt = text[start:start + size]
+    if start > 0:
+        excerpt = "…" + excerpt
+    if start + size < len(text):
+        excerpt += "…"
+
+    # Escape the text between matches and the matches separately, so highlights never split an entity
+    parts = []
+    last = 0
+    for m in pattern.finditer(excerpt):
+        parts.append(html.escape(excerpt[last:m.start()]))
+        parts.append(f"<mark>{html.escape(m.group(0))}</mark>")
+        last = m.end()
+    parts.append(html.escape(excerpt[last:]))
+
+    return "".join(parts)
+
+# Ranked search over the trips of a user: list of dicts, with an HTML snippet each
+def search_trips(conn, user_id, query, limit=SEARCH_PAGE_SIZE):
+    terms = query_terms(query)
+    if not terms:
+        return []
+
+    # Rank on the index alone, then read the summary columns and plans of one page only
+    stmt = sqlalchemy.text(f"SELECT t.trip_id, t.generation_ts, t.destination, t.month, t.duration, t.travel_plan \
+        FROM (SELECT rowid, {RANK} AS rank FROM trips_fts WHERE trips_fts MATCH :match ORDER BY rank LIMIT :limit) AS hits \
+        JOIN trips t ON t.trip_id = hits.rowid ORDER BY hits.rank")
+    rows = conn.execute(stmt, parameters={"match": fts_query(user_id, terms), "limit": limit}).fetchall()
+
+    return [
+        {
+            "trip_id": row[0],
+            "generation_ts": row[1],
+            "destination": row[2],
+            "month": row[3],
+            "duration": row[4],
+            "snippet": snippet(decode_plan(row[5]), terms),
+        }
+        for row in rows
+    ]
+
+# Index the trips missing from trips_fts, in batches. Returns the number of trips indexed.
+def reindex(engine, batch=500):
+    select = sqlalchemy.text("SELECT trip_id, user_id, destination, travel_plan FROM trips \
+        WHERE trip_id > :after AND trip_id NOT IN (SELECT rowid FROM trips_fts WHERE rowid > :after) ORDER BY trip_id LIMIT :batch")
+
+    indexed = 0
+    after = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select, parameters={"after": after, "batch": batch}).fetchall()
+            for row in rows:
+                index_trip(conn, row[0], row[1], row[2], decode_plan(row[3]))
+
+        indexed += len(rows)
+        if len(rows) < batch:
+            return indexed
+        after = rows[-1][0]
+
+
+if __name__ == "__main__":
+    from database import db
+
+    if len(sys.argv) > 1 and sys.argv[1] == "reindex":
+        print(f"indexed {reindex(db)} trips")
+    else:
+        print("usage: python search.py reindex")
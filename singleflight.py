@@ -0,0 +1,416 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+# One in-progress generation, shared by every request that asked for it
+class Flight:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cancelled = False
+
+        # Admission ticket of the upstream generation, if it has to wait for a slot
+        self.ticket = None
+
+        # Called with the flight once it ends, before subscribers are released,
+        # and the first exception one of them raised (e.g. the result couldn't be stored)
+        self.callbacks = []
+        self.callback_error = None
+
+        # Number of attached subscribers, and since when there are none
+        self.listeners = 0
+        self.idle_since = time.monotonic()
+
+        self._cond = threading.Condition()
+
+    # Append a chunk and wake up every subscriber
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    # Mark the flight as finished (with an optional error) and wake up every subscriber
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    # Full text produced so far
+    @property
+    def text(self):
+        with self._cond:
+            return "".join(self.chunks)
+
+    # True if nobody has been listening for at least grace seconds
+    def orphaned(self, grace):
+        with self._cond:
+            return self.listeners == 0 and time.monotonic() - self.idle_since >= grace
+
+    # Yield the text from character position on: what was already produced, then the live tail
+    def subscribe(self, position=0):
+        with self._cond:
+            self.listeners += 1
+            backlog = "".join(self.chunks)[position:]
+            offset = len(self.chunks)
+
+        try:
+            if backlog:
+                yield backlog
+
+            while True:
+                with self._cond:
+                    while offset >= len(self.chunks) and not self.done:
+                        self._cond.wait()
+
+                    pending = self.chunks[offset:]
+                    done = self.done
+                    error = self.error
+
+                # Yield outside of the lock, so slow clients don't hold up the producer
+                for chunk in pending:
+                    yield chunk
+                offset += len(pending)
+
+                if done and offset >= len(self.chunks):
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            with self._cond:
+                self.listeners -= 1
+                if not self.listeners:
+                    self.idle_since = time.monotonic()
+
+
+# Save a flight's partial output, best effort: errors are logged and never fail the flight.
+# checkpoint() may return a Future (a write queued, not waited on): while the previous one is
+# pending, the checkpoint is skipped. Returns the checkpoint now pending, if any
+def save_checkpoint(checkpoint, flight, pending=None):
+    if pending is not None and not pending.done():
+        return pending
+    try:
+        pending = checkpoint(flight)
+    except Exception:
+        logger.exception("flight checkpoint failed")
+        return None
+
+    if hasattr(pending, "add_done_callback"):
+        pending.add_done_callback(log_checkpoint_failure)
+    return pending
+
+def log_checkpoint_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("flight checkpoint failed: %r", future.exception())
+
+
+# Coalesces identical concurrent generations into a single upstream call
+# - checkpoint(flight) is called every checkpoint_interval seconds while the flight runs (see save_checkpoint)
+# - with orphan_policy "cancel", a flight nobody listened to for orphan_grace seconds is stopped,
+#   with "finish" it runs to completion into storage
+class FlightGroup:
+    def __init__(self, checkpoint=None, checkpoint_interval=2.0, orphan_policy="finish", orphan_grace=30.0):
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.orphan_policy = orphan_policy
+        self.orphan_grace = orphan_grace
+        self._flights = {}
+        self._by_id = {}
+        self._lock = threading.Lock()
+
+    # Attach to the flight for key, starting one from produce() if none is running
+    # - on_complete(text) runs once, when the flight completes successfully
+    # - on_done(flight) runs for every request attached, when the flight ends in any way
+    # - ticket is kept on the flight when this call starts it, see admission.py
+    # - on_join(flight) runs for every request attached, before a new flight starts: if it raises,
+    #   the request is detached (a new flight then ends with the error, unstarted) and join() raises
+    def join(self, key, produce, on_complete=None, on_done=None, ticket=None, on_join=None):
+        with self._lock:
+            flight = self._flights.get(key)
+            start = flight is None
+            if start:
+                flight = Flight()
+                flight.ticket = ticket
+                if ticket is not None:
+                    ticket.abandoned = lambda: self._abandoned(flight)
+                self._flights[key] = flight
+                self._by_id[flight.id] = flight
+
+            # Registered under the lock: once the flight is released, no callback can be added
+            if on_done is not None:
+                flight.callbacks.append(on_done)
+
+        if on_join is not None:
+            try:
+                on_join(flight)
+            except Exception as e:
+                with self._lock:
+                    if on_done in flight.callbacks:
+                        flight.callbacks.remove(on_done)
+                if start:
+                    self._release(key, flight, e)
+                raise
+
+        # The upstream stream is driven by its own thread, so a leader disconnecting
+        # doesn't cut the generation short for the requests attached to it
+        if start:
+            thread = threading.Thread(target=self._run, args=(key, flight, produce, on_complete), daemon=True)
+            thread.start()
+
+        return flight
+
+    # Flight currently running with the given id, if any
+    def get(self, flight_id):
+        with self._lock:
+            return self._by_id.get(flight_id)
+
+    # Number of generations currently in progress
+    def __len__(self):
+        with self._lock:
+            return len(self._flights)
+
+    # A flight still waiting for an upstream slot gives up its place in the queue once nobody
+    # listens to it, with orphan_policy "cancel" (see admission.py)
+    def _abandoned(self, flight):
+        if self.orphan_policy == "cancel" and flight.orphaned(self.orphan_grace):
+            flight.cancelled = True
+            return True
+        return False
+
+    def _run(self, key, flight, produce, on_complete):
+        error = None
+        chunks = produce()
+        last_checkpoint = time.monotonic()
+        pending = None
+        try:
+            for chunk in chunks:
+                flight.publish(chunk)
+
+                # Save partial output, so it survives dropped connections
+                if self.checkpoint is not None and time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                    pending = save_checkpoint(self.checkpoint, flight, pending)
+                    last_checkpoint = time.monotonic()
+
+                # Stop paying for tokens nobody will read
+                if self.orphan_policy == "cancel" and flight.orphaned(self.orphan_grace):
+                    flight.cancelled = True
+                    chunks.close()
+                    break
+
+            # Let the caller store the result before the flight is released
+            if on_complete is not None and not flight.cancelled:
+                on_complete(flight.text)
+        except Exception as e:
+            # A cancelled flight ends as cancelled, even if stopping it raised
+            if not flight.cancelled:
+                error = e
+        finally:
+            self._release(key, flight, error)
+
+    # End a flight: unregister it, run its callbacks, then release its subscribers
+    def _release(self, key, flight, error):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            self._by_id.pop(flight.id, None)
+
+        # Callbacks see the outcome, and run before subscribers are released
+        flight.error = error
+        for callback in flight.callbacks:
+            try:
+                callback(flight)
+            except Exception as e:
+                logger.exception("flight callback failed")
+                flight.callback_error = flight.callback_error or e
+        flight.finish(error)
+
+
+# Asyncio counterpart of Flight, used by the ASGI serving mode
+class AsyncFlight:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cancelled = False
+
+        # Admission ticket of the upstream generation, if it has to wait for a slot
+        self.ticket = None
+
+        # Called with the flight once it ends, before subscribers are released,
+        # and the first exception one of them raised (e.g. the result couldn't be stored)
+        self.callbacks = []
+        self.callback_error = None
+
+        # Number of attached subscribers, and since when there are none
+        self.listeners = 0
+        self.idle_since = time.monotonic()
+
+        self._cond = asyncio.Condition()
+
+    # Append a chunk and wake up every subscriber
+    async def publish(self, chunk):
+        async with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    # Mark the flight as finished (with an optional error) and wake up every subscriber
+    async def finish(self, error=None):
+        async with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    # Full text produced so far
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    # True if nobody has been listening for at least grace seconds
+    def orphaned(self, grace):
+        return self.listeners == 0 and time.monotonic() - self.idle_since >= grace
+
+    # Yield the text from character position on: what was already produced, then the live tail
+    async def subscribe(self, position=0):
+        self.listeners += 1
+        backlog = self.text[position:]
+        offset = len(self.chunks)
+
+        try:
+            if backlog:
+                yield backlog
+
+            while True:
+                async with self._cond:
+                    await self._cond.wait_for(lambda: offset < len(self.chunks) or self.done)
+                    pending = self.chunks[offset:]
+                    done = self.done
+
+                for chunk in pending:
+                    yield chunk
+                offset += len(pending)
+
+                if done and offset >= len(self.chunks):
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            self.listeners -= 1
+            if not self.listeners:
+                self.idle_since = time.monotonic()
+
+
+# Asyncio counterpart of FlightGroup: flights are driven by event loop tasks,
+# blocking on_done callbacks are run in threads; checkpoint must not block (see save_checkpoint)
+class AsyncFlightGroup:
+    def __init__(self, checkpoint=None, checkpoint_interval=2.0, orphan_policy="finish", orphan_grace=30.0):
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.orphan_policy = orphan_policy
+        self.orphan_grace = orphan_grace
+        self._flights = {}
+        self._by_id = {}
+        self._tasks = set()
+
+    # Attach to the flight for key, starting one from produce() if none is running.
+    # on_join(flight) is a coroutine function here
+    async def join(self, key, produce, on_complete=None, on_done=None, ticket=None, on_join=None):
+        flight = self._flights.get(key)
+        start = flight is None
+        if start:
+            flight = AsyncFlight()
+            flight.ticket = ticket
+            if ticket is not None:
+                ticket.abandoned = lambda: self._abandoned(flight)
+            self._flights[key] = flight
+            self._by_id[flight.id] = flight
+
+        if on_done is not None:
+            flight.callbacks.append(on_done)
+
+        if on_join is not None:
+            try:
+                await on_join(flight)
+            except Exception as e:
+                if on_done in flight.callbacks:
+                    flight.callbacks.remove(on_done)
+                if start:
+                    await self._release(key, flight, e)
+                raise
+
+        # Keep a reference to the task, the event loop only holds weak ones
+        if start:
+            task = asyncio.get_running_loop().create_task(self._run(key, flight, produce, on_complete))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        return flight
+
+    # Flight currently running with the given id, if any
+    def get(self, flight_id):
+        return self._by_id.get(flight_id)
+
+    # Number of generations currently in progress
+    def __len__(self):
+        return len(self._flights)
+
+    # A flight still waiting for an upstream slot gives up its place in the queue once nobody
+    # listens to it, with orphan_policy "cancel" (see admission.py)
+    def _abandoned(self, flight):
+        if self.orphan_policy == "cancel" and flight.orphaned(self.orphan_grace):
+            flight.cancelled = True
+            return True
+        return False
+
+    async def _run(self, key, flight, produce, on_complete):
+        error = None
+        chunks = produce()
+        last_checkpoint = time.monotonic()
+        pending = None
+        try:
+            async for chunk in chunks:
+                await flight.publish(chunk)
+
+                # Save partial output, so it survives dropped connections
+                if self.checkpoint is not None and time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                    pending = save_checkpoint(self.checkpoint, flight, pending)
+                    last_checkpoint = time.monotonic()
+
+                # Stop paying for tokens nobody will read
+                if self.orphan_policy == "cancel" and flight.orphaned(self.orphan_grace):
+                    flight.cancelled = True
+                    await chunks.aclose()
+                    break
+
+            # Let the caller store the result before the flight is released
+            if on_complete is not None and not flight.cancelled:
+                on_complete(flight.text)
+        except Exception as e:
+            # A cancelled flight ends as cancelled, even if stopping it raised
+            if not flight.cancelled:
+                error = e
+        finally:
+            await self._release(key, flight, error)
+
+    # End a flight: unregister it, run its callbacks, then release its subscribers
+    async def _release(self, key, flight, error):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        self._by_id.pop(flight.id, None)
+
+        # Callbacks see the outcome, and run before subscribers are released
+        flight.error = error
+        for callback in flight.callbacks:
+            try:
+                await asyncio.to_thread(callback, flight)
+            except Exception as e:
+                logger.exception("flight callback failed")
+                flight.callback_error = flight.callback_error or e
+        await flight.finish(error)
@@ -0,0 +1,158 @@
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Non-blocking startup.
+# Warm-ups that need the network or the database (OpenAI check, OAuth discovery, migrations)
+# run as background tasks, so importing the application never waits on them. /readyz turns
+# ready once the required tasks are done; /healthz reports every task and the cold start time,
+# from process start to the first response served.
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Startup variables
+STARTUP_RETRY_DELAY = float(os.environ.get("STARTUP_RETRY_DELAY", 2))
+STARTUP_RETRY_MAX_DELAY = float(os.environ.get("STARTUP_RETRY_MAX_DELAY", 60))
+
+# - Seconds a request waits for the required tasks before getting a 503
+STARTUP_REQUEST_WAIT = float(os.environ.get("STARTUP_REQUEST_WAIT", 10))
+
+
+# Start time of this process, as a time.time() timestamp: from /proc on Linux, else now
+def process_start_time():
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+class Task:
+    def __init__(self, name, fn, required, retry, fatal=()):
+        self.name = name
+        self.fn = fn
+        self.required = required
+        self.retry = retry
+        self.fatal = fatal
+        self.state = "pending"
+        self.attempts = 0
+        self.error = None
+        self.seconds = None
+        self.finished = threading.Event()
+
+    def status(self):
+        return {
+            "state": self.state,
+            "required": self.required,
+            "attempts": self.attempts,
+            "seconds": self.seconds,
+            "error": self.error,
+        }
+
+
+class Startup:
+    def __init__(self, retry_delay=STARTUP_RETRY_DELAY, retry_max_delay=STARTUP_RETRY_MAX_DELAY):
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.tasks = {}
+        self.first_byte = None
+        self._reset()
+
+        # Threads don't survive a fork (gunicorn --preload): each worker resumes the unfinished tasks
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self.started = process_start_time()
+        self.first_byte = None
+        self._lock = threading.Lock()
+
+    # Run fn() on a background thread; required tasks gate readiness, retried ones run until they succeed.
+    # Exceptions of the fatal types can't be fixed by retrying: the task fails at once
+    def add(self, name, fn, required=False, retry=True, fatal=()):
+        task = Task(name, fn, required, retry, fatal)
+        self.tasks[name] = task
+        self._launch(task)
+        return task
+
+    def _launch(self, task):
+        threading.Thread(target=self._run, args=(task,), daemon=True).start()
+
+    def _run(self, task):
+        delay = self.retry_delay
+        while True:
+            task.state = "running"
+            task.attempts += 1
+            start = time.monotonic()
+            try:
+                task.fn()
+            except Exception as e:
+                task.error = f"{type(e).__name__}: {e}"
+                if not task.retry or isinstance(e, task.fatal):
+                    logger.exception("startup task %s failed", task.name)
+                    task.state = "failed"
+                    task.finished.set()
+                    return
+
+                # Network or lock trouble: try again later, with backoff
+                logger.warning("startup task %s failed, retrying in %ss: %s", task.name, delay, task.error)
+                task.state = "retrying"
+                time.sleep(delay)
+                delay = min(delay * 2, self.retry_max_delay)
+                continue
+
+            task.seconds = round(time.monotonic() - start, 3)
+            task.error = None
+            task.state = "done"
+            task.finished.set()
+            logger.info("startup task %s done in %ss", task.name, task.seconds)
+            return
+
+    # True once every required task is done
+    def ready(self):
+        return all(task.state == "done" for task in self.tasks.values() if task.required)
+
+    # Wait up to timeout seconds (None: forever) for the required tasks, return whether they are done
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for task in list(self.tasks.values()):
+            remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+            if task.required and not task.finished.wait(remaining):
+                return False
+        return self.ready()
+
+    # Record the first response of this process, for the cold start time
+    def mark_first_byte(self):
+        if self.first_byte is not None:
+            return
+        with self._lock:
+            if self.first_byte is None:
+                self.first_byte = time.time() - self.started
+                logger.info("first response %.3fs after process start", self.first_byte)
+
+    def status(self):
+        return {
+            "ready": self.ready(),
+            "uptime": round(time.time() - self.started, 3),
+            "first_byte_seconds": round(self.first_byte, 3) if self.first_byte is not None else None,
+            "tasks": {name: task.status() for name, task in self.tasks.items()},
+        }
+
+    def _after_fork(self):
+        self._reset()
+        for task in self.tasks.values():
+            if task.state != "done" and task.state != "failed":
+                task.state = "pending"
+                task.finished = threading.Event()
+                self._launch(task)
+
+
+startup = Startup()
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+
+from dotenv import load_dotenv
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Batching of streamed text
+# - Deltas are coalesced until the batch reaches STREAM_BATCH_BYTES or is STREAM_BATCH_DELAY seconds old
+STREAM_BATCH_BYTES = int(os.environ.get("STREAM_BATCH_BYTES", 512))
+STREAM_BATCH_DELAY = float(os.environ.get("STREAM_BATCH_DELAY", 0.05))
+
+# Headers for streamed responses: no caching, no proxy buffering
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+# Format a server-sent event
+def sse_event(data, event=None, id=None):
+    lines = []
+    if event is not None:
+        lines.append(f"event: {event}")
+    if id is not None:
+        lines.append(f"id: {id}")
+
+    # Multi-line data must be split over several data fields
+    for line in data.split("\n"):
+        lines.append(f"data: {line}")
+
+    return "\n".join(lines) + "\n\n"
+
+
+# Coalesce text chunks into batches, by size or time window
+def batch_chunks(chunks, max_bytes=STREAM_BATCH_BYTES, max_delay=STREAM_BATCH_DELAY):
+    buffer = []
+    size = 0
+    started = None
+    first = True
+
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if started is None:
+            started = time.monotonic()
+
+        # The very first chunk goes out right away, to keep time to first byte low
+        if first or size >= max_bytes or time.monotonic() - started >= max_delay:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+            started = None
+            first = False
+
+    if buffer:
+        yield "".join(buffer)
+
+
+# Async version of batch_chunks
+async def abatch_chunks(chunks, max_bytes=STREAM_BATCH_BYTES, max_delay=STREAM_BATCH_DELAY):
+    buffer = []
+    size = 0
+    started = None
+    first = True
+
+    async for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if started is None:
+            started = time.monotonic()
+
+        # The very first chunk goes out right away, to keep time to first byte low
+        if first or size >= max_bytes or time.monotonic() - started >= max_delay:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+            started = None
+            first = False
+
+    if buffer:
+        yield "".join(buffer)
+
+
+# Merge concurrent streams of text into one, in order: every stream is consumed at once, in its
+# own thread; the first one is passed through live, later ones are buffered until their turn.
+# The first error of any stream is raised right away; closing the merge stops every stream
+# at its next chunk.
+def merge_streams(streams, separator=""):
+    events = queue.Queue()
+    stopping = threading.Event()
+
+    # Feed (index, chunk, error) events; a None chunk without error marks the end of a stream
+    def consume(index, stream):
+        try:
+            for chunk in stream:
+                if stopping.is_set():
+                    return
+                events.put((index, chunk, None))
+            events.put((index, None, None))
+        except Exception as e:
+            events.put((index, None, e))
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+
+    for index, stream in enumerate(streams):
+        threading.Thread(target=consume, args=(index, stream), daemon=True).start()
+
+    buffers = [[] for stream in streams]
+    ended = [False for stream in streams]
+    current = 0
+    try:
+        while current < len(streams):
+            index, chunk, error = events.get()
+            if error is not None:
+                raise error
+            if chunk is None:
+                ended[index] = True
+            else:
+                buffers[index].append(chunk)
+
+            # Pass on the current stream's text, and move on to the next one once it ended
+            while current < len(streams):
+                chunks, buffers[current] = buffers[current], []
+                yield from chunks
+                if not ended[current]:
+                    break
+                current += 1
+                if current < len(streams) and separator:
+                    yield separator
+    finally:
+        stopping.set()
+
+
+# Async version of merge_streams: every stream is consumed by its own task
+async def amerge_streams(streams, separator=""):
+    events = asyncio.Queue()
+
+    async def consume(index, stream):
+        try:
+            async for chunk in stream:
+                events.put_nowait((index, chunk, None))
+            events.put_nowait((index, None, None))
+        except Exception as e:
+            events.put_nowait((index, None, e))
+
+    tasks = [asyncio.ensure_future(consume(index, stream)) for index, stream in enumerate(streams)]
+
+    buffers = [[] for stream in streams]
+    ended = [False for stream in streams]
+    current = 0
+    try:
+        while current < len(streams):
+            index, chunk, error = await events.get()
+            if error is not None:
+                raise error
+            if chunk is None:
+                ended[index] = True
+            else:
+                buffers[index].append(chunk)
+
+            # Pass on the current stream's text, and move on to the next one once it ended
+            while current < len(streams):
+                chunks, buffers[current] = buffers[current], []
+                for text in chunks:
+                    yield text
+                if not ended[current]:
+                    break
+                current += 1
+                if current < len(streams) and separator:
+                    yield separator
+    finally:
+        for task in tasks:
+            task.cancel()
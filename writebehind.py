@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Durable write-behind queue.
+# put() appends a job to a local SQLite spool file and returns: the job survives a crash
+# from then on. A background thread per worker claims batches of jobs (with a lease, so
+# workers don't apply the same jobs), applies them in one transaction, then deletes them.
+# Jobs may be applied twice after a crash, so apply_batch must be idempotent.
+#   python writebehind.py    print the depth of the spool
+
+# SETUP: Load .env
+load_dotenv()
+
+# SETUP: Write-behind variables
+WRITE_BEHIND_SPOOL = os.environ.get("WRITE_BEHIND_SPOOL", "spool.db")
+WRITE_BEHIND_BATCH = int(os.environ.get("WRITE_BEHIND_BATCH", 50))
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", 0.2))
+WRITE_BEHIND_LEASE = float(os.environ.get("WRITE_BEHIND_LEASE", 60))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get("WRITE_BEHIND_MAX_ATTEMPTS", 5))
+
+
+# True for the errors worth retrying: the database is busy or locked
+def is_lock_error(error):
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+class WriteBehindQueue:
+    def __init__(self, apply_batch, spool_path=WRITE_BEHIND_SPOOL, batch_size=WRITE_BEHIND_BATCH,
+                 interval=WRITE_BEHIND_INTERVAL, lease=WRITE_BEHIND_LEASE, max_attempts=WRITE_BEHIND_MAX_ATTEMPTS):
+        self.apply_batch = apply_batch
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # Append a job (a JSON serializable dict) to the spool, and wake up the drainer
+    def put(self, job):
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT INTO jobs (payload) VALUES (?)", (json.dumps(job),))
+        self.start()
+        self._wakeup.set()
+
+    # Jobs waiting to be applied, and jobs given up on after max_attempts
+    def depth(self):
+        conn = self._connection()
+        pending, dead = conn.execute("SELECT COUNT(*) FILTER (WHERE dead = 0), COUNT(*) FILTER (WHERE dead = 1) FROM jobs").fetchone()
+        return {"pending": pending, "dead": dead}
+
+    # Start the drainer thread, once per process
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._local = threading.local()
+        thread = threading.Thread(target=self._loop, daemon=True)
+        thread.start()
+
+    # Spool connection of the current thread
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.spool_path, timeout=30)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, payload TEXT NOT NULL, \
+                claimed_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, dead INTEGER NOT NULL DEFAULT 0)")
+            self._local.conn = conn
+        return conn
+
+    # Claim the next batch of jobs for this worker
+    def _claim(self):
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            return conn.execute(
+                "UPDATE jobs SET claimed_until = ? WHERE id IN \
+                (SELECT id FROM jobs WHERE dead = 0 AND claimed_until < ? ORDER BY id LIMIT ?) RETURNING id, payload",
+                (now + self.lease, now, self.batch_size),
+            ).fetchall()
+
+    # Remove applied jobs from the spool
+    def _delete(self, ids):
+        conn = self._connection()
+        with conn:
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(i,) for i in ids])
+
+    # Give claimed jobs back, to be retried on the next round
+    def _release(self, ids):
+        conn = self._connection()
+        with conn:
+            conn.executemany("UPDATE jobs SET claimed_until = 0 WHERE id = ?", [(i,) for i in ids])
+
+    # Count a failed attempt; past max_attempts the job is kept aside, so it doesn't block the queue
+    def _fail(self, job_id):
+        conn = self._connection()
+        with conn:
+            conn.execute("UPDATE jobs SET attempts = attempts + 1, claimed_until = 0, dead = (attempts + 1 >= ?) WHERE id = ?",
+                         (self.max_attempts, job_id))
+
+    def _loop(self):
+        backoff = self.interval
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+            try:
+                while True:
+                    claimed = self._claim()
+                    if not claimed:
+                        break
+                    self._apply(claimed)
+                backoff = self.interval
+            except Exception as e:
+                # Lock contention: wait longer before the next round
+                if is_lock_error(e):
+                    logger.warning("write-behind batch deferred: %s", e)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 10)
+                else:
+                    logger.exception("write-behind drain failed")
+                    time.sleep(self.interval)
+
+    # Apply a batch in one transaction; if it fails for another reason than a lock,
+    # apply its jobs one by one to isolate the bad ones
+    def _apply(self, claimed):
+        ids = [row[0] for row in claimed]
+        jobs = [json.loads(row[1]) for row in claimed]
+        try:
+            self.apply_batch(jobs)
+        except Exception as e:
+            if is_lock_error(e):
+                self._release(ids)
+                raise
+            for index, (job_id, job) in enumerate(zip(ids, jobs)):
+                try:
+                    self.apply_batch([job])
+                except Exception as e:
+                    if is_lock_error(e):
+                        self._release(ids[index:])
+                        raise
+                    logger.exception("write-behind job %s failed", job_id)
+                    self._fail(job_id)
+                else:
+                    self._delete([job_id])
+            return
+
+        self._delete(ids)
+
+
+if __name__ == "__main__":
+    depth = WriteBehindQueue(apply_batch=None, spool_path=sys.argv[1] if len(sys.argv) > 1 else WRITE_BEHIND_SPOOL).depth()
+    print(f"pending: {depth['pending']}, dead: {depth['dead']}")